@@ -31,6 +31,11 @@ def create_app(config_class=Config):
 
     app = Flask(__name__)
     app.config.from_object(config_class)
+    if app.config['TRUSTED_PROXIES']:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        proxies = app.config['TRUSTED_PROXIES']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies,
+                                x_host=proxies, x_port=proxies)
 
     db.init_app(app)
     migrate.init_app(app, db)
@@ -52,6 +57,31 @@ def create_app(config_class=Config):
 
     app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
         if app.config['ELASTICSEARCH_URL'] else None
+    from app.search import create_backend, SearchCache
+    app.search_backend = create_backend(app)
+    app.search_cache = SearchCache(app.config['SEARCH_CACHE_SIZE'],
+                                   app.config['SEARCH_CACHE_TTL'],
+                                   app.config['SEARCH_CACHE_DEPTH']) \
+        if app.config['SEARCH_CACHE_SIZE'] else None
+    from app.notify import create_broker
+    app.notifier = create_broker(app)
+    from app import instrument, metrics, profiler, ratelimit
+    instrument.init_app(app)
+    metrics.init_app(app)
+    if app.metrics is not None and app.search_cache is not None:
+        app.metrics.watch_cache('search', app.search_cache)
+    profiler.init_app(app)
+    ratelimit.init_app(app)
+    from app.identity import IdentityCache
+    app.identity_cache = IdentityCache(app.config['IDENTITY_CACHE_SIZE'],
+                                       app.config['IDENTITY_CACHE_TTL']) \
+        if app.config['IDENTITY_CACHE_SIZE'] else None
+    if app.metrics is not None and app.identity_cache is not None:
+        app.metrics.watch_cache('identity', app.identity_cache)
+    from app.activity import LastSeenBuffer
+    app.last_seen = LastSeenBuffer(app, app.config['LAST_SEEN_GRANULARITY'],
+                                   app.config['LAST_SEEN_FLUSH_INTERVAL']) \
+        if app.config['LAST_SEEN_BUFFER'] else None
 
     if not app.debug and not app.testing:
          
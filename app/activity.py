@@ -0,0 +1,112 @@
+"""
+Buffers the last_seen times of users, so recording activity does not cost a write per request.
+
+Activity is recorded in memory, and at most once per LAST_SEEN_GRANULARITY seconds for a user.
+The buffered times are written to the database in one batched UPDATE every
+LAST_SEEN_FLUSH_INTERVAL seconds, at the end of a request, and when the process exits.
+A batch that cannot be written is kept, and written with the next one.
+
+Every worker process has its own buffer. The UPDATE only moves last_seen forward,
+so the flushes of several workers can run in any order.
+The users are recorded in the change log in the same transaction, so clients that sync
+see the new times.
+"""
+
+import atexit
+import threading
+import weakref
+from datetime import datetime, timedelta
+from time import time
+from app import db
+
+# the buffers that are open in this process, they are flushed once when it exits
+_buffers = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_all():
+    for buffer in list(_buffers):
+        buffer.flush()
+
+
+class LastSeenBuffer(object):
+    """
+    Collects the last_seen times of users and writes them in batches
+    """
+
+    def __init__(self, app, granularity, interval):
+        self.app = app
+        self.granularity = timedelta(seconds=granularity)
+        self.interval = interval
+        self.pending = {}           # user id -> time of activity that has not been written yet
+        self.recorded = {}          # user id -> time of the last activity that was recorded
+        self.lock = threading.Lock()
+        self.last_flush = time()
+        self.closed = False
+        _buffers.add(self)
+
+    def record(self, user_id, when=None):
+        """
+        Records activity of a user, activity within the granularity of the last one is dropped
+        Returns: True if the activity was recorded
+        """
+        when = when or datetime.utcnow()
+        with self.lock:
+            last = self.recorded.get(user_id)
+            if last is not None and when - last < self.granularity:
+                return False
+            self.recorded[user_id] = when
+            self.pending[user_id] = when
+        return True
+
+    def flush_due(self):
+        """
+        Flushes the buffer if LAST_SEEN_FLUSH_INTERVAL seconds have passed since the last flush
+        """
+        if time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered times in one batched UPDATE
+        Returns: the number of users written
+        """
+        if self.closed:
+            return 0
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time()
+            # activity older than the granularity can no longer cause a drop
+            cutoff = datetime.utcnow() - self.granularity
+            self.recorded = {user_id: when for user_id, when in self.recorded.items()
+                             if when >= cutoff}
+        if not pending:
+            return 0
+        from app.models import User, ChangeLog
+        user = User.__table__
+        update = user.update().where(user.c.id == db.bindparam('user_id')).where(
+            db.or_(user.c.last_seen == None, user.c.last_seen < db.bindparam('seen'))).values(
+            last_seen=db.bindparam('seen'))
+        try:
+            # a connection of its own, the session of the current request is left alone
+            with db.get_engine(self.app).begin() as connection:
+                connection.execute(update, [{'user_id': user_id, 'seen': when}
+                                            for user_id, when in pending.items()])
+                connection.execute(ChangeLog.__table__.insert(),
+                                   ChangeLog.update_records('user', pending))
+        except Exception:
+            self.app.logger.exception('Could not write last_seen for %d users', len(pending))
+            with self.lock:
+                for user_id, when in pending.items():
+                    if self.pending.get(user_id, when) <= when:
+                        self.pending[user_id] = when
+            return 0
+        return len(pending)
+
+    def close(self):
+        """
+        Writes the buffered times and stops buffering, before the database of the app goes away
+        """
+        self.flush()
+        self.closed = True
+        _buffers.discard(self)
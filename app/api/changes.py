@@ -0,0 +1,87 @@
+"""
+Incremental sync: the users, posts and follow relationships changed since a watermark.
+
+A client starts with GET /api/changes without a watermark, which only returns the current one,
+then copies everything with the exports (see export.py) and from then on asks for
+/api/changes?since=<watermark> with the watermark of the previous response. Each response
+has at most CHANGES_BATCH_SIZE changes, and has_more is set when the client should ask again
+straight away. Users and posts that were created or updated are sent as they are now,
+deleted ones with their id only.
+
+Changes are sent once they are CHANGES_SETTLE_SECONDS old, so that a transaction that
+commits after a later one cannot slip behind a watermark - see ChangeLog.settled_before.
+
+Changes are kept for CHANGES_RETENTION_DAYS. A watermark that is older than that gets
+410 Gone, and the client has to export everything again.
+"""
+
+from datetime import datetime, timedelta
+from flask import jsonify, request, url_for, current_app
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request, error_response
+from app.models import ChangeLog
+from app.pagination import encode_cursor, decode_cursor, InvalidCursor
+
+
+def serialize(changes):
+    """
+    Returns: the items of a response, with the current state of the users and posts that
+    still exist, read with one query per resource
+    """
+    models = {resource: model for model, resource in ChangeLog.RESOURCES.items()}
+    objects = {}
+    for resource, model in models.items():
+        ids = [object_id for kind, object_id, _, operation in changes
+               if kind == resource and operation != 'delete']
+        if ids:
+            objects[resource] = {obj.id: obj for obj in model.query.filter(model.id.in_(ids))}
+    items = []
+    for resource, object_id, related_id, operation in changes:
+        if resource == 'follow':
+            items.append({'resource': resource, 'operation': operation,
+                          'data': {'follower_id': object_id, 'followed_id': related_id}})
+            continue
+        obj = objects.get(resource, {}).get(object_id)
+        if obj is None:             # deleted since, its tombstone comes later
+            operation = 'delete'
+        items.append({'resource': resource, 'operation': operation, 'id': object_id,
+                      'data': obj.to_dict() if obj is not None else None})
+    return items
+
+
+@bp.route('/changes', methods=['GET'])
+@token_auth.login_required
+def get_changes():
+    """
+    Returns the changes after the watermark in since, or the current watermark without since
+    """
+    now = datetime.utcnow()
+    since = request.args.get('since')
+    if since is None:
+        change_id = ChangeLog.head()
+        return jsonify({'items': [], 'watermark': encode_cursor([change_id, now], 'next'),
+                        'has_more': False})
+    try:
+        (change_id, issued), _ = decode_cursor(since, [ChangeLog.id, ChangeLog.timestamp])
+    except InvalidCursor:
+        return bad_request('invalid watermark')
+    retention = timedelta(days=current_app.config['CHANGES_RETENTION_DAYS'])
+    if issued < now - retention:
+        return error_response(410, 'the watermark has expired, export everything again')
+    limit = min(request.args.get('limit', current_app.config['CHANGES_BATCH_SIZE'], type=int),
+                current_app.config['CHANGES_BATCH_SIZE'])
+    changes, last, more = ChangeLog.since(change_id, max(limit, 1))
+    if last is not None:
+        # a client that is behind is only as current as the last change it has read
+        watermark = encode_cursor([last.id, last.timestamp if more else now], 'next')
+    else:
+        watermark = encode_cursor([change_id, now], 'next')
+    return jsonify({
+        'items': serialize(changes),
+        'watermark': watermark,
+        'has_more': more,
+        '_links': {
+            'next': url_for('api.get_changes', since=watermark)
+        }
+    })
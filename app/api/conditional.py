@@ -0,0 +1,86 @@
+"""
+Conditional GET support for the API.
+
+Responses carry an ETag, and single resources also a Last-Modified date, both derived from the
+updated_at column of the rows. A client that sends them back in If-None-Match or
+If-Modified-Since gets an empty 304 Not Modified response when nothing has changed, which
+is decided before the resource is serialized.
+Last-Modified only has a resolution of one second, so clients should prefer the ETag.
+"""
+
+import hashlib
+from datetime import datetime
+from flask import request
+from werkzeug.exceptions import HTTPException
+from werkzeug.wrappers import Response
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class NotModified(HTTPException):
+    """
+    Raised to answer a request with 304 Not Modified
+    """
+    code = 304
+
+    def __init__(self, etag, last_modified=None):
+        super(NotModified, self).__init__()
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def get_response(self, environ=None):
+        response = Response(status=304)
+        return set_validators(response, self.etag, self.last_modified)
+
+
+def version(obj):
+    """
+    Returns: the time a row was last updated, rows written before updated_at existed
+    have not been updated since
+    """
+    return obj.updated_at or EPOCH
+
+
+def make_etag(*parts):
+    """
+    Returns: a strong ETag for a representation built from parts
+    """
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def set_validators(response, etag, last_modified=None):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def check_preconditions(etag, last_modified=None):
+    """
+    Raises NotModified if the client already has the current representation.
+    If-None-Match takes precedence over If-Modified-Since, and is compared weakly, as in
+    RFC 7232 - proxies that compress responses may hand the ETag back as W/"..."
+    """
+    if request.if_none_match:
+        if request.if_none_match.contains_weak(etag):
+            raise NotModified(etag, last_modified)
+    elif last_modified is not None and request.if_modified_since is not None:
+        # HTTP dates have a resolution of one second
+        if last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None):
+            raise NotModified(etag, last_modified)
+
+
+def resource_validators(obj):
+    """
+    Returns: a tuple (ETag, Last-Modified date) for a single resource
+    """
+    return make_etag(obj.__tablename__, obj.id, version(obj).isoformat()), version(obj)
+
+
+def page_etag(resources):
+    """
+    Returns: the ETag of a page of a collection, from the rows on the page, the total,
+    and whether there are pages before and after it
+    """
+    return make_etag([(obj.id, version(obj).isoformat()) for obj in resources.items],
+                     resources.total, resources.has_next, resources.has_prev)
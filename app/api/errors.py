@@ -1,5 +1,7 @@
 from flask import jsonify
 from werkzeug.http import HTTP_STATUS_CODES
+from app.api import bp
+from app.models import InvalidFields
 
 
 def error_response(status_code, message=None):
@@ -13,3 +15,8 @@ def error_response(status_code, message=None):
 
 def bad_request(message):
     return error_response(400, message)
+
+
+@bp.errorhandler(InvalidFields)
+def invalid_fields(error):
+    return bad_request('unknown fields: {}'.format(', '.join(error.args[0])))
@@ -0,0 +1,83 @@
+"""
+Streaming exports of the users, posts and follower relationships, for a full sync of an instance.
+
+Each export is a newline delimited JSON (NDJSON) response, one object per line in ascending
+order of its key, that is written while the rows are read from the database:
+- rows are read with yield_per, in batches of EXPORT_CHUNK_SIZE from a server-side cursor
+- every row is dropped from the session once it is written, so memory stays flat
+An interrupted export is resumed with ?after=<the key of the last line received>.
+"""
+
+import json
+from flask import Response, request, stream_with_context, current_app
+from app import db
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request
+from app.models import User, Post, followers
+
+
+def ndjson(rows, serialize):
+    """
+    Streams rows as NDJSON, dropping each one from the session once it is written
+    ------------------------------------------------------------------------------
+    Parameters:
+    rows - a query for the rows, in the order of the export
+    serialize - returns the dictionary written for a row
+    """
+    chunk_size = current_app.config['EXPORT_CHUNK_SIZE']
+
+    def generate():
+        for row in rows.yield_per(chunk_size).execution_options(stream_results=True):
+            yield json.dumps(serialize(row)) + '\n'
+            if isinstance(row, db.Model):
+                db.session.expunge(row)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@bp.route('/export/users', methods=['GET'])
+@token_auth.login_required
+def export_users():
+    """
+    Exports all users in order of id, after=<id> resumes after a user, fields= as for /users
+    """
+    after = request.args.get('after', 0, type=int)
+    fields = User.parse_fields(request.args.get('fields'))
+    query = User.query.options(*User.load_fields(fields)).filter(
+        User.id > after).order_by(User.id)
+    return ndjson(query, lambda user: user.to_dict(fields=fields))
+
+
+@bp.route('/export/posts', methods=['GET'])
+@token_auth.login_required
+def export_posts():
+    """
+    Exports all posts in order of id, after=<id> resumes after a post
+    """
+    after = request.args.get('after', 0, type=int)
+    query = Post.query.filter(Post.id > after).order_by(Post.id)
+    return ndjson(query, Post.to_dict)
+
+
+@bp.route('/export/followers', methods=['GET'])
+@token_auth.login_required
+def export_followers():
+    """
+    Exports all follower relationships in order of (follower_id, followed_id),
+    after=<follower_id>,<followed_id> resumes after a relationship
+    """
+    query = db.session.query(followers.c.follower_id, followers.c.followed_id)
+    after = request.args.get('after')
+    if after:
+        try:
+            follower_id, followed_id = (int(id) for id in after.split(','))
+        except ValueError:
+            return bad_request('after must be <follower_id>,<followed_id>')
+        query = query.filter(db.or_(
+            followers.c.follower_id > follower_id,
+            db.and_(followers.c.follower_id == follower_id,
+                    followers.c.followed_id > followed_id)))
+    query = query.order_by(followers.c.follower_id, followers.c.followed_id)
+    return ndjson(query, lambda row: {'follower_id': row.follower_id,
+                                      'followed_id': row.followed_id})
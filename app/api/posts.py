@@ -0,0 +1,130 @@
+from datetime import datetime
+from flask import jsonify, request, url_for, current_app
+from app import db
+from app.api import bp
+from app.models import User, Post
+from app.pagination import InvalidCursor
+from app.api.errors import bad_request
+from app.api.auth import token_auth
+
+
+def post_collection(query, endpoint, **kwargs):
+    """
+    Paginates a collection of posts in order of id - by cursor, or by page number if a page
+    is requested
+    """
+    per_page = min(request.args.get('per_page', 10, type=int), 100)
+    fields = Post.parse_fields(request.args.get('fields'))
+    if 'page' in request.args or not current_app.config['CURSOR_PAGINATION']:
+        page = request.args.get('page', 1, type=int)
+        data = Post.to_collection_dict(query.order_by(Post.id), page, per_page, endpoint,
+                                       fields=fields, **kwargs)
+    else:
+        data = Post.to_cursor_collection_dict(
+            query, [Post.id], request.args.get('cursor'), per_page, endpoint,
+            count=request.args.get('count', 0, type=int) == 1, fields=fields, **kwargs)
+    return jsonify(data)
+
+
+def validate_post(data):
+    """
+    Returns: the reason the data of a new post is invalid, or None if it is valid
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('body'), str) or \
+            not data['body'].strip():
+        return 'must include a body'
+    if len(data['body']) > 140:
+        return 'the body must be at most 140 characters'
+    if data.get('language') is not None and (not isinstance(data['language'], str) or
+                                             len(data['language']) > 5):
+        return 'the language must be a language code'
+    if data.get('timestamp') is not None:
+        try:
+            datetime.fromisoformat(data['timestamp'].rstrip('Z'))
+        except (AttributeError, ValueError):
+            return 'the timestamp must be in ISO 8601 format'
+    return None
+
+
+@bp.route('/posts/<int:id>', methods=['GET'])
+@token_auth.login_required
+def get_post(id):
+    fields = Post.parse_fields(request.args.get('fields'))
+    return jsonify(Post.query.get_or_404(id).to_dict(fields=fields))
+
+
+@bp.route('/posts', methods=['GET'])
+@token_auth.login_required
+def get_posts():
+    try:
+        return post_collection(Post.query, 'api.get_posts')
+    except InvalidCursor:
+        return bad_request('invalid cursor')
+
+
+@bp.route('/users/<int:id>/posts', methods=['GET'])
+@token_auth.login_required
+def get_user_posts(id):
+    user = User.query.get_or_404(id)
+    try:
+        return post_collection(user.posts, 'api.get_user_posts', id=id)
+    except InvalidCursor:
+        return bad_request('invalid cursor')
+
+
+@bp.route('/posts', methods=['POST'])
+@token_auth.login_required
+def create_post():
+    data = request.get_json() or {}
+    error = validate_post(data)
+    if error:
+        return bad_request(error)
+    post = Post(author=token_auth.current_user())
+    post.from_dict(data)
+    db.session.add(post)
+    db.session.commit()
+    response = jsonify(post.to_dict())
+    response.status_code = 201
+    response.headers['Location'] = url_for('api.get_post', id=post.id)
+    return response
+
+
+@bp.route('/posts/batch', methods=['POST'])
+@token_auth.login_required
+def create_posts():
+    """
+    Creates up to POSTS_BATCH_SIZE posts by the current user in one transaction, e.g. to
+    migrate posts from elsewhere. The body is {"posts": [{"body": ..., "language": ...,
+    "timestamp": ...}, ...]}, where language is detected and timestamp defaults to now.
+    Invalid posts are reported in the results without failing the others, the results
+    are in the order of the posts
+    """
+    data = request.get_json() or {}
+    items = data.get('posts') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return bad_request('must include a list of posts')
+    if len(items) > current_app.config['POSTS_BATCH_SIZE']:
+        return bad_request('at most {} posts can be created at once'.format(
+            current_app.config['POSTS_BATCH_SIZE']))
+    author = token_auth.current_user()
+    results, posts = [], []
+    for item in items:
+        error = validate_post(item)
+        if error:
+            results.append({'status': 400, 'message': error})
+            continue
+        post = Post(author=author)
+        post.from_dict(item)
+        results.append(post)
+        posts.append(post)
+    # one flush for the batch: the counters, timelines and change log are updated with
+    # a few statements, and the search index gets the posts in one bulk request on commit
+    db.session.add_all(posts)
+    db.session.commit()
+    results = [{'status': 201, 'id': result.id,
+                '_links': {'self': url_for('api.get_post', id=result.id)}}
+               if isinstance(result, Post) else result for result in results]
+    response = jsonify({'items': results, '_meta': {'created': len(posts),
+                                                    'failed': len(results) - len(posts)}})
+    response.status_code = 201 if posts else 400
+    return response
@@ -1,45 +1,109 @@
-from flask import jsonify, request, url_for, abort
+from flask import jsonify, request, url_for, abort, current_app
 from app import db
 from app.api import bp
 from app.models import User
-from app.api.errors import bad_request
+from app.pagination import InvalidCursor
+from app.api.errors import bad_request, error_response
 from app.api.auth import token_auth
+from app.api.conditional import check_preconditions, set_validators, resource_validators, \
+    page_etag, make_etag, version
 
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
 def get_user(id):
-    return jsonify(User.query.get_or_404(id).to_dict())
+    fields = User.parse_fields(request.args.get('fields'))
+    user = User.query.options(*User.load_fields(fields)).get_or_404(id)
+    etag, last_modified = resource_validators(user)
+    check_preconditions(etag, last_modified)
+    return set_validators(jsonify(user.to_dict(fields=fields)), etag, last_modified)
+
+
+def user_collection(query, endpoint, **kwargs):
+    """
+    Paginates a collection of users - by cursor, or by page number if a page is requested
+    Returns: the response, with an ETag for the page, or 304 if the client has the page already
+    """
+    per_page = min(request.args.get('per_page', 10, type=int), 100)
+    fields = User.parse_fields(request.args.get('fields'))
+    query = query.options(*User.load_fields(fields))
+    etags = []
+
+    def precondition(resources):
+        etags.append(page_etag(resources))
+        check_preconditions(etags[0])
+
+    if 'page' in request.args or not current_app.config['CURSOR_PAGINATION']:
+        page = request.args.get('page', 1, type=int)
+        data = User.to_collection_dict(query, page, per_page, endpoint,
+                                       precondition=precondition, fields=fields, **kwargs)
+    else:
+        data = User.to_cursor_collection_dict(
+            query, [User.id], request.args.get('cursor'), per_page, endpoint,
+            count=request.args.get('count', 0, type=int) == 1, precondition=precondition,
+            fields=fields, **kwargs)
+    return set_validators(jsonify(data), etags[0])
+
+
+def user_batch(ids):
+    """
+    Looks up a list of users by id in one query, for GET /api/users?ids=1,2,3
+    Returns: the response, with the users in the order of the ids - ids that do not exist
+    are listed in _meta.missing
+    """
+    try:
+        ids = list(dict.fromkeys(int(id) for id in ids.split(',') if id.strip()))
+    except ValueError:
+        return bad_request('ids must be a comma separated list of user ids')
+    if not ids or len(ids) > 100:
+        return bad_request('between 1 and 100 ids can be requested at once')
+    fields = User.parse_fields(request.args.get('fields'))
+    users = {user.id: user for user in User.query.options(
+        *User.load_fields(fields)).filter(User.id.in_(ids))}
+    items = [users[id] for id in ids if id in users]
+    etag = make_etag([(user.id, version(user).isoformat()) for user in items])
+    check_preconditions(etag)
+    data = {
+        'items': [user.to_dict(fields=fields) for user in items],
+        '_meta': {
+            'missing': [id for id in ids if id not in users]
+        },
+        '_links': {
+            'self': url_for('api.get_users', ids=','.join(str(id) for id in ids),
+                            fields=request.args.get('fields'))
+        }
+    }
+    return set_validators(jsonify(data), etag)
 
 
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
 def get_users():
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(User.query, page, per_page, 'api.get_users')
-    return jsonify(data)
+    if 'ids' in request.args:
+        return user_batch(request.args['ids'])
+    try:
+        return user_collection(User.query, 'api.get_users')
+    except InvalidCursor:
+        return bad_request('invalid cursor')
 
 
 @bp.route('/users/<int:id>/followers', methods=['GET'])
 @token_auth.login_required
 def get_followers(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get(page, 10, type=int), 100)
-    data = User.to_collection_dict(user.followers, page, per_page,
-                                        'api.get_followers', id=id)
-    return jsonify(data)
+    try:
+        return user_collection(user.followers, 'api.get_followers', id=id)
+    except InvalidCursor:
+        return bad_request('invalid cursor')
 
 
 @bp.route('/users/<int:id>/followed', methods=['GET'])
 @token_auth.login_required
 def get_followed(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get(page, 10, type=int), 100)
-    data = User.to_collection_dict(user.followed, page, per_page,
-                                        'api.get_followed', id=id)
-    return jsonify(data)
+    try:
+        return user_collection(user.followed, 'api.get_followed', id=id)
+    except InvalidCursor:
+        return bad_request('invalid cursor')
 
 
 @bp.route('/users', methods=['POST'])
@@ -79,4 +143,42 @@ def update_users(id):
         return bad_request('please use a different email address')
     user.from_dict(data, new_user=False)
     db.session.commit()
-    return jsonify(user.to_dict())
+    return set_validators(jsonify(user.to_dict()), *resource_validators(user))
+
+
+def follow_ids(data):
+    """
+    Returns: the list of user ids in the ids field of a request, or None if it is not valid
+    """
+    ids = data.get('ids') if isinstance(data, dict) else None
+    if not isinstance(ids, list) or len(ids) > current_app.config['FOLLOW_BATCH_SIZE'] or \
+            not all(isinstance(id, int) and not isinstance(id, bool) for id in ids):
+        return None
+    return ids
+
+
+@bp.route('/users/<int:id>/followed', methods=['POST', 'PUT', 'DELETE'])
+@token_auth.login_required
+def update_followed(id):
+    """
+    Changes the users followed by the current user, the body is {"ids": [user ids]}
+    POST follows the users, DELETE unfollows them and PUT makes them the users followed.
+    Ids that are already in the wanted state or do not exist are skipped
+    """
+    user = token_auth.current_user()
+    if user.id != id:
+        return error_response(403)
+    ids = follow_ids(request.get_json())
+    if ids is None:
+        return bad_request('must include a list of at most {} user ids'.format(
+            current_app.config['FOLLOW_BATCH_SIZE']))
+    followed, unfollowed = [], []
+    if request.method == 'POST':
+        followed = user.follow_many(ids)
+    elif request.method == 'DELETE':
+        unfollowed = user.unfollow_many(ids)
+    else:
+        followed, unfollowed = user.set_followed(ids)
+    db.session.commit()
+    return jsonify({'followed': followed, 'unfollowed': unfollowed,
+                    'followed_count': user.followed_count})
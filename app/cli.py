@@ -7,12 +7,19 @@ pybabel init -i messages.pot -d app/translations -l es
 pybabel update -i messages.pot -d app/translations
 pybabel compile -d app/translations
 
+Maintenance commands for the precomputed home timelines, the denormalized
+user counters, the search index, the change log and the profiler are also defined here.
+
 
 Flask uses Click to create command line interfaces
 https://click.palletsprojects.com/en/5.x/
 """
 
+import json
 import os
+import time
+from collections import Counter
+from datetime import datetime
 import click
 
 
@@ -65,3 +72,198 @@ def register(app):
             'pybabel init -i messages.pot -d app/translations -l ' + lang):
             raise RuntimeError('init command faied')
         os.remove('messages.pot')
+
+
+    @app.cli.group()
+    def timeline():
+        """
+        Home timeline commands
+        """
+        pass
+
+
+    @timeline.command()
+    def rebuild():
+        """
+        Rebuild the precomputed timelines of all users
+        """
+        from app import db
+        from app.models import User, TimelineEntry
+        for user in User.query:
+            TimelineEntry.rebuild(user)
+        db.session.commit()
+
+
+    @timeline.command()
+    def trim():
+        """
+        Drop the entries beyond TIMELINE_LENGTH from the precomputed timelines
+        """
+        from app import db
+        from app.models import TimelineEntry
+        trimmed = TimelineEntry.trim()
+        db.session.commit()
+        click.echo('Dropped {} timeline entries'.format(trimmed))
+
+
+    @app.cli.group()
+    def counters():
+        """
+        Denormalized counter commands
+        """
+        pass
+
+
+    @counters.command()
+    def repair():
+        """
+        Recompute the post, follower, followed and unread message counts of all users
+        """
+        from app import db
+        from app.models import User
+        repaired = User.repair_counters()
+        db.session.commit()
+        click.echo('Repaired the counters of {} users'.format(repaired))
+
+
+    @app.cli.group()
+    def search():
+        """
+        Search index commands
+        """
+        pass
+
+
+    @search.command()
+    @click.option('--batch-size', type=int, default=None,
+                  help='Outbox records sent per bulk request.')
+    @click.option('--interval', type=float, default=1.0,
+                  help='Seconds to wait when the outbox is empty.')
+    def worker(batch_size, interval):
+        """
+        Send changes recorded in the search outbox to the index
+        """
+        from app.models import SearchOutbox
+        last_report = 0
+        while True:
+            processed = SearchOutbox.drain(batch_size)
+            if time.time() - last_report > 60:
+                pending, age = SearchOutbox.lag()
+                click.echo('Search outbox: {} pending, oldest {:.1f}s'.format(pending, age))
+                last_report = time.time()
+            if not processed:
+                time.sleep(interval)
+
+
+    @search.command()
+    @click.argument('index', default='post')
+    @click.option('--workers', type=int, default=4,
+                  help='Worker processes, 0 indexes in this process.')
+    @click.option('--chunk-size', type=int, default=None,
+                  help='Rows sent per bulk request.')
+    @click.option('--since', default=None,
+                  help='Only reindex rows with a newer timestamp (ISO format), in place.')
+    @click.option('--restart', is_flag=True,
+                  help='Ignore the checkpoints of an interrupted run.')
+    @click.option('--keep-old', is_flag=True,
+                  help='Keep the index that was replaced.')
+    def reindex(index, workers, chunk_size, since, restart, keep_old):
+        """
+        Rebuild a search index into a new index and swap it in
+        """
+        from app import reindex as rebuild
+        if since:
+            count = rebuild.reindex_since(index, datetime.fromisoformat(since), chunk_size)
+            click.echo('Reindexed {} rows changed since {}'.format(count, since))
+            return
+        rebuild.reindex(index, workers=workers, chunk_size=chunk_size, restart=restart,
+                        keep_old=keep_old, log=click.echo)
+
+
+    @search.command()
+    def status():
+        """
+        Show the search outbox queue lag
+        """
+        from app.models import SearchOutbox
+        pending, age = SearchOutbox.lag()
+        click.echo('{} changes pending, oldest is {:.1f} seconds old'.format(pending, age))
+
+
+    @app.cli.group()
+    def changes():
+        """
+        Change log commands
+        """
+        pass
+
+
+    @changes.command()
+    def prune():
+        """
+        Delete the changes older than CHANGES_RETENTION_DAYS
+        """
+        from app import db
+        from app.models import ChangeLog
+        deleted = ChangeLog.prune()
+        db.session.commit()
+        click.echo('Deleted {} changes'.format(deleted))
+
+
+    @app.cli.group()
+    def profile():
+        """
+        Sampling profiler commands
+        """
+        pass
+
+
+    @profile.command()
+    @click.option('--rate', type=float, default=0.1,
+                  help='Share of the requests that are profiled, from 0 to 1.')
+    @click.option('--endpoint', default=None,
+                  help='Only profile this endpoint, e.g. main.index.')
+    @click.option('--duration', type=int, default=300,
+                  help='Seconds after which profiling stops.')
+    def start(rate, endpoint, duration):
+        """
+        Start profiling the running app, replacing the previous profile
+        """
+        from flask import current_app
+        from app import profiler
+        profiler.clear(current_app.config['PROFILE_DIR'])
+        profiler.set_control(current_app.config['PROFILE_DIR'], rate, endpoint, duration)
+        click.echo('Profiling {:.0%} of the requests to {} for {} seconds'.format(
+            rate, endpoint or 'all endpoints', duration))
+
+
+    @profile.command()
+    def stop():
+        """
+        Stop profiling the running app
+        """
+        from flask import current_app
+        from app import profiler
+        profiler.set_control(current_app.config['PROFILE_DIR'], 0)
+        click.echo('Profiling stopped')
+
+
+    @profile.command()
+    @click.argument('endpoint', required=False)
+    @click.option('--format', 'output_format', type=click.Choice(['collapsed', 'speedscope']),
+                  default='collapsed', help='collapsed stacks or a speedscope profile.')
+    @click.option('--output', type=click.File('w'), default='-', help='File to write to.')
+    def report(endpoint, output_format, output):
+        """
+        Write the profile of an endpoint, or of all endpoints
+        """
+        from flask import current_app
+        from app import profiler
+        profiles = profiler.collect(current_app.config['PROFILE_DIR'])
+        if endpoint:
+            profiles = {endpoint: profiles.get(endpoint, Counter())}
+        if output_format == 'speedscope':
+            output.write(json.dumps(profiler.speedscope(profiles)))
+        else:
+            for counts in profiles.values():
+                output.write(profiler.collapsed(counts))
@@ -22,6 +22,7 @@ from threading import Thread
 from flask_mail import Message
 from app import mail
 from flask import current_app
+from app.metrics import timed
 
 
 
@@ -35,7 +36,8 @@ def send_async_email(app, msg):
     msg - the Message object to be sent
     """
     with app.app_context():
-        mail.send(msg)
+        with timed('smtp'):
+            mail.send(msg)
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
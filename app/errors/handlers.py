@@ -1,4 +1,4 @@
-from flask import render_template, request
+from flask import render_template, request, current_app
 from app import db
 from app.errors import bp
 from app.api.errors import error_response as api_error_response
@@ -28,6 +28,17 @@ def not_found_error(error):
         return api_error_response(404)
     return render_template('errors/404.html'), 404
 
+@bp.app_errorhandler(429)
+def too_many_requests_error(error):
+    # API clients always get JSON, as they do not send an Accept header for HTML
+    if request.blueprint == 'api' or wants_json_response():
+        response = api_error_response(429, 'rate limit exceeded, retry after {} seconds'.format(
+            error.retry_after))
+    else:
+        response = current_app.make_response((render_template('errors/429.html'), 429))
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
 @bp.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback()
@@ -0,0 +1,68 @@
+"""
+Caches the users looked up to authenticate requests.
+
+Browser sessions load the user by id (load_user) and API requests look the user up by
+token (User.check_token). Both go through an IdentityCache, which keeps a snapshot of the
+user's columns for IDENTITY_CACHE_TTL seconds, so a warm request authenticates without
+a database query. A snapshot is merged into the session of the request without a SELECT.
+
+Entries are dropped when a commit changes or deletes the user. The cache is kept per process,
+so other processes can use a stale entry for up to the ttl - a revoked token included.
+"""
+
+import threading
+from collections import OrderedDict
+from time import time
+
+
+class IdentityCache(object):
+    """
+    A bounded cache of user snapshots by id, and of user ids by token.
+    Entries are dropped when they are older than ttl seconds or when there are more than
+    max_entries (least recently used first).
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Returns: the cached value, or None if the key is not cached
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time() - self.ttl:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """
+        Drops the snapshot of a user, the tokens of the user are checked against the new one
+        """
+        with self.lock:
+            self.entries.pop(('user', user_id), None)
+
+    def stats(self):
+        """
+        Returns: a dictionary of cache statistics
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
@@ -0,0 +1,100 @@
+"""
+Measures the database and template time of each request.
+
+Enabled with REQUEST_INSTRUMENTATION, otherwise no hooks are installed at all. For every request:
+- the number of SQL statements, the total time spent in them and the slowest statement
+- the time spent rendering templates
+- the total time of the request
+are sent back in a Server-Timing header, which the browser developer tools display, and
+requests slower than SLOW_REQUEST_MS or running more than SLOW_REQUEST_QUERIES statements
+are logged with their slowest statement.
+"""
+
+from time import perf_counter
+from flask import g, request, has_app_context, before_render_template, template_rendered
+from app import db
+
+
+class RequestStats(object):
+    """
+    The measurements of a request, kept in g.request_stats
+    """
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.slowest = (0.0, None)          # (duration, statement)
+        self.template_time = 0.0
+        self.template_start = None
+
+    def server_timing(self, total):
+        """
+        Returns: the value of the Server-Timing header, durations are in milliseconds
+        """
+        return 'db;dur={:.1f};desc="{} queries", tpl;dur={:.1f}, total;dur={:.1f}'.format(
+            self.db_time * 1000, self.queries, self.template_time * 1000, total * 1000)
+
+
+def _stats():
+    return g.get('request_stats') if has_app_context() else None
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = perf_counter() - conn.info['query_start'].pop()
+    stats = _stats()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += elapsed
+        if elapsed > stats.slowest[0]:
+            stats.slowest = (elapsed, statement)
+
+
+def before_template(sender, template, context, **extra):
+    stats = _stats()
+    if stats is not None:
+        stats.template_start = perf_counter()
+
+
+def after_template(sender, template, context, **extra):
+    stats = _stats()
+    if stats is not None and stats.template_start is not None:
+        stats.template_time += perf_counter() - stats.template_start
+        stats.template_start = None
+
+
+def init_app(app):
+    """
+    Installs the engine, template and request hooks, if REQUEST_INSTRUMENTATION is set
+    """
+    if not app.config['REQUEST_INSTRUMENTATION']:
+        return
+    engine = db.get_engine(app)
+    db.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    db.event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    before_render_template.connect(before_template, app)
+    template_rendered.connect(after_template, app)
+
+    @app.before_request
+    def start_request():
+        g.request_stats = RequestStats()
+
+    @app.after_request
+    def finish_request(response):
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return response
+        total = perf_counter() - stats.start
+        response.headers['Server-Timing'] = stats.server_timing(total)
+        if total * 1000 > app.config['SLOW_REQUEST_MS'] or \
+                stats.queries > app.config['SLOW_REQUEST_QUERIES']:
+            app.logger.warning(
+                'Slow request %s %s: %.1fms, %d queries in %.1fms, templates %.1fms, '
+                'slowest query %.1fms: %s', request.method, request.path, total * 1000,
+                stats.queries, stats.db_time * 1000, stats.template_time * 1000,
+                stats.slowest[0] * 1000, stats.slowest[1])
+        return response
@@ -0,0 +1,593 @@
+"""
+Provides an embedded full-text search backend, used when ElasticSearch is not configured.
+
+Each index is a directory of immutable segment files plus a MANIFEST listing the live
+segments, oldest first. A segment holds an inverted index (term -> postings) for a batch
+of documents, and the ids of documents it deletes. Every bulk write creates a new segment,
+so a document in a newer segment, or deleted by one, shadows its copies in older segments.
+Small segments are merged into larger ones by a background thread (tiered merging).
+
+Segments are memory-mapped for reads and results are ranked with BM25.
+
+Several worker processes can share an index directory: writers serialize on an exclusive
+lock file, the manifest is replaced atomically, and readers reload it when it changes.
+Locking uses fcntl, on platforms without it only threads of one process are serialized.
+
+Segment file layout (little endian):
+header   - magic, version, document count, delete count, term count, total document length,
+           and the offsets of the sections below
+docs     - (document id int64, document length uint32) sorted by id
+deletes  - document ids int64, sorted
+terms    - (string offset uint64, string length uint32, postings offset uint64, df uint32)
+           sorted by term
+strings  - the utf-8 encoded terms
+postings - (document number uint32, term frequency uint32) for each term
+"""
+
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+import struct
+import threading
+from collections import Counter
+
+try:
+    import fcntl
+except ImportError:         # pragma: no cover - Windows
+    fcntl = None
+
+
+MAGIC = b'MBSG'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIIQQQQQQ')
+DOC = struct.Struct('<qI')
+DELETE = struct.Struct('<q')
+TERM = struct.Struct('<QIQI')
+POSTING = struct.Struct('<II')
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    """
+    Splits text into lower case terms
+    """
+    return TOKEN_RE.findall(text.lower()) if text else []
+
+
+def _contains(mm, offset, record, count, doc_id):
+    """
+    Binary searches a section of count records that start with a document id, sorted by it
+    """
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        found = record.unpack_from(mm, offset + record.size * mid)[0]
+        if found < doc_id:
+            lo = mid + 1
+        elif found > doc_id:
+            hi = mid
+        else:
+            return True
+    return False
+
+
+def write_segment(path, docs, deletes, postings):
+    """
+    Writes a segment file
+    ---------------------
+    Parameters:
+    path - the file to write, it is written to a temporary file first and renamed
+    docs - a list of (document id, document length) sorted by id
+    deletes - a sorted list of deleted document ids
+    postings - a dictionary of term -> list of (document number, term frequency),
+               where the document number is the position of the document in docs
+    """
+    terms = sorted(postings)
+    encoded = [t.encode('utf-8') for t in terms]
+    docs_off = HEADER.size
+    deletes_off = docs_off + DOC.size * len(docs)
+    terms_off = deletes_off + DELETE.size * len(deletes)
+    strings_off = terms_off + TERM.size * len(terms)
+    postings_off = strings_off + sum(len(e) for e in encoded)
+    total_length = sum(length for _, length in docs)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(docs), len(deletes), len(terms), total_length,
+                            docs_off, deletes_off, terms_off, strings_off, postings_off))
+        f.write(b''.join(DOC.pack(doc_id, length) for doc_id, length in docs))
+        f.write(b''.join(DELETE.pack(doc_id) for doc_id in deletes))
+        string_pos = 0
+        posting_pos = 0
+        for term, e in zip(terms, encoded):
+            f.write(TERM.pack(string_pos, len(e), posting_pos, len(postings[term])))
+            string_pos += len(e)
+            posting_pos += POSTING.size * len(postings[term])
+        f.write(b''.join(encoded))
+        for term in terms:
+            f.write(b''.join(POSTING.pack(n, tf) for n, tf in postings[term]))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Segment(object):
+    """
+    A read-only, memory-mapped segment file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.n_docs, self.n_deletes, self.n_terms, self.total_length,
+         self.docs_off, self.deletes_off, self.terms_off, self.strings_off,
+         self.postings_off) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a search segment'.format(path))
+
+    @property
+    def size(self):
+        return self.n_docs + self.n_deletes
+
+    def doc(self, n):
+        """
+        Returns: a tuple (document id, document length) of the nth document
+        """
+        return DOC.unpack_from(self.mm, self.docs_off + DOC.size * n)
+
+    def docs(self):
+        return DOC.iter_unpack(self.mm[self.docs_off:self.deletes_off])
+
+    def deletes(self):
+        return [d for d, in DELETE.iter_unpack(self.mm[self.deletes_off:self.terms_off])]
+
+    def shadows(self, doc_id):
+        """
+        Binary searches the docs and deletes sections, without reading the whole segment
+        Returns: True if this segment adds or deletes the document, which shadows its copies
+        in older segments
+        """
+        return _contains(self.mm, self.docs_off, DOC, self.n_docs, doc_id) or \
+            _contains(self.mm, self.deletes_off, DELETE, self.n_deletes, doc_id)
+
+    def _term(self, n):
+        string_off, string_len, postings_off, df = TERM.unpack_from(
+            self.mm, self.terms_off + TERM.size * n)
+        start = self.strings_off + string_off
+        return self.mm[start:start + string_len], postings_off, df
+
+    def terms(self):
+        """
+        Yields (term, postings offset, df) for every term in sorted order
+        """
+        for n in range(self.n_terms):
+            term, postings_off, df = self._term(n)
+            yield term.decode('utf-8'), postings_off, df
+
+    def lookup(self, term):
+        """
+        Binary searches the term table
+        Returns: a tuple (postings offset, df), or None if the term is not in the segment
+        """
+        key = term.encode('utf-8')
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found, postings_off, df = self._term(mid)
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return postings_off, df
+        return None
+
+    def postings(self, postings_off, df):
+        """
+        Returns: an iterator of (document number, term frequency)
+        """
+        start = self.postings_off + postings_off
+        return POSTING.iter_unpack(self.mm[start:start + POSTING.size * df])
+
+
+class FileLock(object):
+    """
+    An exclusive lock on a file, shared between processes and threads
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.thread_lock = threading.Lock()
+        self.f = None
+
+    def acquire(self, blocking=True):
+        if not self.thread_lock.acquire(blocking):
+            return False
+        self.f = open(self.path, 'a+')
+        if fcntl:
+            try:
+                fcntl.flock(self.f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except OSError:
+                self.f.close()
+                self.thread_lock.release()
+                return False
+        return True
+
+    def release(self):
+        if fcntl:
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+        self.thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class LocalIndex(object):
+    """
+    One index directory, see the module docstring for the layout
+    """
+
+    def __init__(self, path, merge_factor=10):
+        self.path = path
+        self.merge_factor = merge_factor
+        self.manifest_path = os.path.join(path, 'MANIFEST')
+        self.write_lock = None
+        self.merge_lock = None
+        self.refresh_lock = threading.Lock()
+        self.manifest_stat = None
+        self.segments = []                  # oldest first
+        self.merging = False
+        self.merge_thread = None
+        self.closed = False
+
+    def _ensure_dir(self):
+        if self.write_lock is None:
+            os.makedirs(self.path, exist_ok=True)
+            self.write_lock = FileLock(os.path.join(self.path, 'LOCK'))
+            self.merge_lock = FileLock(os.path.join(self.path, 'MERGE_LOCK'))
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'next_segment': 1, 'segments': []}
+
+    def _write_manifest(self, manifest):
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.manifest_path)
+
+    def refresh(self):
+        """
+        Reloads the manifest if another thread or process has changed it
+        Returns: the live segments, oldest first
+        """
+        with self.refresh_lock:
+            while True:
+                try:
+                    stat = os.stat(self.manifest_path)
+                except FileNotFoundError:
+                    return []
+                key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+                if key == self.manifest_stat:
+                    return self.segments
+                manifest = self._read_manifest()
+                current = {s.path: s for s in self.segments}
+                try:
+                    segments = [current.get(os.path.join(self.path, name)) or
+                                Segment(os.path.join(self.path, name))
+                                for name in manifest['segments']]
+                except FileNotFoundError:
+                    continue        # merged away while reading, the manifest has changed
+                self.segments = segments
+                self.manifest_stat = key
+                return segments
+
+    def write(self, documents, deletes):
+        """
+        Writes a batch of changes as a new segment
+        ------------------------------------------
+        Parameters:
+        documents - a dictionary of document id -> text to add or replace
+        deletes - a set of document ids to remove
+        """
+        self._ensure_dir()
+        docs = []
+        postings = {}
+        for doc_id in sorted(documents):
+            terms = Counter(tokenize(documents[doc_id]))
+            n = len(docs)
+            docs.append((doc_id, sum(terms.values())))
+            for term, tf in terms.items():
+                postings.setdefault(term, []).append((n, tf))
+        with self.write_lock:
+            manifest = self._read_manifest()
+            name = 'seg_{:08d}.seg'.format(manifest['next_segment'])
+            write_segment(os.path.join(self.path, name), docs, sorted(deletes), postings)
+            manifest['next_segment'] += 1
+            manifest['segments'].append(name)
+            self._write_manifest(manifest)
+        self.refresh()
+        self._schedule_merge()
+
+    def search(self, query, limit, after=None):
+        """
+        Ranks the live documents matching any of the query terms with BM25
+        -------------------------------------------------------------------
+        Parameters:
+        query - the text to search for
+        limit - the number of results to return
+        after - only return results ranked below this (score, document id) pair
+        -------------------------------------------------------------------
+        Returns:
+        A tuple (list of the top limit (score, document id) pairs, number of matches)
+        """
+        terms = set(tokenize(query))
+        segments = self.refresh()
+        if not terms or not segments:
+            return [], 0
+        n_docs = sum(s.n_docs for s in segments) or 1
+        avg_length = sum(s.total_length for s in segments) / n_docs or 1.0
+        found = [[s.lookup(t) for t in terms] for s in segments]
+        df = [sum(f[i][1] for f in found if f[i]) for i in range(len(terms))]
+        idf = [math.log(1 + (n_docs - d + 0.5) / (d + 0.5)) for d in df]
+        scores = {}
+        newer = []
+        for segment, segment_found in zip(reversed(segments), reversed(found)):
+            # only the matching documents are checked against the newer segments
+            shadowed = {}
+            for i, term in enumerate(segment_found):
+                if term is None:
+                    continue
+                for n, tf in segment.postings(*term):
+                    doc_id, length = segment.doc(n)
+                    if doc_id not in shadowed:
+                        shadowed[doc_id] = any(s.shadows(doc_id) for s in newer)
+                    if shadowed[doc_id]:
+                        continue
+                    norm = K1 * (1 - B + B * length / avg_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + \
+                        idf[i] * tf * (K1 + 1) / (tf + norm)
+            newer.append(segment)
+        ranked = ((score, doc_id) for doc_id, score in scores.items())
+        if after is not None:
+            after = tuple(after)
+            ranked = (hit for hit in ranked if hit < after)
+        top = heapq.nlargest(limit, ranked)
+        return top, len(scores)
+
+    def _schedule_merge(self):
+        """
+        Starts a background merge thread if there are enough small segments to merge
+        """
+        if self.merging or not self._merge_candidate(self.segments):
+            return
+        self.merging = True
+        self.merge_thread = threading.Thread(target=self._merge_loop, daemon=True)
+        self.merge_thread.start()
+
+    def close(self):
+        """
+        Stops merging after the merge that is running, e.g. before the index is deleted
+        """
+        self.closed = True
+        thread = self.merge_thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _tier(self, segment):
+        return int(math.log(max(segment.size, 1), self.merge_factor))
+
+    def _merge_candidate(self, segments):
+        """
+        Returns: the newest run of at least merge_factor adjacent segments in the same size
+        tier, as (start position, end position), or None
+        """
+        end = len(segments)
+        while end > 0:
+            start = end - 1
+            tier = self._tier(segments[start])
+            while start > 0 and self._tier(segments[start - 1]) == tier:
+                start -= 1
+            if end - start >= self.merge_factor:
+                return start, end
+            end = start
+        return None
+
+    def _merge_loop(self):
+        try:
+            if not self.merge_lock.acquire(blocking=False):
+                return              # another process is merging this index
+            try:
+                while not self.closed and self.merge():
+                    pass
+            finally:
+                self.merge_lock.release()
+        finally:
+            self.merging = False
+
+    def merge(self):
+        """
+        Merges one run of segments into a single segment, the caller must hold the merge lock.
+        The merged segment is built without holding the write lock, writers can keep
+        adding segments after the run in the meantime.
+        Returns: True if a merge was done
+        """
+        self._ensure_dir()
+        segments = self.refresh()
+        candidate = self._merge_candidate(segments)
+        if candidate is None:
+            return False
+        start, end = candidate
+        run = segments[start:end]
+        # newest first, a document is taken from the newest segment that has it
+        newer = []
+        live = []
+        for segment in reversed(run):
+            for n, (doc_id, length) in enumerate(segment.docs()):
+                if not any(s.shadows(doc_id) for s in newer):
+                    live.append((doc_id, length, segment, n))
+            newer.append(segment)
+        live.sort(key=lambda d: d[0])
+        numbers = {(id(segment), n): i for i, (_, _, segment, n) in enumerate(live)}
+        postings = {}
+        for segment in run:
+            for term, postings_off, df in segment.terms():
+                for n, tf in segment.postings(postings_off, df):
+                    new = numbers.get((id(segment), n))
+                    if new is not None:
+                        postings.setdefault(term, []).append((new, tf))
+        # deletes only need to be kept while there are older segments to shadow
+        deletes = [] if start == 0 else sorted(set().union(*[s.deletes() for s in run]))
+        with self.write_lock:
+            manifest = self._read_manifest()
+            names = [os.path.basename(s.path) for s in run]
+            position = manifest['segments'].index(names[0])
+            name = 'seg_{:08d}.seg'.format(manifest['next_segment'])
+            write_segment(os.path.join(self.path, name),
+                          [(doc_id, length) for doc_id, length, _, _ in live], deletes, postings)
+            manifest['next_segment'] += 1
+            manifest['segments'][position:position + len(names)] = [name]
+            self._write_manifest(manifest)
+        for old in names:
+            # processes that still have the file mapped keep reading it until they refresh
+            os.remove(os.path.join(self.path, old))
+        self.refresh()
+        return True
+
+
+class LocalSearchBackend(object):
+    """
+    Search backend storing each index in a directory under SEARCH_INDEX_DIR.
+    An index name can also be an alias for another index, the aliases are kept in
+    the ALIASES file and swapped atomically - see swap_alias
+    """
+
+    def __init__(self, path, merge_factor=10):
+        self.path = path
+        self.merge_factor = merge_factor
+        self.indexes = {}
+        self.lock = threading.Lock()
+        self.aliases_path = os.path.join(path, 'ALIASES')
+        self.aliases_stat = None
+        self.aliases = {}
+
+    def close(self):
+        """
+        Stops the background merges of all indexes
+        """
+        with self.lock:
+            indexes = list(self.indexes.values())
+        for index in indexes:
+            index.close()
+
+    def _read_aliases(self):
+        try:
+            with open(self.aliases_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def resolve(self, index):
+        """
+        Returns: the name of the index an alias points to, or the name itself
+        """
+        with self.lock:
+            try:
+                stat = os.stat(self.aliases_path)
+                key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+            except FileNotFoundError:
+                key = None
+            if key != self.aliases_stat:
+                self.aliases = self._read_aliases()
+                self.aliases_stat = key
+            return self.aliases.get(index, index)
+
+    def get_index(self, index):
+        index = self.resolve(index)
+        with self.lock:
+            if index not in self.indexes:
+                self.indexes[index] = LocalIndex(os.path.join(self.path, index),
+                                                 self.merge_factor)
+            return self.indexes[index]
+
+    def create_index(self, index):
+        os.makedirs(os.path.join(self.path, index), exist_ok=True)
+
+    def swap_alias(self, alias, index):
+        """
+        Points an alias at an index, replacing an index that has the alias' name
+        Returns: the names of the indexes the alias pointed to before
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with FileLock(os.path.join(self.path, 'ALIASES.lock')):
+            aliases = self._read_aliases()
+            old = aliases.get(alias)
+            if old is None and os.path.isdir(os.path.join(self.path, alias)):
+                old = alias
+            aliases[alias] = index
+            tmp = self.aliases_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(aliases, f)
+            os.replace(tmp, self.aliases_path)
+        return [old] if old and old != index else []
+
+    def delete_index(self, index):
+        with self.lock:
+            deleted = self.indexes.pop(index, None)
+        if deleted is not None:
+            deleted.close()
+        shutil.rmtree(os.path.join(self.path, index), ignore_errors=True)
+
+    def bulk(self, operations):
+        """
+        Applies a batch of (operation, index, id, document) tuples, one new segment per index
+        Returns: the operations that failed, none as the index is local
+        """
+        batches = {}
+        for operation, index, doc_id, document in operations:
+            documents, deletes = batches.setdefault(index, ({}, set()))
+            if operation == 'index':
+                documents[doc_id] = ' '.join(str(v) for v in document.values() if v)
+                deletes.discard(doc_id)
+            else:
+                documents.pop(doc_id, None)
+                deletes.add(doc_id)
+        for index, (documents, deletes) in batches.items():
+            self.get_index(index).write(documents, deletes)
+        return []
+
+    def query(self, index, query, page, per_page):
+        top, total = self.get_index(index).search(query, page * per_page)
+        return [doc_id for _, doc_id in top[(page - 1) * per_page:]], total
+
+    def query_after(self, index, query, state, per_page):
+        """
+        Returns the page of results after the last (score, id) pair in state, so
+        reading a deep page costs the same as reading the first one
+        """
+        offset = state.get('offset', 0)
+        top, total = self.get_index(index).search(query, offset + per_page + 1,
+                                                  after=state.get('after'))
+        top = top[offset:]
+        hits = top[:per_page]
+        next_state = {'after': list(hits[-1])} if len(top) > per_page else None
+        return [doc_id for _, doc_id in hits], total, next_state
@@ -3,7 +3,8 @@ Handles the main view function logic for the blog.
 Additional view functions for authentication and error handling can be found in the auth/ and errors/ packages respectively.
 """
 
-from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app
+from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app, abort, \
+    Response
 from app import db
 from app.main import bp
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm, MessageForm
@@ -12,8 +13,49 @@ from app.models import User, Post, Message, Notification
 from werkzeug.urls import url_parse
 from datetime import datetime
 from flask_babel import get_locale, lazy_gettext as _l
-from guess_language import guess_language
 from app.translate import translate
+from app.pagination import paginate_keyset, InvalidCursor
+from app.search import search_cursor
+from app.notify import user_channel
+from app import profiler
+from collections import Counter
+from time import time
+import json
+
+# seconds between the keepalive comments sent on an idle notification stream
+HEARTBEAT = 15
+
+
+
+def paginate(query, columns, endpoint, **kwargs):
+    """
+    Paginates a listing - by cursor, or by page number if a page is requested.
+    ------------------------------------------------------------------------
+    Parameters:
+    query - the query for the listing
+    columns - the unique sort key of the listing, e.g. [Post.timestamp, Post.id]
+    endpoint - the endpoint of the listing, used to build the next and previous links
+    ------------------------------------------------------------------------
+    Returns: a tuple (list of objects, next page url, previous page url)
+    """
+    per_page = current_app.config['POSTS_PER_PAGE']
+    if 'page' in request.args or not current_app.config['CURSOR_PAGINATION']:
+        page = request.args.get('page', 1, type=int)
+        resources = query.paginate(page, per_page, False)
+        next_url = url_for(endpoint, page=resources.next_num, **kwargs) \
+            if resources.has_next else None
+        prev_url = url_for(endpoint, page=resources.prev_num, **kwargs) \
+            if resources.has_prev else None
+        return resources.items, next_url, prev_url
+    try:
+        resources = paginate_keyset(query, columns, request.args.get('cursor'), per_page)
+    except InvalidCursor:
+        abort(400)
+    next_url = url_for(endpoint, cursor=resources.next_cursor, **kwargs) \
+        if resources.has_next else None
+    prev_url = url_for(endpoint, cursor=resources.prev_cursor, **kwargs) \
+        if resources.has_prev else None
+    return resources.items, next_url, prev_url
 
 
 
@@ -31,21 +73,19 @@ def index():
 
     if form.validate_on_submit():
         # try to identify the language being used
-        language = guess_language(form.post.data)
-        if language == 'UNKNOWN' or len(language) > 5:
-            language = ''
-        post = Post(body=form.post.data, author=current_user, language=language)
+        post = Post(body=form.post.data, author=current_user,
+                    language=Post.detect_language(form.post.data))
         db.session.add(post)
         db.session.commit()
         flash(_l('Your post is now live!'))
         # Post/Redirect/Get pattern
         return redirect(url_for('main.index'))
 
-    page = request.args.get('page', 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    # posts.items is used to retrieve posts from the paginated object 
-    return render_template('index.html', title=_l('Home'), form=form, posts=posts.items)
+    posts, next_url, prev_url = paginate(
+        current_user.followed_posts().options(db.selectinload(Post.author)),
+        [Post.timestamp, Post.id], 'main.index')
+    return render_template('index.html', title=_l('Home'), form=form, posts=posts,
+                           next_url=next_url, prev_url=prev_url)
 
 
 
@@ -66,11 +106,12 @@ def user(username):
     #     {'author': user, 'body': 'Test post #1'},
     #     {'author': user, 'body': 'Test post #2'}
     # ]
-    page = request.args.get('page', 1, type=int)
-    posts = user.user_posts().paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
+    # every post has the same author, which the lazy loader finds in the session identity map
+    posts, next_url, prev_url = paginate(user.user_posts(), [Post.timestamp, Post.id],
+                                         'main.user', username=user.username)
     form = EmptyForm()
-    return render_template('user.html', user=user, posts=posts.items, form=form)
+    return render_template('user.html', user=user, posts=posts, form=form,
+                           next_url=next_url, prev_url=prev_url)
 
 
 
@@ -79,16 +120,31 @@ def before_request():
     """
     Flask before_request decorator registers a function to be called before all requests.
     Adds a last visited time for a user to their profile - this is translated to the appropriate language.
+    The time is buffered and written in batches unless LAST_SEEN_BUFFER is disabled, see activity.py
     Also renders the search box for searching posts.
     """
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        if current_app.last_seen is not None:
+            current_app.last_seen.record(current_user.id)
+        else:
+            current_user.last_seen = datetime.utcnow()
+            db.session.commit()
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
 
 
+@bp.after_app_request
+def after_request(response):
+    """
+    Writes the buffered last visited times once they are due
+    """
+    if current_app.last_seen is not None:
+        current_app.last_seen.flush_due()
+    return response
+
+
+
 @bp.route('/edit_profile', methods=['GET', 'POST'])
 @login_required
 def edit_profile():
@@ -197,10 +253,11 @@ def explore():
     Returns: a paginated list of posts by users
     If the user is not logged in, they are re-directed to the login page.
     """
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    return render_template('index.html', title=_l('Explore'), posts=posts.items)
+    posts, next_url, prev_url = paginate(
+        Post.query.options(db.selectinload(Post.author)).order_by(Post.timestamp.desc()),
+        [Post.timestamp, Post.id], 'main.explore')
+    return render_template('index.html', title=_l('Explore'), posts=posts,
+                           next_url=next_url, prev_url=prev_url)
 
 
 
@@ -229,14 +286,32 @@ def search():
     if not g.search_form.validate():
         return redirect(url_for('main.explore'))
     
+    q = g.search_form.q.data
+    per_page = current_app.config['POSTS_PER_PAGE']
+    cursor = request.args.get('cursor')
+    if cursor:
+        # deep pages are read with search_after, which can only move forward
+        try:
+            posts, total, next_cursor = Post.search_after(q, cursor, per_page)
+        except InvalidCursor:
+            abort(400)
+        next_url = url_for('main.search', q=q, cursor=next_cursor) if next_cursor else None
+        prev_url = None
+        return render_template('search.html', title=_l('Search'), posts=posts,
+                                next_url=next_url, prev_url=prev_url)
+
     page = request.args.get('page', 1, type=int)
-    posts, total = Post.search(g.search_form.q.data, page, 
-                            current_app.config['POSTS_PER_PAGE'])
+    posts, total = Post.search(q, page, per_page)
     
-    next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
-        if total > page * current_app.config['POSTS_PER_PAGE'] else None
+    # pages within the cached results are linked by number, later pages by cursor
+    cached = current_app.search_cache.depth if current_app.search_cache else per_page
+    next_url = None
+    if total > page * per_page:
+        next_url = url_for('main.search', q=q, page=page + 1) \
+            if (page + 1) * per_page <= cached else \
+            url_for('main.search', q=q, cursor=search_cursor(page * per_page))
     
-    prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
+    prev_url = url_for('main.search', q=q, page=page - 1) \
         if page > 1 else None
     
     return render_template('search.html', title=_l('Search'), posts=posts,
@@ -300,22 +375,13 @@ def messages():
     Returns: a pagenated list messages.
     If the user is not logged in, they are re-directed to the login page.
     """
-    current_user.last_message_read_time = datetime.utcnow()
-    current_user.add_notification('unread_message_count', 0)
+    current_user.read_messages()
     db.session.commit()
-    page = request.args.get('page', 1, type=int)
-    
-    messages = current_user.messages_received.order_by(
-        Message.timestamp.desc()).paginate(
-            page, current_app.config['POSTS_PER_PAGE'], False)
-    
-    next_url = url_for('main.messages', page=messages.next_num) \
-        if messages.has_next else None
-    
-    prev_url = url_for('main.messages', page=messages.prev_num) \
-        if messages.has_prev else None
-    
-    return render_template('messages.html', messages=messages.items,
+    messages, next_url, prev_url = paginate(
+        current_user.messages_received.options(db.selectinload(Message.author)).order_by(
+            Message.timestamp.desc()),
+        [Message.timestamp, Message.id], 'main.messages')
+    return render_template('messages.html', messages=messages,
                             next_url=next_url, prev_url=prev_url)
 
 
@@ -331,8 +397,93 @@ def notifications():
     since = request.args.get('since', 0.0, type=float)
     notifications = current_user.notifications.filter(
         Notification.timestamp > since).order_by(Notification.timestamp.asc())
-    return jsonify([{
-        'name': n.name,
-        'data': n.get_data(),
-        'timestamp': n.timestamp
-    } for n in notifications])
\ No newline at end of file
+    return jsonify([n.to_dict() for n in notifications])
+
+
+
+@bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+    """
+    Streams a user's notifications to the client as Server-Sent Events.
+    The notifications newer than the Last-Event-ID header (or the since argument) are sent first,
+    then the connection is held open and notifications are pushed as they are committed.
+    The stream ends after NOTIFICATION_STREAM_TIMEOUT seconds and the client reconnects.
+    Each open stream holds a worker thread, serve the app with a threaded or async worker.
+    ----------------------------------------------------------------------------------------
+    Returns: a 204 response when no broker is configured, the client then polls /notifications
+    """
+    notifier = current_app.notifier
+    if notifier is None:
+        return '', 204
+    try:
+        since = float(request.headers.get('Last-Event-ID') or request.args.get('since') or 0)
+    except ValueError:
+        since = 0.0
+    # subscribe before reading the database, so no notification falls in between
+    subscription = notifier.subscribe(user_channel(current_user.id))
+    try:
+        pending = [json.dumps(n.to_dict()) for n in current_user.notifications.filter(
+            Notification.timestamp > since).order_by(Notification.timestamp.asc())]
+    except Exception:
+        subscription.close()
+        raise
+    timeout = current_app.config['NOTIFICATION_STREAM_TIMEOUT']
+
+    def event(message):
+        return 'id: {}\ndata: {}\n\n'.format(json.loads(message)['timestamp'], message)
+
+    def stream():
+        # runs after the request has ended, so the database session is not held open
+        try:
+            yield 'retry: 1000\n\n'
+            for message in pending:
+                yield event(message)
+            deadline = time() + timeout
+            while time() < deadline:
+                message = subscription.get(min(HEARTBEAT, deadline - time()))
+                yield event(message) if message else ': keepalive\n\n'
+        finally:
+            subscription.close()
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+
+@bp.route('/admin/profile', methods=['GET', 'POST'])
+@login_required
+def admin_profile():
+    """
+    Controls the sampling profiler and downloads its results, for ADMINS only - see profiler.py
+    --------------------------------------------------------------------------------------------
+    POST a JSON object {"rate": 0.1, "endpoint": "main.index", "duration": 300} to start profiling,
+    or {"rate": 0} to stop.
+    GET returns the profiler status, or the profile with format=collapsed or format=speedscope
+    (and optionally endpoint=main.index)
+    """
+    if not current_user.is_admin():
+        abort(403)
+    path = current_app.config['PROFILE_DIR']
+    if request.method == 'POST':
+        data = request.get_json() or {}
+        try:
+            rate = float(data.get('rate', 0))
+            duration = int(data.get('duration', 300))
+        except (TypeError, ValueError):
+            abort(400)
+        if rate > 0:
+            profiler.clear(path)
+        return jsonify(profiler.set_control(path, rate, data.get('endpoint'), duration))
+    profiles = profiler.collect(path)
+    endpoint = request.args.get('endpoint')
+    if endpoint:
+        profiles = {endpoint: profiles.get(endpoint, Counter())}
+    output_format = request.args.get('format')
+    if output_format == 'speedscope':
+        return jsonify(profiler.speedscope(profiles))
+    if output_format == 'collapsed':
+        return Response(''.join(profiler.collapsed(counts) for counts in profiles.values()),
+                        mimetype='text/plain')
+    return jsonify({'control': profiler.get_control(path),
+                    'samples': {name: sum(counts.values()) for name, counts in profiles.items()}})
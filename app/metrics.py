@@ -0,0 +1,302 @@
+"""
+Collects operational metrics and exposes them at /metrics in the Prometheus text format.
+
+Enabled with METRICS. The metrics are:
+- http_requests_total - counter of requests by blueprint, endpoint, method and status code
+- http_request_duration_seconds - histogram of request latency by blueprint and endpoint
+- http_requests_in_flight - gauge of the requests being handled
+- db_queries_total - counter of SQL statements by blueprint and endpoint
+- external_call_duration_seconds - histogram of the latency of calls to other services
+  (elasticsearch, translator, smtp), see timed
+- cache_hits_total, cache_misses_total - counters of the lookups of the in-process caches
+  by cache, see watch_cache
+- cache_entries - gauge of the entries held by the in-process caches
+
+Each process keeps its own metrics in memory. When METRICS_DIR is set, every process also
+writes them to a file of its own in that directory, at most every METRICS_WRITE_INTERVAL
+seconds and when it exits, and /metrics adds up the files of all processes. The gauges of
+processes that are no longer running are left out.
+"""
+
+import atexit
+import glob
+import itertools
+import json
+import os
+import threading
+from contextlib import contextmanager
+from time import perf_counter, time
+from flask import g, request, current_app, has_app_context, Response
+from app import db
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    'http_requests_total': ('counter', 'Requests handled'),
+    'http_request_duration_seconds': ('histogram', 'Request latency'),
+    'http_requests_in_flight': ('gauge', 'Requests being handled'),
+    'db_queries_total': ('counter', 'SQL statements run by requests'),
+    'external_call_duration_seconds': ('histogram', 'Latency of calls to other services'),
+    'cache_hits_total': ('counter', 'Lookups answered by a cache'),
+    'cache_misses_total': ('counter', 'Lookups not answered by a cache'),
+    'cache_entries': ('gauge', 'Entries held by a cache')
+}
+
+
+class Metrics(object):
+    """
+    The counters, gauges and histograms of a process.
+    Each metric is stored by (name, labels), where labels is a tuple of (label, value) pairs.
+    """
+
+    def __init__(self, path=None, write_interval=1):
+        self.path = path
+        self.write_interval = write_interval
+        self.lock = threading.Lock()
+        self.caches = {}
+        self.reset()
+        if path:
+            os.makedirs(path, exist_ok=True)
+            atexit.register(self.close)
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}            # (name, labels) -> [bucket counts..., sum, count]
+        self.last_write = 0.0
+
+    def _check_fork(self):
+        # a forked worker starts with the metrics of its parent, which are not its own
+        if os.getpid() != self.pid:
+            self.reset()
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self._check_fork()
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def add(self, name, labels, amount):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self._check_fork()
+            self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self._check_fork()
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0, 0]
+            i = 0
+            while i < len(BUCKETS) and value > BUCKETS[i]:
+                i += 1
+            histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def watch_cache(self, name, cache):
+        """
+        Reports the stats() of a cache as cache_hits_total, cache_misses_total and
+        cache_entries, labelled with name, whenever the metrics are read
+        """
+        self.caches[name] = cache
+
+    def snapshot(self):
+        """
+        Returns: the metrics of the process as a dictionary that can be stored as JSON
+        """
+        stats = {name: cache.stats() for name, cache in self.caches.items()}
+        with self.lock:
+            self._check_fork()
+            for name, cache_stats in stats.items():
+                labels = (('cache', name),)
+                self.counters[('cache_hits_total', labels)] = cache_stats['hits']
+                self.counters[('cache_misses_total', labels)] = cache_stats['misses']
+                self.gauges[('cache_entries', labels)] = cache_stats['entries']
+            return {
+                'pid': self.pid,
+                'counters': [[name, labels, value] for (name, labels), value
+                             in self.counters.items()],
+                'gauges': [[name, labels, value] for (name, labels), value
+                           in self.gauges.items()],
+                'histograms': [[name, labels, values] for (name, labels), values
+                               in self.histograms.items()]
+            }
+
+    def write(self, force=False):
+        """
+        Writes the metrics of the process to its file, if METRICS_WRITE_INTERVAL has passed
+        """
+        if not self.path or (not force and time() - self.last_write < self.write_interval):
+            return
+        self.last_write = time()
+        filename = os.path.join(self.path, 'metrics-{}.json'.format(os.getpid()))
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, filename)
+
+    def close(self):
+        """
+        Writes the final metrics of the process, without the requests in flight
+        """
+        with self.lock:
+            self.gauges = {}
+        try:
+            self.write(force=True)
+        except OSError:
+            pass                        # the directory has gone, nothing is left to add up
+
+    def collect(self):
+        """
+        Returns: the snapshots of all processes - only this one if there is no METRICS_DIR
+        """
+        if not self.path:
+            return [self.snapshot()]
+        self.write(force=True)
+        snapshots = []
+        for filename in glob.glob(os.path.join(self.path, 'metrics-*.json')):
+            try:
+                with open(filename) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for label, value in labels) + '}'
+
+
+def _with_le(labels, le):
+    return [list(pair) for pair in labels] + [['le', le]]
+
+
+def render(snapshots):
+    """
+    Adds up the snapshots of several processes
+    Returns: the metrics in the Prometheus text exposition format
+    """
+    counters, gauges, histograms = {}, {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+        if _alive(snapshot['pid']):
+            for name, labels, value in snapshot['gauges']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                gauges[key] = gauges.get(key, 0) + value
+        for name, labels, values in snapshot['histograms']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            total = histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+
+    samples = {}
+    for (name, labels), value in itertools.chain(sorted(counters.items()),
+                                                 sorted(gauges.items())):
+        samples.setdefault(name, []).append('{}{} {}'.format(name, _labels(labels), value))
+    for (name, labels), values in sorted(histograms.items()):
+        lines = samples.setdefault(name, [])
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), values):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(name, _labels(_with_le(labels, bound)),
+                                                 cumulative))
+        lines.append('{}_sum{} {}'.format(name, _labels(labels), values[-2]))
+        lines.append('{}_count{} {}'.format(name, _labels(labels), values[-1]))
+
+    output = []
+    for name in sorted(samples):
+        kind, description = HELP.get(name, ('untyped', name))
+        output.append('# HELP {} {}'.format(name, description))
+        output.append('# TYPE {} {}'.format(name, kind))
+        output.extend(samples[name])
+    return '\n'.join(output) + '\n'
+
+
+@contextmanager
+def timed(service):
+    """
+    Records the latency of a call to another service in external_call_duration_seconds
+        with timed('elasticsearch'):
+            ...
+    """
+    metrics = current_app.metrics if has_app_context() else None
+    if metrics is None:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe('external_call_duration_seconds', {'service': service},
+                        perf_counter() - start)
+
+
+def _request_labels():
+    return {'blueprint': request.blueprint or '', 'endpoint': request.endpoint or ''}
+
+
+def init_app(app):
+    """
+    Installs the request and engine hooks and the /metrics endpoint, if METRICS is set
+    """
+    app.metrics = None
+    if not app.config['METRICS']:
+        return
+    metrics = app.metrics = Metrics(app.config['METRICS_DIR'],
+                                    app.config['METRICS_WRITE_INTERVAL'])
+
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        if has_app_context() and 'metrics_queries' in g:
+            g.metrics_queries += 1
+
+    db.event.listen(db.get_engine(app), 'after_cursor_execute', count_query)
+
+    @app.before_request
+    def start_request():
+        g.metrics_start = perf_counter()
+        g.metrics_queries = 0
+        metrics.add('http_requests_in_flight', {}, 1)
+
+    @app.after_request
+    def record_request(response):
+        if 'metrics_start' in g:
+            labels = _request_labels()
+            metrics.observe('http_request_duration_seconds', labels,
+                            perf_counter() - g.metrics_start)
+            metrics.inc('db_queries_total', labels, g.metrics_queries)
+            metrics.inc('http_requests_total', dict(labels, method=request.method,
+                                                    status=response.status_code))
+        return response
+
+    @app.teardown_request
+    def finish_request(exc=None):
+        if g.pop('metrics_start', None) is not None:
+            metrics.add('http_requests_in_flight', {}, -1)
+            metrics.write()
+
+    def metrics_view():
+        return Response(render(metrics.collect()),
+                        mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -5,39 +5,79 @@ Defines the database models for the blog
 from hashlib import md5
 from app import login, db
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from time import time
 from flask_login import UserMixin
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.expression import ClauseElement
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
 import jwt
-from flask import current_app, url_for
-from app.search import add_to_index, remove_from_index, query_index
+from guess_language import guess_language
+from flask import current_app, url_for, g, has_request_context
+from app.search import bulk_index, cached_query_index, query_index_after
+from app.pagination import paginate_keyset
+from app.notify import user_channel
 import json
 import base64
+import itertools
 import os
 
 # Create followers table - seconadary association table used in User class
+# The composite primary key serves lookups by follower, the index lookups by followed user
 followers = db.Table('followers', 
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True, index=True)
 )
 
 
+class InvalidFields(ValueError):
+    """
+    Raised when fields that a model does not have are requested from its to_dict
+    """
+    pass
+
+
+
 class PaginatedAPIMixin(object):
     """
     Generic Mixin class - allows models that inherit it to be represented as collections in api calls
+    Models list the fields of their to_dict in API_FIELDS
     """
+    @classmethod
+    def parse_fields(cls, fields):
+        """
+        Parses a comma separated list of fields, e.g. from the fields= argument of a request
+        Returns: the list of fields, or None for all of them
+        """
+        if not fields:
+            return None
+        fields = [field.strip() for field in fields.split(',') if field.strip()]
+        unknown = [field for field in fields if field not in cls.API_FIELDS]
+        if unknown:
+            raise InvalidFields(unknown)
+        return fields
+
     @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
+    def to_collection_dict(query, page, per_page, endpoint, precondition=None, fields=None,
+                           **kwargs):
         """
         Generates a dictionary represention of a paginated collection of db model type
         query: a Flask-SQLAlchemy query object
         page: the current page of the collection
         per_page: the number of objects contained in a page
         endpoint: the endpoint for the collection of resources
+        precondition: called with the page before its items are serialized, e.g. to raise
+                      NotModified - see api/conditional.py
+        fields: the fields of the items to include, or None for all of them
         """
         resources = query.paginate(page, per_page, False)
+        if precondition is not None:
+            precondition(resources)
+        if fields is not None:
+            kwargs['fields'] = ','.join(fields)       # keep the fields in the links
         data = {
-            'items': [item.to_dict() for item in resources.items],
+            'items': [item.to_dict(fields=fields) for item in resources.items],
             '_meta': {
                 'page': page,
                 'per_page': per_page,
@@ -55,6 +95,45 @@ class PaginatedAPIMixin(object):
         }
         return data
 
+    @staticmethod
+    def to_cursor_collection_dict(query, columns, cursor, per_page, endpoint,
+                                  count=False, precondition=None, fields=None, **kwargs):
+        """
+        Generates a dictionary represention of a collection using keyset pagination,
+        the total number of items is only counted when requested
+        query: a Flask-SQLAlchemy query object
+        columns: the unique sort key of the collection, e.g. [User.id]
+        cursor: the cursor of the current page, or None for the first page
+        per_page: the number of objects contained in a page
+        endpoint: the endpoint for the collection of resources
+        count: include the total number of items
+        precondition: called with the page before its items are serialized
+        fields: the fields of the items to include, or None for all of them
+        """
+        resources = paginate_keyset(query, columns, cursor, per_page,
+                                    descending=False, count=count)
+        if precondition is not None:
+            precondition(resources)
+        if fields is not None:
+            kwargs['fields'] = ','.join(fields)       # keep the fields in the links
+        data = {
+            'items': [item.to_dict(fields=fields) for item in resources.items],
+            '_meta': {
+                'per_page': per_page
+            },
+            '_links': {
+                'self': url_for(endpoint, cursor=cursor, per_page=per_page,
+                                **kwargs),
+                'next': url_for(endpoint, cursor=resources.next_cursor,
+                                per_page=per_page, **kwargs) if resources.has_next else None,
+                'previous': url_for(endpoint, cursor=resources.prev_cursor,
+                                per_page=per_page, **kwargs) if resources.has_prev else None
+            }
+        }
+        if count:
+            data['_meta']['total_items'] = resources.total
+        return data
+
 
 
 class User(PaginatedAPIMixin, UserMixin, db.Model):
@@ -73,6 +152,8 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
     token = db.Column(db.String(32), index=True, unique=True)
     token_expiration = db.Column(db.DateTime)
+    # set on every UPDATE of the row, including the counter updates - used for ETags in the API
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     # set up many-to-many follower-followed relationship
     followed = db.relationship(
@@ -92,6 +173,13 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
                                     backref='recipient', lazy='dynamic')
     
     last_message_read_time = db.Column(db.DateTime)
+
+    # denormalized counters, maintained by follow/unfollow, Post.before_flush and
+    # Message.before_flush, and repaired in bulk with 'flask counters repair'
+    post_count = db.Column(db.Integer, default=0, nullable=False)
+    follower_count = db.Column(db.Integer, default=0, nullable=False)
+    followed_count = db.Column(db.Integer, default=0, nullable=False)
+    unread_message_count = db.Column(db.Integer, default=0, nullable=False)
     
     notifications = db.relationship('Notification', backref='user', lazy='dynamic')
 
@@ -128,6 +216,11 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         """
         if not self.is_following(user):
             self.followed.append(user)
+            self._following_cache()[user.id] = True
+            self.increment('followed_count')
+            user.increment('follower_count')
+            if timeline_fanout_on_write() and not user.is_fanout_exempt():
+                TimelineEntry.backfill(self.id, [user.id])
 
     def unfollow(self, user):
         """
@@ -135,23 +228,209 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         """
         if self.is_following(user):
             self.followed.remove(user)
+            self._following_cache()[user.id] = False
+            self.increment('followed_count', -1)
+            user.increment('follower_count', -1)
+            if timeline_fanout_on_write():
+                TimelineEntry.remove_authors(self.id, [user.id])
+
+    def follow_many(self, user_ids):
+        """
+        Follows several users with the same few statements however many there are.
+        Users that are already followed or do not exist, and the user itself, are skipped
+        Returns: the ids of the users that were followed
+        """
+        ids = sorted(id for id, following in self._following_edges(user_ids).items()
+                     if not following)
+        if ids:
+            db.session.execute(followers.insert(), [
+                {'follower_id': self.id, 'followed_id': id} for id in ids])
+            self._update_follows(ids, 1)
+            if timeline_fanout_on_write():
+                TimelineEntry.backfill(self.id, ids)
+        return ids
+
+    def unfollow_many(self, user_ids):
+        """
+        Unfollows several users with the same few statements however many there are.
+        Users that are not followed are skipped
+        Returns: the ids of the users that were unfollowed
+        """
+        ids = sorted(id for id, following in self._following_edges(user_ids).items()
+                     if following)
+        if ids:
+            db.session.execute(followers.delete().where(
+                followers.c.follower_id == self.id).where(followers.c.followed_id.in_(ids)))
+            self._update_follows(ids, -1)
+            if timeline_fanout_on_write():
+                TimelineEntry.remove_authors(self.id, ids)
+        return ids
+
+    def set_followed(self, user_ids):
+        """
+        Makes the users followed exactly the given ones, following and unfollowing as needed
+        Returns: a tuple (ids of the users that were followed, ids of those unfollowed)
+        """
+        current = set(id for id, in db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == self.id))
+        wanted = set(user_ids)
+        return self.follow_many(wanted - current), self.unfollow_many(current - wanted)
+
+    def _following_edges(self, user_ids):
+        """
+        Checks which of the given users exist and are followed, in a single query
+        Returns: a dictionary of user id -> True if the user is followed
+        """
+        ids = set(user_ids) - {self.id}
+        if not ids:
+            return {}
+        rows = db.session.query(User.id, followers.c.follower_id).outerjoin(
+            followers, db.and_(followers.c.followed_id == User.id,
+                               followers.c.follower_id == self.id)).filter(User.id.in_(ids))
+        return {id: follower_id is not None for id, follower_id in rows}
+
+    def _update_follows(self, ids, delta):
+        """
+        Updates the counters, caches and change log after the user followed (delta 1) or
+        unfollowed (delta -1) users directly in the followers table
+        """
+        self.increment('followed_count', delta * len(ids))
+        db.session.execute(User.__table__.update().where(User.id.in_(ids)).values(
+            follower_count=User.follower_count + delta))
+        cache = self._following_cache()
+        for id in ids:
+            cache[id] = delta > 0
+            user = db.session.identity_map.get(identity_key(User, id))
+            if user is not None:
+                db.session.expire(user, ['follower_count', 'updated_at'])
+        db.session.info.setdefault('users_changed', set()).update(ids)
+        operation = 'create' if delta > 0 else 'delete'
+        ChangeLog.record(ChangeLog.follow_records([(self.id, id) for id in ids], operation) +
+                         ChangeLog.update_records('user', ids))
 
     def is_following(self, user):
         """
         Checks if the current user if following another given user
+        The answer is cached for the rest of the request, see following_ids
+        """
+        cache = self._following_cache()
+        if user.id not in cache:
+            cache[user.id] = db.session.query(followers.c.followed_id).filter(
+                followers.c.follower_id == self.id).filter(
+                followers.c.followed_id == user.id).first() is not None
+        return cache[user.id]
+
+    def following_ids(self, users):
+        """
+        Checks which of the given users are followed by the current user in a single query.
+        The answers are cached for the rest of the request, so pages that render many
+        users can call this once up front and then use is_following freely.
+        users - a list of users or user ids
+        Returns: the set of ids of the given users that are followed
         """
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0  
+        cache = self._following_cache()
+        ids = set(u if isinstance(u, int) else u.id for u in users)
+        missing = ids.difference(cache)
+        if missing:
+            found = set(followed_id for followed_id, in db.session.query(
+                followers.c.followed_id).filter(followers.c.follower_id == self.id).filter(
+                followers.c.followed_id.in_(missing)))
+            for user_id in missing:
+                cache[user_id] = user_id in found
+        return set(user_id for user_id in ids if cache[user_id])
+
+    def _following_cache(self):
+        """
+        Returns: the per-request cache of the current user's follow relationships,
+        outside of a request a throwaway dictionary is returned
+        """
+        if not has_request_context() or self.id is None:
+            return {}
+        caches = g.setdefault('following_cache', {})
+        return caches.setdefault(self.id, {})
 
     def followed_posts(self):
         """
         Returns: the posts of all users followed by the current user along with the current user's posts
+        The posts are read from the precomputed timeline when TIMELINE_FANOUT is set to 'write'
         """
+        if timeline_fanout_on_write():
+            return self.timeline_posts()
         followed = Post.query.join(
                 followers, (followers.c.followed_id == Post.user_id)).filter(  # join posts and followers where followed_id = user_id 
                 followers.c.follower_id == self.id)                            # filter to get rows where only current user is follower
         own = Post.query.filter_by(user_id=self.id)                            # get the current user's own posts
         return followed.union(own).order_by(Post.timestamp.desc())             # order by time of posting
 
+    def timeline_posts(self):
+        """
+        Returns: the posts in the current user's precomputed timeline, merged with the posts
+        of any followed users that are too popular to be fanned out on write
+        """
+        timeline = Post.query.join(
+                TimelineEntry, (TimelineEntry.post_id == Post.id)).filter(
+                TimelineEntry.user_id == self.id)
+        exempt = [user_id for user_id, in db.session.query(followers.c.followed_id).filter(
+                followers.c.follower_id == self.id).filter(
+                followers.c.followed_id.in_(fanout_exempt_ids()))]
+        if exempt:
+            timeline = timeline.union(Post.query.filter(Post.user_id.in_(exempt)))
+        return timeline.order_by(Post.timestamp.desc())
+
+    def is_fanout_exempt(self):
+        """
+        Checks if the user has too many followers for their posts to be fanned out on write
+        """
+        if isinstance(db.inspect(self).dict.get('follower_count'), ClauseElement):
+            db.session.flush()      # apply a pending increment before reading the counter
+        return (self.follower_count or 0) > current_app.config['TIMELINE_FANOUT_THRESHOLD']
+
+    def increment(self, counter, delta=1):
+        """
+        Adds delta to one of the denormalized counters.
+        For users already in the database this is done with an UPDATE counter = counter + delta
+        when the session is flushed, so concurrent transactions do not overwrite each other.
+        counter - the name of the counter column e.g. follower_count
+        """
+        state = db.inspect(self)
+        current = state.dict.get(counter)
+        if isinstance(current, ClauseElement):
+            setattr(self, counter, current + delta)
+        elif state.persistent:
+            setattr(self, counter, getattr(User, counter) + delta)
+        else:
+            setattr(self, counter, (current or 0) + delta)
+
+    @staticmethod
+    def repair_counters():
+        """
+        Recomputes the denormalized counters of every user whose counters have drifted,
+        and records the users in the change log
+        Returns: the number of users that were repaired
+        """
+        actual = {
+            'post_count': db.select([db.func.count(Post.id)]).where(
+                Post.user_id == User.id).as_scalar(),
+            'follower_count': db.select([db.func.count()]).select_from(followers).where(
+                followers.c.followed_id == User.id).as_scalar(),
+            'followed_count': db.select([db.func.count()]).select_from(followers).where(
+                followers.c.follower_id == User.id).as_scalar(),
+            'unread_message_count': db.select([db.func.count(Message.id)]).where(
+                Message.recipient_id == User.id).where(
+                Message.timestamp > db.func.coalesce(User.last_message_read_time,
+                                                     datetime(1900, 1, 1))).as_scalar()
+        }
+        drifted = db.or_(*[db.or_(getattr(User, name) == None, getattr(User, name) != value)
+                           for name, value in actual.items()])
+        ids = [id for id, in db.session.query(User.id).filter(drifted)]
+        if not ids:
+            return 0
+        User.query.filter(User.id.in_(ids)).update(
+            {getattr(User, name): value for name, value in actual.items()},
+            synchronize_session=False)
+        ChangeLog.record(ChangeLog.update_records('user', ids))
+        return len(ids)
+
     def user_posts(self):
         """
         Returns: the current user's posts
@@ -183,40 +462,105 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         """
         Returns: the number of unread messages
         """
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        return Message.query.filter_by(recipient=self).filter(
-            Message.timestamp > last_read_time).count()
-        
+        db.session.flush()      # count messages that are still pending, and apply the increments
+        return self.unread_message_count
+
+    def read_messages(self):
+        """
+        Marks all of the user's messages as read
+        """
+        self.last_message_read_time = datetime.utcnow()
+        self.unread_message_count = 0
+        self.add_notification('unread_message_count', 0)
+
     def add_notification(self, name, data):
         """
-        Updates the number of new unread messages for a user
+        Updates the number of new unread messages for a user.
+        There is one notification per name for a user, it is updated in place if it exists.
         name: the notification type e.g. unread_message_count
         data: the notification content - can be a single value e.g. the number of unread messages
         """
-        self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return
+        payload = {'name': name, 'data': data, 'timestamp': time()}
+        if not self._update_notification(payload):
+            try:
+                # a savepoint of the connection rather than of the session, so that a conflict
+                # leaves the transaction usable without running the commit and rollback hooks
+                connection = db.session.connection()
+                with connection.begin_nested():
+                    connection.execute(Notification.__table__.insert().values(
+                        name=name, user_id=self.id, payload_json=json.dumps(data),
+                        timestamp=payload['timestamp']))
+            except IntegrityError:
+                # a concurrent request inserted the notification first
+                self._update_notification(payload)
+        # published after the commit
+        db.session.info.setdefault('notifications', []).append((self.id, json.dumps(payload)))
 
-    def to_dict(self, include_email=False):
+    def _update_notification(self, payload):
+        """
+        Updates the notification of a user in place
+        Returns: True if the user has the notification
+        """
+        return bool(self.notifications.filter_by(name=payload['name']).update(
+            {'payload_json': json.dumps(payload['data']), 'timestamp': payload['timestamp']},
+            synchronize_session='evaluate'))
+
+    def is_admin(self):
+        """
+        Checks if the user's email address is one of the ADMINS
+        """
+        admins = current_app.config['ADMINS'] or []
+        if isinstance(admins, str):
+            admins = [email.strip() for email in admins.split(',')]
+        return self.email in admins
+
+    # the fields of to_dict that can be requested with fields=, and the columns they read
+    API_FIELDS = {
+        'id': ['id'],
+        'username': ['username'],
+        'last_seen': ['last_seen'],
+        'about_me': ['about_me'],
+        'post_count': ['post_count'],
+        'follower_count': ['follower_count'],
+        'followed_count': ['followed_count'],
+        '_links': ['email']
+    }
+
+    @staticmethod
+    def load_fields(fields):
+        """
+        Returns: the query options that only load the columns needed for fields
+        """
+        if fields is None:
+            return []
+        columns = {'id', 'updated_at'}
+        for field in fields:
+            columns.update(User.API_FIELDS[field])
+        return [db.load_only(*sorted(columns))]
+
+    def to_dict(self, include_email=False, fields=None):
         """
         Returns a dictionary representation of a user in the database
+        fields: the fields to include, or None for all of them - see API_FIELDS
         """
-        data = {
-            'id': self.id,
-            'username': self.username,
-            'last_seen': self.last_seen.isoformat() + 'Z',
-            'about_me': self.about_me,
-            'post_count': self.posts.count(),
-            'follower_count': self.followers.count(),
-            'followed_count': self.followed.count(),
-            '_links': {
+        fields = User.API_FIELDS if fields is None else fields
+        data = {'id': self.id}
+        if 'username' in fields:
+            data['username'] = self.username
+        if 'last_seen' in fields:
+            data['last_seen'] = self.last_seen.isoformat() + 'Z'
+        if 'about_me' in fields:
+            data['about_me'] = self.about_me
+        for counter in ('post_count', 'follower_count', 'followed_count'):
+            if counter in fields:
+                data[counter] = getattr(self, counter)
+        if '_links' in fields:
+            data['_links'] = {
                 'self': url_for('api.get_user', id=self.id),
                 'followers': url_for('api.get_followers', id=self.id),
                 'followed': url_for('api.get_followed', id=self.id),
                 'avatar': self.avatar(128)
             }
-        }
         if include_email:
             data['email'] = self.email
         return data
@@ -246,11 +590,80 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 
     @staticmethod
     def check_token(token):
-        user = User.query.filter_by(token=token).first()
+        cache = current_app.identity_cache
+        user_id = cache.get(('token', token)) if cache is not None else None
+        if user_id is not None:
+            user = User.load(user_id)
+            if user is not None and user.token != token:
+                user = None             # the token has been replaced
+        else:
+            user = User.query.filter_by(token=token).first()
+            if user is not None and cache is not None:
+                cache.put(('token', token), user.id)
+                cache.put(('user', user.id), user.snapshot())
         if user is None or user.token_expiration < datetime.utcnow():
             return None
         return user
 
+    def snapshot(self):
+        """
+        Returns: the column values of the user, as kept by the identity cache
+        """
+        return {attr.key: getattr(self, attr.key) for attr in db.inspect(User).column_attrs}
+
+    @staticmethod
+    def load(id):
+        """
+        Loads a user by id through the identity cache - see identity.py
+        A cached user is merged into the session without querying the database
+        """
+        user = db.session.identity_map.get(identity_key(User, id))
+        cache = current_app.identity_cache
+        if user is not None or cache is None:
+            return user or User.query.get(id)
+        data = cache.get(('user', id))
+        if data is None:
+            user = User.query.get(id)
+            if user is not None:
+                cache.put(('user', id), user.snapshot())
+            return user
+        user = User(**data)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        """
+        Notes the users changed in a transaction, their cached identities are dropped after the commit
+        session - a connected session with the database
+        """
+        changed = session.info.setdefault('users_changed', set())
+        for obj in itertools.chain(session.dirty, session.deleted):
+            if isinstance(obj, User):
+                changed.add(obj.id)
+
+    @staticmethod
+    def after_commit(session):
+        """
+        Drops the cached identities of the users changed in the transaction,
+        e.g. by get_token, revoke_token, a password reset or a profile edit
+        session - a connected session with the database
+        """
+        changed = session.info.pop('users_changed', ())
+        if current_app.identity_cache is not None:
+            for user_id in changed:
+                current_app.identity_cache.invalidate(user_id)
+
+    @staticmethod
+    def after_rollback(session):
+        session.info.pop('users_changed', None)
+
+
+
+db.event.listen(db.session, 'after_flush', User.after_flush)
+db.event.listen(db.session, 'after_commit', User.after_commit)
+db.event.listen(db.session, 'after_rollback', User.after_rollback)
+
 
 
 class SearchableMixin(object):
@@ -276,14 +689,43 @@ class SearchableMixin(object):
         Returns:
         A list of objects matching the search criterea
         """
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
-        if total == 0:
-            return cls.query.filter_by(id=0), 0
+        ids, total = cached_query_index(cls.__tablename__, expression, page, per_page)
+        return cls.query_ids(ids), total
+
+    @classmethod
+    def search_after(cls, expression, cursor, per_page):
+        """
+        Searches the index for a given text string, paging with an opaque cursor.
+        Reading a deep page costs about the same as reading the first one.
+        -------------------------------------------------------------------------
+        Parameters:
+        expression - the text string to search for
+        cursor - the cursor returned with the previous page, or None for the first page
+        per_page - the number of results to display per page
+        -------------------------------------------------------------------------
+        Returns:
+        A tuple (objects matching the search criterea, number of search hits,
+        cursor of the next page or None)
+        """
+        ids, total, next_cursor = query_index_after(cls.__tablename__, expression,
+                                                    cursor, per_page)
+        return cls.query_ids(ids), total, next_cursor
+
+    @classmethod
+    def query_ids(cls, ids):
+        """
+        Returns: a query for the objects with the given ids, in the same order as the ids
+        """
+        if not ids:
+            return cls.query.filter_by(id=0)
         when = []
         for i in range(len(ids)):
             when.append((ids[i], i))
-        return cls.query.filter(cls.id.in_(ids)).order_by(   # ensure DB results 
-            db.case(when, value=cls.id)), total
+        # relationships listed in __searchable_relations__ are loaded in one batched query
+        options = [db.selectinload(getattr(cls, name))
+                   for name in getattr(cls, '__searchable_relations__', [])]
+        return cls.query.options(*options).filter(cls.id.in_(ids)).order_by(   # ensure DB results 
+            db.case(when, value=cls.id))
 
     @classmethod
     def before_commit(cls, session):
@@ -298,42 +740,209 @@ class SearchableMixin(object):
         }
 
     @classmethod
-    def after_commit(cls, session):
+    def after_flush(cls, session, flush_context):
         """
-        Adds any objects in _changes to the index after they are committed to the database
+        Writes a change record to the search outbox for every searchable object in the flush.
+        The records are committed or rolled back together with the objects themselves,
+        and are sent to the index by the 'flask search worker' process - see SearchOutbox.
+        Only used when SEARCH_SYNC is set to 'outbox'.
+        The changed indexes are also noted, so their cached searches are dropped after the commit.
         session - a connected session with the database
         """
-        for obj in session._changes['add']:
+        changed = session.info.setdefault('search_changed', set())
+        for obj in itertools.chain(session.new, session.dirty, session.deleted):
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
+                changed.add(obj.__tablename__)
+        if current_app.config['SEARCH_SYNC'] != 'outbox':
+            return
+        records = []
+        for operation, objects in [('index', session.new), ('index', session.dirty),
+                                   ('delete', session.deleted)]:
+            for obj in objects:
+                if isinstance(obj, SearchableMixin):
+                    records.append({'index': obj.__tablename__, 'object_id': obj.id,
+                                    'operation': operation})
+        if records:
+            session.execute(SearchOutbox.__table__.insert(), records)
+
+    @classmethod
+    def after_commit(cls, session):
+        """
+        Sends the objects in _changes to the index after they are committed to the database,
+        all changes of a commit go to the index in a single bulk request.
+        Not used when SEARCH_SYNC is set to 'outbox'
+        session - a connected session with the database
+        """
+        if current_app.search_cache is not None:
+            for index in session.info.pop('search_changed', ()):
+                current_app.search_cache.bump(index)
+        if current_app.config['SEARCH_SYNC'] == 'outbox':
+            session._changes = None
+            return
+        actions = []
+        for obj in session._changes['add'] + session._changes['update']:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
+                actions.append(('index', obj.__tablename__, obj))
         for obj in session._changes['delete']:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
+                actions.append(('delete', obj.__tablename__, obj))
         session._changes = None
+        bulk_index(actions)
 
     @classmethod
-    def reindex(cls):
+    def after_rollback(cls, session):
         """
-        Adds all objects inthe the database relation to the search index
+        Forgets the indexes changed in a transaction that was rolled back
+        session - a connected session with the database
         """
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+        session.info.pop('search_changed', None)
+
+    @classmethod
+    def reindex(cls, chunk_size=None):
+        """
+        Adds all objects in the database relation to the search index.
+        Rows are read and indexed in chunks of SEARCH_REINDEX_CHUNK_SIZE, one bulk request per chunk
+        ---------------------------------------------------------------------------------------------
+        Returns:
+        A tuple (number of objects indexed, throughput in docs/sec)
+        """
+        chunk_size = chunk_size or current_app.config['SEARCH_REINDEX_CHUNK_SIZE']
+        start = time()
+        count = 0
+        last_id = 0
+        while True:
+            chunk = cls.query.filter(cls.id > last_id).order_by(cls.id).limit(chunk_size).all()
+            if not chunk:
+                break
+            bulk_index([('index', cls.__tablename__, obj) for obj in chunk])
+            count += len(chunk)
+            last_id = chunk[-1].id
+            db.session.expunge_all()        # keep memory flat on large tables
+        elapsed = time() - start
+        rate = count / elapsed if elapsed else 0.0
+        current_app.logger.info('Reindexed %d %s in %.1fs (%.0f docs/sec)',
+                                count, cls.__tablename__, elapsed, rate)
+        return count, rate
 
 
 
 db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
+
+
+
+class SearchOutbox(db.Model):
+    """
+    A pending change to the search index (transactional outbox).
+    Rows are written by SearchableMixin in the same transaction as the change,
+    and a worker process sends them to the index in batches with retries.
+    """
+    __tablename__ = 'search_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    index = db.Column(db.String(64))
+    object_id = db.Column(db.Integer)
+    operation = db.Column(db.String(16))            # 'index' or 'delete'
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+
+    @staticmethod
+    def searchable_models():
+        """
+        Returns: a dictionary of the searchable model classes by index name
+        """
+        return {cls.__tablename__: cls for cls in db.Model._decl_class_registry.values()
+                if isinstance(cls, type) and issubclass(cls, SearchableMixin)}
 
+    @staticmethod
+    def drain(batch_size=None):
+        """
+        Sends a batch of due outbox records to the search index.
+        Repeated changes to the same object are collapsed into the last one, and objects
+        are read from the database when the batch is sent so the newest version is indexed.
+        If the index cannot be reached the batch is retried later with exponential backoff,
+        and so are the operations the index rejects for a transient reason.
+        -----------------------------------------------------------------------------------
+        Returns:
+        The number of outbox records processed
+        """
+        config = current_app.config
+        batch_size = batch_size or config['SEARCH_OUTBOX_BATCH_SIZE']
+        now = datetime.utcnow()
+        records = SearchOutbox.query.filter(SearchOutbox.next_attempt <= now).order_by(
+            SearchOutbox.id).limit(batch_size).all()
+        if not records:
+            return 0
+        latest = {}
+        for record in records:
+            latest[(record.index, record.object_id)] = record.operation
+        models = SearchOutbox.searchable_models()
+        actions = []
+        for index, ids in itertools.groupby(sorted(latest), key=lambda key: key[0]):
+            ids = [object_id for _, object_id in ids]
+            model = models[index]
+            objects = {obj.id: obj for obj in model.query.filter(model.id.in_(
+                [i for i in ids if latest[(index, i)] == 'index']))}
+            for object_id in ids:
+                if object_id in objects:
+                    actions.append(('index', index, objects[object_id]))
+                else:           # deleted, or deleted since the change was recorded
+                    actions.append(('delete', index, model(id=object_id)))
+        try:
+            failed = bulk_index(actions)
+        except Exception as e:
+            SearchOutbox.retry_later(records, now)
+            db.session.commit()
+            current_app.logger.warning('Search outbox batch of %d failed, will retry: %s',
+                                       len(records), e)
+            return len(records)
+        # operations rejected for a transient reason, e.g. 429 when the cluster is busy, are
+        # retried - others, e.g. a document the mapping does not accept, would fail again
+        retry = set((index, object_id) for index, object_id, status in failed
+                    if status is None or status == 429 or status >= 500)
+        retried = [record for record in records if (record.index, record.object_id) in retry]
+        if retried:
+            SearchOutbox.retry_later(retried, now)
+            current_app.logger.warning('%d search outbox records were rejected, will retry',
+                                       len(retried))
+        SearchOutbox.query.filter(SearchOutbox.id.in_(
+            [r.id for r in records if (r.index, r.object_id) not in retry])).delete(
+            synchronize_session=False)
+        db.session.commit()
+        return len(records)
 
+    @staticmethod
+    def retry_later(records, now):
+        """
+        Schedules the next attempt of records with exponential backoff
+        """
+        config = current_app.config
+        for record in records:
+            record.attempts += 1
+            delay = min(config['SEARCH_OUTBOX_BACKOFF'] * 2 ** (record.attempts - 1),
+                        config['SEARCH_OUTBOX_MAX_BACKOFF'])
+            record.next_attempt = now + timedelta(seconds=delay)
+
+    @staticmethod
+    def lag():
+        """
+        Returns: a tuple (number of pending outbox records, age in seconds of the oldest one)
+        """
+        pending, oldest = db.session.query(
+            db.func.count(SearchOutbox.id), db.func.min(SearchOutbox.timestamp)).one()
+        age = (datetime.utcnow() - oldest).total_seconds() if oldest else 0.0
+        return pending, age
 
-class Post(SearchableMixin, db.Model):
+
+
+class Post(PaginatedAPIMixin, SearchableMixin, db.Model):
     """
     Represents a post by a user
     """
     __searchable__ = ['body']                       # the body of a post is searchable
+    __searchable_relations__ = ['author']           # search results are rendered with their author
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
     # use uniform timestamp, will be converted into users local times
@@ -347,6 +956,392 @@ class Post(SearchableMixin, db.Model):
         """
         return '<Post {}>'.format(self.body)
 
+    API_FIELDS = ('id', 'body', 'timestamp', 'language', 'user_id', '_links')
+
+    def to_dict(self, fields=None):
+        """
+        Returns a dictionary representation of a post in the database
+        fields: the fields to include, or None for all of them - see API_FIELDS
+        """
+        fields = Post.API_FIELDS if fields is None else fields
+        data = {'id': self.id}
+        if 'body' in fields:
+            data['body'] = self.body
+        if 'timestamp' in fields:
+            data['timestamp'] = self.timestamp.isoformat() + 'Z'
+        if 'language' in fields:
+            data['language'] = self.language
+        if 'user_id' in fields:
+            data['user_id'] = self.user_id
+        if '_links' in fields:
+            data['_links'] = {
+                'self': url_for('api.get_post', id=self.id),
+                'author': url_for('api.get_user', id=self.user_id)
+            }
+        return data
+
+    def from_dict(self, data):
+        """
+        Sets the body of a post, and its language and timestamp if they are given -
+        the language is detected otherwise. Timestamps with an offset are converted to UTC
+        """
+        self.body = data['body']
+        self.language = data.get('language') or Post.detect_language(self.body)
+        if data.get('timestamp'):
+            timestamp = datetime.fromisoformat(data['timestamp'].rstrip('Z'))
+            if timestamp.tzinfo is not None:
+                timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+            self.timestamp = timestamp
+
+    @staticmethod
+    def detect_language(text):
+        """
+        Returns: the language code of a text, or '' if it cannot be identified
+        """
+        language = guess_language(text)
+        if language == 'UNKNOWN' or len(language) > 5:
+            language = ''
+        return language
+
+    @staticmethod
+    def before_flush(session, flush_context, instances):
+        """
+        Keeps the post_count of authors in step with posts that are added or deleted,
+        in the same transaction as the posts themselves
+        session - a connected session with the database
+        """
+        changes = [(obj, 1) for obj in session.new if isinstance(obj, Post)] + \
+            [(obj, -1) for obj in session.deleted if isinstance(obj, Post)]
+        for post, delta in changes:
+            if post.author is not None:
+                post.author.increment('post_count', delta)
+            elif post.user_id is not None:
+                session.execute(User.__table__.update().where(User.id == post.user_id).values(
+                    post_count=User.post_count + delta))
+                ChangeLog.record(ChangeLog.update_records('user', [post.user_id]))
+
+
+
+db.event.listen(db.session, 'before_flush', Post.before_flush)
+
+
+
+class ChangeLog(db.Model):
+    """
+    A change to a user, a post or a follow relationship, for clients that sync incrementally.
+    Rows are written by after_flush in the same transaction as the change, and are read in
+    order of id by /api/changes. Writes that do not go through the session, such as the
+    counters updated in bulk and the buffered last_seen times, add their rows with record. The rows of deleted objects (tombstones) are the reason the
+    log is kept at all - all rows are pruned after CHANGES_RETENTION_DAYS, see prune.
+    """
+    __tablename__ = 'change_log'
+    id = db.Column(db.Integer, primary_key=True)
+    resource = db.Column(db.String(16))             # 'user', 'post' or 'follow'
+    object_id = db.Column(db.Integer)               # the follower_id of a follow
+    related_id = db.Column(db.Integer)              # the followed_id of a follow
+    operation = db.Column(db.String(16))            # 'create', 'update' or 'delete'
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+
+    RESOURCES = {User: 'user', Post: 'post'}
+
+    @staticmethod
+    def follow_records(pairs, operation):
+        """
+        Returns: the change records of follow relationships that are created or deleted,
+        for changes to the followers table that do not go through the session
+        pairs - (follower_id, followed_id) tuples
+        """
+        now = datetime.utcnow()
+        return [{'resource': 'follow', 'object_id': follower_id, 'related_id': followed_id,
+                 'operation': operation, 'timestamp': now} for follower_id, followed_id in pairs]
+
+    @staticmethod
+    def update_records(resource, ids):
+        """
+        Returns: the change records of users or posts that are updated without the session
+        """
+        now = datetime.utcnow()
+        return [{'resource': resource, 'object_id': id, 'related_id': None,
+                 'operation': 'update', 'timestamp': now} for id in ids]
+
+    @staticmethod
+    def record(records):
+        """
+        Writes change records in the current transaction, see follow_records and update_records
+        """
+        if records:
+            db.session.execute(ChangeLog.__table__.insert(), records)
+
+    @staticmethod
+    def before_update(mapper, connection, target):
+        """
+        Notes the users and posts whose columns are updated by a flush. This is done here
+        rather than in after_flush, where the history of counters that were set to an
+        SQL expression (see User.increment) has already been expired
+        """
+        session = db.object_session(target)
+        if session.is_modified(target, include_collections=False):
+            session.info.setdefault('changes_updated', set()).add(target)
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        """
+        Writes a change record for every user and post in the flush that was added, changed or
+        deleted, and for every follow relationship added or removed through User.followed
+        session - a connected session with the database
+        """
+        now = datetime.utcnow()
+        updated = session.info.pop('changes_updated', set())
+        records = []
+        for operation, objects in [('create', session.new), ('update', session.dirty),
+                                   ('delete', session.deleted)]:
+            for obj in objects:
+                resource = ChangeLog.RESOURCES.get(type(obj))
+                if resource is None:
+                    continue
+                if operation != 'update' or obj in updated:
+                    records.append({'resource': resource, 'object_id': obj.id,
+                                    'related_id': None, 'operation': operation,
+                                    'timestamp': now})
+                if isinstance(obj, User) and operation != 'delete':
+                    added, _, removed = db.inspect(obj).attrs.followed.history
+                    records += ChangeLog.follow_records(
+                        [(obj.id, user.id) for user in added], 'create')
+                    records += ChangeLog.follow_records(
+                        [(obj.id, user.id) for user in removed], 'delete')
+        if records:
+            session.execute(ChangeLog.__table__.insert(), records)
+
+    @staticmethod
+    def after_rollback(session):
+        session.info.pop('changes_updated', None)
+
+    @staticmethod
+    def settled_before():
+        """
+        Returns: the time before which changes are settled. Ids are given out when a change is
+        flushed, but transactions commit in any order, so a change with a lower id can still
+        become visible after a higher one has been read. Changes are only read once they are
+        older than CHANGES_SETTLE_SECONDS, which must be longer than the longest transaction
+        that writes them
+        """
+        return datetime.utcnow() - timedelta(seconds=current_app.config['CHANGES_SETTLE_SECONDS'])
+
+    @staticmethod
+    def head():
+        """
+        Returns: the id of the last change before the first one that is not settled,
+        where a client that has just exported everything starts reading
+        """
+        unsettled = db.session.query(db.func.min(ChangeLog.id)).filter(
+            ChangeLog.timestamp > ChangeLog.settled_before()).scalar()
+        if unsettled is not None:
+            return unsettled - 1
+        return db.session.query(db.func.max(ChangeLog.id)).scalar() or 0
+
+    @staticmethod
+    def since(change_id, limit):
+        """
+        Reads the settled changes after a change, repeated changes to the same object are
+        collapsed into the last one. Reading stops at the first change that is not settled,
+        as the changes before it may not all be visible yet - see settled_before
+        ------------------------------------------------------------------------------------
+        Returns:
+        A tuple (list of (resource, object_id, related_id, operation) in order of their last
+        change, the last change read or None, whether there are more settled changes)
+        """
+        cutoff = ChangeLog.settled_before()
+        rows = ChangeLog.query.filter(ChangeLog.id > change_id).order_by(
+            ChangeLog.id).limit(limit + 1).all()
+        for i, row in enumerate(rows):
+            if row.timestamp > cutoff:
+                rows = rows[:i]
+                break
+        more = len(rows) > limit
+        rows = rows[:limit]
+        latest = {}
+        for row in rows:
+            key = (row.resource, row.object_id, row.related_id)
+            operation = row.operation
+            if key in latest:
+                previous = latest.pop(key)
+                if previous == 'create' and operation != 'delete':
+                    operation = 'create'            # still new to the client
+            latest[key] = operation
+        changes = [key + (operation,) for key, operation in latest.items()]
+        return changes, (rows[-1] if rows else None), more
+
+    @staticmethod
+    def prune():
+        """
+        Deletes the changes older than CHANGES_RETENTION_DAYS. The last change is always kept,
+        as some databases would otherwise reuse its id and clients would skip the new changes
+        Returns: the number of changes deleted
+        """
+        cutoff = datetime.utcnow() - timedelta(days=current_app.config['CHANGES_RETENTION_DAYS'])
+        last = db.session.query(db.func.max(ChangeLog.id)).scalar()
+        return ChangeLog.query.filter(ChangeLog.timestamp < cutoff).filter(
+            ChangeLog.id < last).delete(synchronize_session=False)
+
+
+
+db.event.listen(User, 'before_update', ChangeLog.before_update)
+db.event.listen(Post, 'before_update', ChangeLog.before_update)
+db.event.listen(db.session, 'after_flush', ChangeLog.after_flush)
+db.event.listen(db.session, 'after_rollback', ChangeLog.after_rollback)
+
+
+
+def timeline_fanout_on_write():
+    """
+    Returns: True if home timelines are precomputed when posts are written
+    """
+    return current_app.config['TIMELINE_FANOUT'] == 'write'
+
+
+def fanout_exempt_ids():
+    """
+    Returns: a subquery of the ids of users with too many followers to be fanned out on write
+    """
+    return db.session.query(User.id.label('followed_id')).filter(
+        User.follower_count > current_app.config['TIMELINE_FANOUT_THRESHOLD']).subquery()
+
+
+
+class TimelineEntry(db.Model):
+    """
+    A post in a user's precomputed home timeline.
+    Rows are written when a post is committed (fan-out-on-write), and are only
+    used when TIMELINE_FANOUT is set to 'write'
+    """
+    __tablename__ = 'timeline'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+    timestamp = db.Column(db.DateTime)
+    __table_args__ = (db.Index('ix_timeline_user_id_timestamp', 'user_id', 'timestamp'),)
+
+    @staticmethod
+    def fan_out(posts):
+        """
+        Pushes new posts into the timelines of their authors and the authors' followers,
+        with the same three statements however many posts there are.
+        Authors with more than TIMELINE_FANOUT_THRESHOLD followers only get their posts
+        in their own timeline, their followers merge them in on read.
+        """
+        table = TimelineEntry.__table__
+        db.session.execute(table.insert(), [
+            {'user_id': post.user_id, 'post_id': post.id, 'timestamp': post.timestamp}
+            for post in posts])
+        exempt = set(user_id for user_id, in db.session.query(User.id).filter(
+            User.id.in_(set(post.user_id for post in posts))).filter(
+            User.follower_count > current_app.config['TIMELINE_FANOUT_THRESHOLD']))
+        ids = [post.id for post in posts if post.user_id not in exempt]
+        if not ids:
+            return
+        db.session.execute(table.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select([followers.c.follower_id, Post.id, Post.timestamp]).where(
+                followers.c.followed_id == Post.user_id).where(Post.id.in_(ids))))
+
+    @staticmethod
+    def backfill(user_id, author_ids):
+        """
+        Copies the most recent posts of newly followed authors into a user's timeline,
+        authors with too many followers to be fanned out on write are left out
+        """
+        recent = db.select([db.literal(user_id, db.Integer), Post.id, Post.timestamp]).where(
+            Post.user_id.in_(author_ids)).where(
+            Post.user_id.notin_(db.select([fanout_exempt_ids().c.followed_id]))).order_by(
+            Post.timestamp.desc()).limit(current_app.config['TIMELINE_LENGTH'])
+        db.session.execute(TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'], recent))
+
+    @staticmethod
+    def remove_authors(user_id, author_ids):
+        """
+        Removes the posts of unfollowed authors from a user's timeline
+        """
+        db.session.execute(TimelineEntry.__table__.delete().where(
+            TimelineEntry.user_id == user_id).where(
+            TimelineEntry.post_id.in_(db.select([Post.id]).where(
+                Post.user_id.in_(author_ids)))))
+
+    @staticmethod
+    def rebuild(user):
+        """
+        Rebuilds a user's timeline from the followers table, keeping the newest TIMELINE_LENGTH posts.
+        Used to populate timelines when switching TIMELINE_FANOUT from 'read' to 'write'.
+        """
+        db.session.execute(TimelineEntry.__table__.delete().where(
+            TimelineEntry.user_id == user.id))
+        followed = db.select([followers.c.followed_id]).where(
+            followers.c.follower_id == user.id).where(
+            followers.c.followed_id.notin_(db.select([fanout_exempt_ids().c.followed_id])))
+        recent = db.select([db.literal(user.id, db.Integer), Post.id, Post.timestamp]).where(
+            db.or_(Post.user_id == user.id, Post.user_id.in_(followed))).order_by(
+            Post.timestamp.desc()).limit(current_app.config['TIMELINE_LENGTH'])
+        db.session.execute(TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'], recent))
+
+    @staticmethod
+    def trim(user_ids=None):
+        """
+        Drops the entries beyond the newest TIMELINE_LENGTH from the timelines that are longer.
+        Fan-out on write only appends, so this is run periodically with 'flask timeline trim'
+        to keep every timeline bounded, rather than on every post for all of the followers.
+        user_ids - only trim the timelines of these users
+        Returns: the number of entries dropped
+        """
+        length = current_app.config['TIMELINE_LENGTH']
+        over = db.session.query(TimelineEntry.user_id).group_by(TimelineEntry.user_id).having(
+            db.func.count() > length)
+        if user_ids is not None:
+            over = over.filter(TimelineEntry.user_id.in_(user_ids))
+        trimmed = 0
+        for user_id, in over.all():
+            # the oldest entry that is kept
+            timestamp, post_id = db.session.query(
+                TimelineEntry.timestamp, TimelineEntry.post_id).filter(
+                TimelineEntry.user_id == user_id).order_by(
+                TimelineEntry.timestamp.desc(), TimelineEntry.post_id.desc()).offset(
+                length - 1).first()
+            trimmed += db.session.execute(TimelineEntry.__table__.delete().where(
+                TimelineEntry.user_id == user_id).where(db.or_(
+                    TimelineEntry.timestamp < timestamp,
+                    db.and_(TimelineEntry.timestamp == timestamp,
+                            TimelineEntry.post_id < post_id)))).rowcount
+        return trimmed
+
+    @staticmethod
+    def before_flush(session, flush_context, instances):
+        """
+        Drops posts that are about to be deleted from every timeline
+        session - a connected session with the database
+        """
+        if not timeline_fanout_on_write():
+            return
+        deleted = [obj.id for obj in session.deleted if isinstance(obj, Post)]
+        if deleted:
+            session.execute(TimelineEntry.__table__.delete().where(
+                TimelineEntry.post_id.in_(deleted)))
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        """
+        Fans out newly inserted posts in the same transaction as the posts themselves
+        session - a connected session with the database
+        """
+        if not timeline_fanout_on_write():
+            return
+        posts = [obj for obj in session.new if isinstance(obj, Post)]
+        if posts:
+            TimelineEntry.fan_out(posts)
+
+
+
+db.event.listen(db.session, 'before_flush', TimelineEntry.before_flush)
+db.event.listen(db.session, 'after_flush', TimelineEntry.after_flush)
+
 
 
 @login.user_loader   # flask-login
@@ -354,7 +1349,7 @@ def load_user(id):
     """
     Keeps track of a unique identifier for each user
     """
-    return User.query.get(int(id))
+    return User.load(int(id))
 
 
 
@@ -374,6 +1369,27 @@ class Message(db.Model):
         """
         return '<Message {}>'.format(self.body)
 
+    @staticmethod
+    def before_flush(session, flush_context, instances):
+        """
+        Counts new messages in the unread_message_count of their recipient,
+        in the same transaction as the messages themselves
+        session - a connected session with the database
+        """
+        for obj in session.new:
+            if not isinstance(obj, Message):
+                continue
+            if obj.recipient is not None:
+                obj.recipient.increment('unread_message_count')
+            elif obj.recipient_id is not None:
+                session.execute(User.__table__.update().where(
+                    User.id == obj.recipient_id).values(
+                    unread_message_count=User.unread_message_count + 1))
+
+
+
+db.event.listen(db.session, 'before_flush', Message.before_flush)
+
 
 
 class Notification(db.Model):
@@ -385,9 +1401,57 @@ class Notification(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     timestamp = db.Column(db.Float, index=True, default=time)
     payload_json = db.Column(db.Text)
+    __table_args__ = (db.Index('ix_notification_user_id_name', 'user_id', 'name', unique=True),)
 
     def get_data(self):
         """
         Returns: the message associated with the notification
         """
-        return json.loads(str(self.payload_json))
\ No newline at end of file
+        return json.loads(str(self.payload_json))
+
+    def to_dict(self):
+        """
+        Returns a dictionary representation of a notification, as sent to the client
+        """
+        return {
+            'name': self.name,
+            'data': self.get_data(),
+            'timestamp': self.timestamp
+        }
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        """
+        Notes the notifications written in a transaction, they are published after the commit
+        session - a connected session with the database
+        """
+        pending = session.info.setdefault('notifications', [])
+        for obj in session.new:
+            if isinstance(obj, Notification):
+                pending.append((obj.user_id, json.dumps(obj.to_dict())))
+
+    @staticmethod
+    def after_commit(session):
+        """
+        Publishes the committed notifications on the channel of their user - see notify.py
+        session - a connected session with the database
+        """
+        pending = session.info.pop('notifications', ())
+        if current_app.notifier is None:
+            return
+        for user_id, message in pending:
+            current_app.notifier.publish(user_channel(user_id), message)
+
+    @staticmethod
+    def after_rollback(session):
+        """
+        Forgets the notifications of a transaction that was rolled back
+        session - a connected session with the database
+        """
+        session.info.pop('notifications', None)
+
+
+
+db.event.listen(db.session, 'after_flush', Notification.after_flush)
+db.event.listen(db.session, 'after_commit', Notification.after_commit)
+db.event.listen(db.session, 'after_rollback', Notification.after_rollback)
\ No newline at end of file
@@ -0,0 +1,127 @@
+"""
+Publishes notifications to the clients that are listening for them.
+
+When a notification is committed it is published on the channel of its user, and the
+/notifications/stream view pushes it to the user's open pages as a Server-Sent Event,
+instead of every page polling /notifications for changes.
+
+The broker is selected by NOTIFICATION_BROKER:
+- LocalBroker, an in-process broker, only reaches the streams served by the same process
+- RedisBroker, uses Redis pub/sub at REDIS_URL, needed when the app runs in several processes
+
+A broker is any object with the methods:
+publish(channel, message) - sends a message string to the subscribers of a channel
+subscribe(channel) - returns a subscription, with the methods get(timeout), which returns
+                     the next message or None after timeout seconds, and close()
+"""
+
+import queue
+import threading
+
+
+class Subscription(object):
+    """
+    A subscription to a channel of a LocalBroker
+    """
+
+    def __init__(self, broker, channel, maxsize):
+        self.broker = broker
+        self.channel = channel
+        self.messages = queue.Queue(maxsize)
+
+    def get(self, timeout):
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker(object):
+    """
+    Publishes messages to the subscribers in the current process
+    """
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize              # messages queued per subscriber, later ones are dropped
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscriptions = list(self.channels.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.messages.put_nowait(message)
+            except queue.Full:
+                pass
+
+    def subscribe(self, channel):
+        subscription = Subscription(self, channel, self.maxsize)
+        with self.lock:
+            self.channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.channels.get(subscription.channel, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.channels.pop(subscription.channel, None)
+
+
+class RedisSubscription(object):
+    """
+    A subscription to a channel of a RedisBroker
+    """
+
+    def __init__(self, client, channel):
+        self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(channel)
+
+    def get(self, timeout):
+        message = self.pubsub.get_message(timeout=timeout)
+        return message['data'].decode('utf-8') if message else None
+
+    def close(self):
+        self.pubsub.close()
+
+
+class RedisBroker(object):
+    """
+    Publishes messages through Redis pub/sub, reaching the subscribers in every process
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def publish(self, channel, message):
+        self.client.publish(channel, message)
+
+    def subscribe(self, channel):
+        return RedisSubscription(self.client, channel)
+
+
+def create_broker(app):
+    """
+    Creates the broker selected by NOTIFICATION_BROKER
+    ---------------------------------------------------
+    Returns:
+    The broker, or None if notifications are not pushed
+    """
+    broker = app.config['NOTIFICATION_BROKER']
+    if broker == 'local':
+        return LocalBroker()
+    if broker == 'redis':
+        from redis import Redis
+        return RedisBroker(Redis.from_url(app.config['REDIS_URL']))
+    return None
+
+
+def user_channel(user_id):
+    """
+    Returns: the name of the channel a user's notifications are published on
+    """
+    return 'notifications:{}'.format(user_id)
@@ -0,0 +1,152 @@
+"""
+Provides keyset (cursor) pagination for database queries.
+
+Page-number pagination uses OFFSET, so the database has to scan and throw away
+every row before the requested page, and it runs a separate COUNT(*) query to
+work out the number of pages. Keyset pagination instead remembers the sort key
+of the last row on a page, e.g. (timestamp, id) for posts, and asks for the rows
+that come after it, which costs the same for every page.
+
+The position is handed to the client as an opaque cursor string.
+"""
+
+import base64
+import json
+from datetime import datetime
+from app import db
+
+
+class InvalidCursor(ValueError):
+    """
+    Raised when a cursor string cannot be decoded
+    """
+    pass
+
+
+class KeysetPage(object):
+    """
+    A page of results from a keyset paginated query
+    """
+
+    def __init__(self, items, next_cursor, prev_cursor, total=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def encode_cursor(values, direction):
+    """
+    Encodes the sort key of a row as an opaque cursor
+    -------------------------------------------------
+    Parameters:
+    values - the values of the sort key columns for the row
+    direction - 'next' for the rows after the row, 'prev' for the rows before it
+    """
+    key = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    data = json.dumps({'k': key, 'd': direction}).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('utf-8').rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    """
+    Decodes a cursor created by encode_cursor
+    -----------------------------------------
+    Parameters:
+    cursor - the cursor string
+    columns - the sort key columns, used to convert the values back to their types
+    -----------------------------------------
+    Returns:
+    A tuple (list of sort key values, direction)
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode('utf-8')))
+        key, direction = data['k'], data['d']
+        if not isinstance(key, list) or len(key) != len(columns) or \
+                direction not in ('next', 'prev'):
+            raise InvalidCursor(cursor)
+        values = [_key_value(c, v) for c, v in zip(columns, key)]
+    except (ValueError, TypeError, KeyError):
+        raise InvalidCursor(cursor)
+    return values, direction
+
+
+def _key_value(column, value):
+    """
+    Returns: a value of a cursor as the type of its column, the values come from the
+    client so anything else is rejected
+    """
+    if isinstance(column.type, db.DateTime):
+        if not isinstance(value, str):
+            raise TypeError(value)
+        return datetime.fromisoformat(value)
+    python_type = column.type.python_type
+    if not isinstance(value, python_type) or isinstance(value, bool):
+        raise TypeError(value)
+    return value
+
+
+def _after(columns, values, descending):
+    """
+    Builds the condition (c1, c2, ...) < (v1, v2, ...) for descending order,
+    or > for ascending order, without relying on row value support in the database
+    """
+    column, value = columns[0], values[0]
+    beyond = column < value if descending else column > value
+    if len(columns) == 1:
+        return beyond
+    return db.or_(beyond, db.and_(column == value,
+                                  _after(columns[1:], values[1:], descending)))
+
+
+def paginate_keyset(query, columns, cursor, per_page, descending=True, count=False):
+    """
+    Returns a page of a query using keyset pagination
+    -------------------------------------------------
+    Parameters:
+    query - a Flask-SQLAlchemy query object, any existing ordering is replaced
+    columns - the unique sort key of the query, e.g. [Post.timestamp, Post.id]
+    cursor - a cursor returned with a previous page, or None for the first page
+    per_page - the number of objects contained in a page
+    descending - sort the results in descending order of the key
+    count - also count the total number of results, this costs an extra query
+    -------------------------------------------------
+    Returns:
+    A KeysetPage object
+    """
+    direction = 'next'
+    reverse = False
+    query_all = query.order_by(None)
+    if cursor:
+        values, direction = decode_cursor(cursor, columns)
+        # paging backwards reads the rows before the cursor in the opposite order
+        reverse = direction == 'prev'
+        query = query_all.filter(_after(columns, values, descending != reverse))
+    else:
+        query = query_all
+    ascending = descending == reverse
+    order = [c.asc() if ascending else c.desc() for c in columns]
+    items = query.order_by(*order).limit(per_page + 1).all()
+    more = len(items) > per_page
+    items = items[:per_page]
+    if reverse:
+        items.reverse()
+
+    def key(item):
+        return [getattr(item, c.key) for c in columns]
+
+    has_next = more if direction == 'next' else True
+    has_prev = more if direction == 'prev' else bool(cursor)
+    next_cursor = encode_cursor(key(items[-1]), 'next') if items and has_next else None
+    prev_cursor = encode_cursor(key(items[0]), 'prev') if items and has_prev else None
+    total = query_all.count() if count else None
+    return KeysetPage(items, next_cursor, prev_cursor, total)
@@ -0,0 +1,268 @@
+"""
+A sampling profiler that can be switched on at runtime for a share of the requests.
+
+The profiler is controlled through a file in PROFILE_DIR, written by the 'flask profile'
+commands or the /admin/profile view, so it can be switched on and off for all processes
+without a restart. The control sets:
+- rate - the share of requests that are profiled, from 0 to 1
+- endpoint - only profile requests to this endpoint, e.g. main.index, or None for all
+- until - when profiling stops by itself
+
+While a profiled request is running, a background thread samples its stack every
+PROFILE_INTERVAL seconds. The samples are added up by stack for each endpoint, and every
+process writes its totals to PROFILE_DIR, from where they are exported as collapsed stacks
+(for flamegraph.pl and most flamegraph tools) or as a speedscope profile.
+
+The overhead is bounded: only the profiled requests are sampled, the sampler thread sleeps
+when there are none, and at most PROFILE_MAX_STACKS distinct stacks are kept per endpoint.
+"""
+
+import atexit
+import glob
+import json
+import os
+import random
+import sys
+import threading
+from collections import Counter
+from time import time, sleep
+from flask import g, request
+
+MAX_DEPTH = 128                         # frames kept from the root of a stack
+OVERFLOW = '[other stacks]'             # where the samples of new stacks go once the limit is hit
+
+
+def control_path(path):
+    return os.path.join(path, 'control.json')
+
+
+def set_control(path, rate, endpoint=None, duration=300):
+    """
+    Switches profiling on for all processes, or off with a rate of 0
+    ----------------------------------------------------------------
+    Parameters:
+    path - PROFILE_DIR
+    rate - the share of requests that are profiled, from 0 to 1
+    endpoint - only profile requests to this endpoint, or None for all
+    duration - the number of seconds after which profiling stops
+    ----------------------------------------------------------------
+    Returns:
+    The control settings
+    """
+    control = {'rate': max(0.0, min(float(rate), 1.0)), 'endpoint': endpoint,
+               'started': time(), 'until': time() + duration}
+    os.makedirs(path, exist_ok=True)
+    tmp = control_path(path) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(control, f)
+    os.replace(tmp, control_path(path))
+    return control
+
+
+def get_control(path):
+    """
+    Returns: the control settings, or None if profiling is off
+    """
+    try:
+        with open(control_path(path)) as f:
+            control = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if control['rate'] <= 0 or control['until'] < time():
+        return None
+    return control
+
+
+class Profiler(object):
+    """
+    Samples the stacks of the profiled requests of a process
+    """
+
+    def __init__(self, path, interval=0.005, max_stacks=5000, write_interval=10):
+        self.path = path
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.write_interval = write_interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.active = {}                # thread id -> endpoint of the request being profiled
+        self.stacks = {}                # endpoint -> Counter of collapsed stacks
+        self.thread = None
+        self.pid = None
+        self.control = None
+        self.control_checked = 0.0
+        self.last_write = time()
+        atexit.register(self.write)
+
+    def should_profile(self, endpoint):
+        """
+        Decides if a request to an endpoint is profiled, the control file is read once a second
+        """
+        now = time()
+        if now - self.control_checked >= 1:
+            control = get_control(self.path)
+            if control and (self.control is None or
+                            control['started'] != self.control['started']):
+                with self.lock:
+                    self.stacks = {}        # a new profile was started
+            self.control = control
+            self.control_checked = now
+        control = self.control
+        if control is None or control['until'] < now:
+            return False
+        if control['endpoint'] and control['endpoint'] != endpoint:
+            return False
+        return random.random() < control['rate']
+
+    def start_request(self, endpoint):
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                # the sampler thread does not survive a fork
+                if self.pid is not None:
+                    self.stacks = {}
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.active[threading.get_ident()] = endpoint or ''
+            self.wakeup.set()
+
+    def end_request(self):
+        with self.lock:
+            self.active.pop(threading.get_ident(), None)
+            if not self.active:
+                self.wakeup.clear()
+        if time() - self.last_write >= self.write_interval:
+            self.write()
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            self.wakeup.wait()              # sleeps while no request is profiled
+            self.sample(exclude=me)
+            sleep(self.interval)
+
+    def sample(self, exclude=None):
+        """
+        Adds the current stacks of the profiled requests to the totals
+        """
+        frames = sys._current_frames()
+        with self.lock:
+            for ident, endpoint in self.active.items():
+                frame = frames.get(ident)
+                if frame is None or ident == exclude:
+                    continue
+                stack = collapse(frame)
+                counts = self.stacks.setdefault(endpoint, Counter())
+                if stack not in counts and len(counts) >= self.max_stacks:
+                    stack = OVERFLOW
+                counts[stack] += 1
+
+    def write(self):
+        """
+        Writes the totals of the process to PROFILE_DIR
+        """
+        with self.lock:
+            self.last_write = time()
+            if not self.stacks:
+                return
+            data = {endpoint: dict(counts) for endpoint, counts in self.stacks.items()}
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            filename = os.path.join(self.path, 'profile-{}.json'.format(os.getpid()))
+            with open(filename + '.tmp', 'w') as f:
+                json.dump(data, f)
+            os.replace(filename + '.tmp', filename)
+        except OSError:
+            pass
+
+
+def collapse(frame):
+    """
+    Returns: the stack of a frame as a string of semicolon separated functions, root first
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{} ({}:{})'.format(code.co_name, code.co_filename, code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names[-MAX_DEPTH:]))
+
+
+def collect(path):
+    """
+    Adds up the profiles written by all processes
+    Returns: a dictionary of endpoint -> Counter of collapsed stacks
+    """
+    totals = {}
+    for filename in glob.glob(os.path.join(path, 'profile-*.json')):
+        try:
+            with open(filename) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for endpoint, counts in data.items():
+            totals.setdefault(endpoint, Counter()).update(counts)
+    return totals
+
+
+def clear(path):
+    """
+    Deletes the profiles written by all processes
+    """
+    for filename in glob.glob(os.path.join(path, 'profile-*.json')):
+        os.remove(filename)
+
+
+def collapsed(counts):
+    """
+    Returns: the samples in the collapsed stack format, one 'stack count' line per stack
+    """
+    return ''.join('{} {}\n'.format(stack, count) for stack, count in counts.most_common())
+
+
+def speedscope(profiles):
+    """
+    Converts the samples of several endpoints to a speedscope profile, one profile per endpoint
+    See https://www.speedscope.app/file-format-schema.json
+    """
+    frames, index = [], {}
+    output = []
+    for endpoint, counts in sorted(profiles.items()):
+        samples, weights = [], []
+        for stack, count in counts.most_common():
+            sample = []
+            for name in stack.split(';'):
+                if name not in index:
+                    index[name] = len(frames)
+                    frames.append({'name': name})
+                sample.append(index[name])
+            samples.append(sample)
+            weights.append(count)
+        output.append({'type': 'sampled', 'name': endpoint or '(none)', 'unit': 'none',
+                       'startValue': 0, 'endValue': sum(weights),
+                       'samples': samples, 'weights': weights})
+    return {'$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'exporter': 'microblog', 'shared': {'frames': frames}, 'profiles': output}
+
+
+def init_app(app):
+    """
+    Installs the request hooks of the profiler, unless PROFILER is disabled
+    """
+    app.profiler = None
+    if not app.config['PROFILER']:
+        return
+    profiler = app.profiler = Profiler(app.config['PROFILE_DIR'],
+                                       app.config['PROFILE_INTERVAL'],
+                                       app.config['PROFILE_MAX_STACKS'])
+
+    @app.before_request
+    def start_profile():
+        if profiler.should_profile(request.endpoint):
+            profiler.start_request(request.endpoint)
+            g.profiling = True
+
+    @app.teardown_request
+    def end_profile(exc=None):
+        if g.pop('profiling', False):
+            profiler.end_request()
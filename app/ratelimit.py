@@ -0,0 +1,171 @@
+"""
+Rate limits requests with token buckets, so that one client cannot saturate the app.
+
+RATELIMITS sets the limits by endpoint, e.g. 'main.search', or by blueprint, e.g. 'api',
+as '<requests>/<period>' where the period is second, minute, hour or day. The bucket of a
+limit holds <requests> tokens, refills at <requests> per <period>, and every request takes
+a token. Buckets are chosen without a database query, so credentials are not checked yet:
+- every request takes a token from the bucket of its IP address
+- a request with a bearer token, or from a logged in browser session, then also takes one
+  from the bucket of the token or of the user id
+The IP bucket of requests with credentials holds RATELIMIT_IP_FACTOR times the limit, so
+that the users behind a shared address are not limited together, while made up tokens
+cannot get a client more than that. A request that finds a bucket empty is answered with
+429 Too Many Requests and a Retry-After header, before the view runs or the token is
+looked up.
+
+The IP address is request.remote_addr. Behind reverse proxies it is the address of the
+nearest proxy, set TRUSTED_PROXIES to the number of proxies in front of the app to take
+it from X-Forwarded-For instead - only if the proxies set that header, as clients can
+forge it otherwise.
+
+The buckets are kept in the store selected by RATELIMIT_STORAGE:
+- MemoryStore, in-process, each process then has its own buckets
+- RedisStore, at REDIS_URL, shared by all processes
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from math import ceil
+from time import time
+from flask import request, session, current_app
+from werkzeug.exceptions import TooManyRequests
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+def parse_limit(limit):
+    """
+    Parses a limit such as '100/minute'
+    Returns: a tuple (capacity of the bucket, tokens added per second)
+    """
+    count, period = limit.split('/')
+    return int(count), int(count) / PERIODS[period.strip()]
+
+
+class MemoryStore(object):
+    """
+    Keeps the buckets in the memory of the process, the least recently used are dropped
+    when there are more than max_entries
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.buckets = OrderedDict()            # key -> (tokens, time of the last update)
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        """
+        Takes a token from a bucket
+        ---------------------------
+        Returns:
+        A tuple (True if a token was taken, seconds until the next token)
+        """
+        now = time()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_entries:
+                self.buckets.popitem(last=False)
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+
+# takes a token from the bucket in KEYS[1] atomically, ARGV is capacity, rate and the time
+TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+class RedisStore(object):
+    """
+    Keeps the buckets in Redis, shared by all processes. A bucket expires once it would
+    be full again. If Redis cannot be reached, requests are let through
+    """
+
+    def __init__(self, client, prefix='ratelimit:'):
+        self.client = client
+        self.prefix = prefix
+        self.script = client.register_script(TAKE_SCRIPT)
+
+    def take(self, key, capacity, rate):
+        from redis.exceptions import RedisError
+        try:
+            allowed, tokens = self.script(keys=[self.prefix + key], args=[capacity, rate, time()])
+        except RedisError as e:
+            current_app.logger.warning('Rate limit store unavailable: %s', e)
+            return True, 0.0
+        return bool(allowed), 0.0 if allowed else (1 - float(tokens)) / rate
+
+
+def create_store(app):
+    """
+    Returns: the store selected by RATELIMIT_STORAGE
+    """
+    if app.config['RATELIMIT_STORAGE'] == 'redis':
+        from redis import Redis
+        return RedisStore(Redis.from_url(app.config['REDIS_URL']))
+    return MemoryStore()
+
+
+def credentials_key():
+    """
+    Returns: the key of the credentials of the request - the bearer token or the user id
+    of the session - or None if there are none
+    """
+    auth = request.headers.get('Authorization', '')
+    if auth.startswith('Bearer ') and auth[7:].strip():
+        return 'token:' + hashlib.sha1(auth[7:].strip().encode('utf-8')).hexdigest()
+    if session.get('_user_id'):
+        return 'user:' + session['_user_id']
+    return None
+
+
+def init_app(app):
+    """
+    Installs the rate limiting hook, unless RATELIMIT is disabled
+    """
+    app.ratelimit_store = None
+    if not app.config['RATELIMIT']:
+        return
+    store = app.ratelimit_store = create_store(app)
+    limits = {name: parse_limit(limit) for name, limit in app.config['RATELIMITS'].items()}
+    ip_factor = app.config['RATELIMIT_IP_FACTOR']
+
+    @app.before_request
+    def check_rate_limit():
+        name = request.endpoint if request.endpoint in limits else request.blueprint
+        if name not in limits:
+            return
+        capacity, rate = limits[name]
+        address = request.remote_addr or ''
+        credentials = credentials_key()
+        if credentials is None:
+            buckets = [('ip:' + address, capacity, rate)]
+        else:
+            buckets = [('ip+auth:' + address, capacity * ip_factor, rate * ip_factor),
+                       (credentials, capacity, rate)]
+        # the credentials bucket is only charged once the address bucket has let it through
+        for key, bucket_capacity, bucket_rate in buckets:
+            allowed, retry_after = store.take('{}:{}'.format(name, key),
+                                              bucket_capacity, bucket_rate)
+            if not allowed:
+                raise TooManyRequests(retry_after=int(ceil(retry_after)))
@@ -0,0 +1,217 @@
+"""
+Rebuilds a search index without downtime - used by the 'flask search reindex' command.
+
+A full reindex builds a fresh index next to the live one and then points the
+index name (an alias) at it in one atomic swap, so searches keep using the
+complete old index until the new one is ready:
+- the id range of the table is split between worker processes
+- each worker streams its rows with a server-side cursor and sends them to
+  the new index in bulk requests of SEARCH_REINDEX_CHUNK_SIZE rows
+- after every chunk the worker checkpoints the last id it sent, an
+  interrupted run started again picks up where each worker stopped
+- once the alias is swapped, rows that were created, changed or deleted while
+  the index was being built are caught up from the change log, which does not
+  depend on the timestamps clients give their posts
+
+An incremental reindex (since=...) sends the rows with a newer timestamp
+straight to the live index instead.
+"""
+
+import json
+import multiprocessing
+import os
+from datetime import datetime
+from time import time
+from flask import current_app
+from app import db, create_app
+from app.search import bulk_index
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_json(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def searchable_model(index):
+    """
+    Returns: the searchable model class stored in an index
+    """
+    from app.models import SearchOutbox
+    return SearchOutbox.searchable_models()[index]
+
+
+def index_rows(index, target, query, chunk_size, checkpoint=None):
+    """
+    Streams the rows of a query to the search index in bulk requests
+    ----------------------------------------------------------------
+    Parameters:
+    index - the name of the index the rows belong to
+    target - the name of the index to write to
+    query - the rows to index, ordered by id
+    chunk_size - the number of rows per bulk request
+    checkpoint - a file to save the last id sent after each chunk, or None
+    ----------------------------------------------------------------
+    Returns:
+    The number of rows indexed
+    """
+    count = 0
+    chunk = []
+
+    def send():
+        bulk_index([('index', target, obj) for obj in chunk])
+        if checkpoint:
+            _write_json(checkpoint, {'last_id': chunk[-1].id})
+
+    rows = query.yield_per(chunk_size).execution_options(stream_results=True)
+    for obj in rows:
+        chunk.append(obj)
+        if len(chunk) == chunk_size:
+            send()
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        send()
+        count += len(chunk)
+    return count
+
+
+def index_range(index, target, first_id, last_id, checkpoint, chunk_size):
+    """
+    Indexes the rows of a model with first_id <= id <= last_id, resuming after the
+    last id saved in the checkpoint file
+    """
+    model = searchable_model(index)
+    saved = _read_json(checkpoint)
+    if saved:
+        first_id = saved['last_id'] + 1
+    query = model.query.filter(model.id >= first_id).filter(
+        model.id <= last_id).order_by(model.id)
+    return index_rows(index, target, query, chunk_size, checkpoint)
+
+
+def _index_range_worker(args):
+    """
+    Runs index_range in a worker process with its own app and database connection
+    """
+    app = create_app()
+    with app.app_context():
+        return index_range(*args)
+
+
+def reindex_since(index, since, chunk_size=None):
+    """
+    Reindexes the rows with a timestamp at or after since into the live index
+    Returns: the number of rows indexed
+    """
+    model = searchable_model(index)
+    chunk_size = chunk_size or current_app.config['SEARCH_REINDEX_CHUNK_SIZE']
+    query = model.query.filter(model.timestamp >= since).order_by(model.id)
+    return index_rows(index, index, query, chunk_size)
+
+
+def reindex_changes(index, change_id, chunk_size=None):
+    """
+    Brings the live index up to date with the rows created, changed or deleted after a change
+    in the change log - see ChangeLog
+    Returns: the number of rows indexed or deleted
+    """
+    from app.models import ChangeLog
+    model = searchable_model(index)
+    chunk_size = chunk_size or current_app.config['SEARCH_REINDEX_CHUNK_SIZE']
+    ids = sorted(set(object_id for object_id, in db.session.query(ChangeLog.object_id).filter(
+        ChangeLog.resource == ChangeLog.RESOURCES[model]).filter(ChangeLog.id > change_id)))
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        objects = {obj.id: obj for obj in model.query.filter(model.id.in_(chunk))}
+        bulk_index([('index', index, objects[id]) if id in objects
+                    else ('delete', index, model(id=id)) for id in chunk])
+    return len(ids)
+
+
+def reindex(index, workers=4, chunk_size=None, restart=False, keep_old=False, log=print):
+    """
+    Rebuilds an index into a fresh index and swaps the alias over to it
+    --------------------------------------------------------------------
+    Parameters:
+    index - the name of the index (the alias searches use)
+    workers - the number of worker processes, 0 indexes in the current process
+    chunk_size - the number of rows per bulk request
+    restart - ignore the checkpoints of an interrupted run
+    keep_old - keep the index the alias pointed to before
+    log - called with progress messages
+    --------------------------------------------------------------------
+    Returns:
+    A tuple (number of rows indexed, throughput in docs/sec)
+    """
+    from app.models import ChangeLog
+    backend = current_app.search_backend
+    model = searchable_model(index)
+    chunk_size = chunk_size or current_app.config['SEARCH_REINDEX_CHUNK_SIZE']
+    state_dir = current_app.config['SEARCH_REINDEX_STATE_DIR']
+    os.makedirs(state_dir, exist_ok=True)
+    state_path = os.path.join(state_dir, 'reindex-{}.json'.format(index))
+    state = None if restart else _read_json(state_path)
+    if state is None:
+        first_id, last_id = db.session.query(db.func.min(model.id),
+                                             db.func.max(model.id)).one()
+        first_id, last_id = first_id or 1, last_id or 0
+        parts = max(workers, 1)
+        step = (last_id - first_id) // parts + 1
+        now = datetime.utcnow()
+        state = {
+            'target': '{}-{}'.format(index, now.strftime('%Y%m%d%H%M%S')),
+            'started': now.isoformat(),
+            # settled, so no change after it can commit before the build starts
+            'changes_after': ChangeLog.head(),
+            'ranges': [[first_id + i * step, min(first_id + (i + 1) * step - 1, last_id)]
+                       for i in range(parts)]
+        }
+        backend.create_index(state['target'])
+        for i in range(parts):
+            checkpoint = os.path.join(state_dir, 'reindex-{}-{}.json'.format(index, i))
+            if os.path.exists(checkpoint):
+                os.remove(checkpoint)
+        _write_json(state_path, state)
+        log('Building {} with {} worker(s)'.format(state['target'], workers))
+    else:
+        log('Resuming the build of {}'.format(state['target']))
+
+    jobs = [(index, state['target'], first_id, last_id,
+             os.path.join(state_dir, 'reindex-{}-{}.json'.format(index, i)), chunk_size)
+            for i, (first_id, last_id) in enumerate(state['ranges'])]
+    start = time()
+    if workers > 0:
+        # spawned workers create their own app and database connections
+        with multiprocessing.get_context('spawn').Pool(workers) as pool:
+            count = sum(pool.map(_index_range_worker, jobs))
+    else:
+        count = sum(index_range(*job) for job in jobs)
+
+    old = backend.swap_alias(index, state['target'])
+    log('{} now points to {}'.format(index, state['target']))
+    if not keep_old:
+        for name in old:
+            backend.delete_index(name)
+    # catch up with the rows that changed while the new index was being built
+    count += reindex_changes(index, state['changes_after'], chunk_size)
+    if current_app.search_cache is not None:
+        current_app.search_cache.bump(index)
+
+    for job in jobs:
+        if os.path.exists(job[4]):
+            os.remove(job[4])
+    os.remove(state_path)
+    elapsed = time() - start
+    rate = count / elapsed if elapsed else 0.0
+    log('Indexed {} rows in {:.1f}s ({:.0f} docs/sec)'.format(count, elapsed, rate))
+    return count, rate
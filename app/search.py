@@ -1,8 +1,215 @@
 """
-Provides support for searching posts with ElasticSearch
+Provides support for searching posts.
+
+The functions in this module work with the search backend created for the app:
+- ElasticsearchBackend, used when ELASTICSEARCH_URL is set
+- LocalSearchBackend, an embedded index stored under SEARCH_INDEX_DIR - see localsearch.py
+
+A backend is any object with the methods:
+bulk(operations) - applies a list of (operation, index, id, document) tuples, where operation
+                   is 'index' to add or replace a document, or 'delete' to remove it, and
+                   returns the (index, id, status) of the operations that failed
+query(index, query, page, per_page) - returns a tuple (list of ids, number of search hits)
+query_after(index, query, state, per_page) - returns a tuple (list of ids, number of search hits,
+                   state of the next page or None), see query_index_after
+create_index(index), delete_index(index) and swap_alias(alias, index) - used by the
+                   'flask search reindex' command to rebuild an index behind an alias
 """
 
+import base64
+import json
+import threading
+from collections import OrderedDict
+from time import time
 from flask import current_app
+from app.pagination import InvalidCursor
+from app.metrics import timed
+
+
+class ElasticsearchBackend(object):
+    """
+    Search backend using an ElasticSearch cluster
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def bulk(self, operations):
+        """
+        Returns: the (index, id, HTTP status) of the operations the cluster rejected,
+        e.g. status 429 when its write queue is full
+        """
+        body = []
+        for operation, index, id, document in operations:
+            body.append({operation: {'_index': index, '_id': id}})
+            if operation == 'index':
+                body.append(document)
+        with timed('elasticsearch'):
+            response = self.client.bulk(body=body)
+        if not response.get('errors'):
+            return []
+        failed, errors = [], []
+        # the items of the response are in the order of the operations
+        for (operation, index, id, document), item in zip(operations, response['items']):
+            result = list(item.values())[0]
+            if result.get('error'):
+                failed.append((index, id, result.get('status')))
+                errors.append(result['error'])
+        current_app.logger.warning('Bulk indexing failed for %d of %d operations: %s',
+                                   len(failed), len(operations), errors[:5])
+        return failed
+
+    def create_index(self, index):
+        self.client.indices.create(index=index)
+
+    def delete_index(self, index):
+        self.client.indices.delete(index=index, ignore_unavailable=True)
+
+    def swap_alias(self, alias, index):
+        """
+        Points an alias at an index in one atomic update, replacing an index that has the alias' name
+        Returns: the names of the indexes the alias pointed to before
+        """
+        actions = [{'add': {'index': index, 'alias': alias}}]
+        old = []
+        if self.client.indices.exists_alias(name=alias):
+            old = [name for name in self.client.indices.get_alias(name=alias) if name != index]
+            actions += [{'remove': {'index': name, 'alias': alias}} for name in old]
+        elif self.client.indices.exists(index=alias):
+            actions.append({'remove_index': {'index': alias}})
+        self.client.indices.update_aliases(body={'actions': actions})
+        return old
+
+    def query(self, index, query, page, per_page):
+        with timed('elasticsearch'):
+            search = self.client.search(
+                index=index,
+                body={'query':{'multi_match':{'query': query, 'fields':['*']}},
+                      'from': (page - 1) * per_page, 'size': per_page})
+        ids = [int(hit['_id']) for hit in search['hits']['hits']]
+        return ids, search['hits']['total']['value']
+
+    def query_after(self, index, query, state, per_page):
+        """
+        Pages through a point-in-time view of the index with search_after.
+        The point in time is opened for the first page and closed after the last one.
+        The _shard_doc tiebreaker needs ElasticSearch 7.12 or later.
+        """
+        keep_alive = current_app.config['SEARCH_PIT_KEEP_ALIVE']
+        pit = state.get('pit') or \
+            self.client.open_point_in_time(index=index, keep_alive=keep_alive)['id']
+        body = {'query': {'multi_match': {'query': query, 'fields': ['*']}},
+                'size': per_page,
+                'pit': {'id': pit, 'keep_alive': keep_alive},
+                'sort': [{'_score': 'desc'}, {'_shard_doc': 'desc'}]}
+        if 'after' in state:
+            body['search_after'] = state['after']
+        elif state.get('offset'):
+            body['from'] = state['offset']
+        if 'total' in state:
+            body['track_total_hits'] = False
+        with timed('elasticsearch'):
+            search = self.client.search(body=body)
+        hits = search['hits']['hits']
+        total = state['total'] if 'total' in state else search['hits']['total']['value']
+        pit = search.get('pit_id', pit)
+        if len(hits) < per_page:
+            self.client.close_point_in_time(body={'id': pit})
+            next_state = None
+        else:
+            next_state = {'pit': pit, 'after': hits[-1]['sort'], 'total': total}
+        return [int(hit['_id']) for hit in hits], total, next_state
+
+
+class SearchCache(object):
+    """
+    Caches the ranked list of ids for a search, so later pages of the same search are
+    served without querying the index again.
+    Entries are dropped when they are older than ttl seconds, when there are more than
+    max_entries (least recently used first), or when the generation of their index changes.
+    The generation of an index is bumped every time a commit changes a searchable object.
+    Generations are kept per process, the ttl bounds how long other processes serve stale results.
+    """
+
+    def __init__(self, max_entries, ttl, depth):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.depth = depth                  # number of ids fetched and cached per search
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(query):
+        return ' '.join(query.lower().split())
+
+    def bump(self, index):
+        """
+        Invalidates all cached searches of an index
+        """
+        with self.lock:
+            self.generations[index] = self.generations.get(index, 0) + 1
+
+    def get(self, index, query):
+        """
+        Returns: a tuple (list of ids, number of search hits), or None if the search is not cached
+        """
+        key = (index, self.normalize(query))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != self.generations.get(index, 0) or \
+                    entry[1] < time() - self.ttl:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2], entry[3]
+
+    def put(self, index, query, ids, total, generation):
+        """
+        Caches a search, unless its index has changed since generation was read
+        """
+        key = (index, self.normalize(query))
+        with self.lock:
+            if generation != self.generations.get(index, 0):
+                return
+            self.entries[key] = (generation, time(), ids, total)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def generation(self, index):
+        with self.lock:
+            return self.generations.get(index, 0)
+
+    def stats(self):
+        """
+        Returns: a dictionary of cache statistics
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+def create_backend(app):
+    """
+    Creates the search backend selected by SEARCH_BACKEND
+    ------------------------------------------------------
+    Returns:
+    The backend, or None if search is disabled
+    """
+    backend = app.config['SEARCH_BACKEND']
+    if backend == 'elasticsearch' and app.elasticsearch:
+        return ElasticsearchBackend(app.elasticsearch)
+    if backend == 'local':
+        from app.localsearch import LocalSearchBackend
+        return LocalSearchBackend(app.config['SEARCH_INDEX_DIR'],
+                                  merge_factor=app.config['SEARCH_MERGE_FACTOR'])
+    return None
 
 
 def add_to_index(index, model):
@@ -10,15 +217,10 @@ def add_to_index(index, model):
     Adds entries to a full-text index
     ---------------------------------
     Parameters:
-    index - an index in ElasticSearch
+    index - the name of the index
     model - SQLAlchamy model
     """
-    if not current_app.elasticsearch:
-        return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    bulk_index([('index', index, model)])
 
 
 def remove_from_index(index, model):
@@ -26,12 +228,32 @@ def remove_from_index(index, model):
     Removes entries from the index
     ------------------------------
     Parameters:
-    index - an index in ElasticSearch
+    index - the name of the index
     model - SQLAlchamy model
     """
-    if not current_app.elasticsearch:
-        return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    bulk_index([('delete', index, model)])
+
+
+def bulk_index(actions):
+    """
+    Sends a batch of index and delete operations to the index in one request
+    ------------------------------------------------------------------------
+    Parameters:
+    actions - a list of (operation, index, model) tuples, where operation is
+              'index' to add or update the model's entry, or 'delete' to remove it
+    ------------------------------------------------------------------------
+    Returns:
+    The (index, id, HTTP status) of the operations that failed
+    """
+    if not current_app.search_backend or not actions:
+        return []
+    operations = []
+    for operation, index, model in actions:
+        document = None
+        if operation == 'index':
+            document = {field: getattr(model, field) for field in model.__searchable__}
+        operations.append((operation, index, model.id, document))
+    return current_app.search_backend.bulk(operations)
 
 
 def query_index(index, query, page, per_page):
@@ -39,7 +261,7 @@ def query_index(index, query, page, per_page):
     Search the index for a given string.
     ------------------------------------
     Parameters:
-    index - an index in ElasticSearch
+    index - the name of the index
     query - the text string to search for
     page - the current page
     per_page - the number of results to include per page
@@ -48,11 +270,92 @@ def query_index(index, query, page, per_page):
     The search results within the pagination limits, this is
     a tuple (list of ids, number of search hits).
     """
-    if not current_app.elasticsearch:
+    if not current_app.search_backend:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={'query':{'multi_match':{'query': query, 'fields':['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
\ No newline at end of file
+    return current_app.search_backend.query(index, query, page, per_page)
+
+
+def cached_query_index(index, query, page, per_page):
+    """
+    Same as query_index, but the first SEARCH_CACHE_DEPTH results of a search are fetched
+    at once and cached, and pages within them are served from the cache - see SearchCache
+    """
+    cache = current_app.search_cache
+    if cache is None or page * per_page > cache.depth:
+        return query_index(index, query, page, per_page)
+    cached = cache.get(index, query)
+    if cached is None:
+        generation = cache.generation(index)
+        cached = query_index(index, query, 1, cache.depth)
+        cache.put(index, query, cached[0], cached[1], generation)
+    ids, total = cached
+    return ids[(page - 1) * per_page:page * per_page], total
+
+
+def encode_search_cursor(state):
+    """
+    Encodes the paging state of a search as an opaque cursor
+    """
+    data = json.dumps(state).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('utf-8').rstrip('=')
+
+
+def decode_search_cursor(cursor):
+    """
+    Decodes a cursor created by encode_search_cursor, checking the type of each part of
+    the state, as the backends pass them on to the index
+    """
+    try:
+        state = json.loads(base64.urlsafe_b64decode(
+            (cursor + '=' * (-len(cursor) % 4)).encode('utf-8')))
+    except ValueError:
+        raise InvalidCursor(cursor)
+    if not isinstance(state, dict) or \
+            ('after' in state and not _is_after(state['after'])) or \
+            ('offset' in state and not (_is_int(state['offset']) and state['offset'] >= 0)) or \
+            ('total' in state and not (_is_int(state['total']) and state['total'] >= 0)) or \
+            ('pit' in state and not isinstance(state['pit'], str)):
+        raise InvalidCursor(cursor)
+    return state
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_after(value):
+    # the (score, id) of the last hit, or its sort values with a point in time
+    return isinstance(value, list) and len(value) == 2 and _is_int(value[1]) and \
+        (_is_int(value[0]) or isinstance(value[0], float))
+
+
+def query_index_after(index, query, cursor, per_page):
+    """
+    Search the index for a given string, paging with a cursor instead of a page number.
+    Unlike query_index, the cost of a page does not grow with its depth.
+    -----------------------------------------------------------------------------------
+    Parameters:
+    index - the name of the index
+    query - the text string to search for
+    cursor - the cursor returned with the previous page, or None for the first page.
+             search_cursor creates a cursor starting at a given offset
+    per_page - the number of results to include per page
+    -----------------------------------------------------------------------------------
+    Returns:
+    A tuple (list of ids, number of search hits, cursor of the next page or None)
+    """
+    if not current_app.search_backend:
+        return [], 0, None
+    state = decode_search_cursor(cursor) if cursor else {}
+    ids, total, next_state = current_app.search_backend.query_after(
+        index, query, state, per_page)
+    if next_state is not None:
+        next_state['total'] = total
+    return ids, total, encode_search_cursor(next_state) if next_state else None
+
+
+def search_cursor(offset):
+    """
+    Returns: a cursor for query_index_after starting after the first offset results
+    """
+    return encode_search_cursor({'offset': offset})
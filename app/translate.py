@@ -7,6 +7,7 @@ import json
 import requests
 from flask_babel import _
 from flask import current_app
+from app.metrics import timed
 
 def translate(text, source_language, dest_language):
     """
@@ -24,11 +25,12 @@ def translate(text, source_language, dest_language):
         'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY'],
         'Ocp-Apim-Subscription-Region': 'westeurope'
     }
-    r = requests.post(
-        'https://api.cognitive.microsofttranslator.com/'
-        '/translate?api-version=3.0&from={}&to={}'.format(
-            source_language, dest_language), headers = auth, json=[{'Text': text}]
-    )
+    with timed('translator'):
+        r = requests.post(
+            'https://api.cognitive.microsofttranslator.com/'
+            '/translate?api-version=3.0&from={}&to={}'.format(
+                source_language, dest_language), headers = auth, json=[{'Text': text}]
+        )
     if r.status_code != 200:
         return _('Error: the translation service faied.')
     return r.json()[0]['translations'][0]['text']
\ No newline at end of file
@@ -18,7 +18,99 @@ class Config(object):
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = os.environ.get('ADMINS')
     POSTS_PER_PAGE = 25
+    # Page listings with opaque (timestamp, id) cursors unless a page number is requested
+    CURSOR_PAGINATION = (os.environ.get('CURSOR_PAGINATION') or '1') != '0'
+    # Changes kept for /api/changes, clients that sync less often have to export everything again
+    CHANGES_RETENTION_DAYS = int(os.environ.get('CHANGES_RETENTION_DAYS') or 30)
+    CHANGES_BATCH_SIZE = int(os.environ.get('CHANGES_BATCH_SIZE') or 500)
+    # Changes are only sent once they are older than this, it must be longer than any write
+    # transaction as transactions can commit out of the order of their changes' ids
+    CHANGES_SETTLE_SECONDS = int(os.environ.get('CHANGES_SETTLE_SECONDS') or 10)
+    # Most posts that can be created with one request to /api/posts/batch
+    POSTS_BATCH_SIZE = int(os.environ.get('POSTS_BATCH_SIZE') or 500)
+    # Most user ids that can be followed or unfollowed with one request to the API
+    FOLLOW_BATCH_SIZE = int(os.environ.get('FOLLOW_BATCH_SIZE') or 500)
+    # Rows read per batch by the streaming exports of the API
+    EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE') or 1000)
     LANGUAGES = ['en', 'es']
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
 
-    ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
\ No newline at end of file
+    ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    # 'elasticsearch', or 'local' for the embedded index stored in SEARCH_INDEX_DIR
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or \
+        ('elasticsearch' if ELASTICSEARCH_URL else 'local')
+    SEARCH_INDEX_DIR = os.environ.get('SEARCH_INDEX_DIR') or os.path.join(basedir, 'search_index')
+    # Number of similar sized segments of the local index that are merged together
+    SEARCH_MERGE_FACTOR = int(os.environ.get('SEARCH_MERGE_FACTOR') or 10)
+    # 'inline' sends changes to the search index after each commit, 'outbox' records them
+    # in the search_outbox table for the 'flask search worker' process to send
+    SEARCH_SYNC = os.environ.get('SEARCH_SYNC') or 'inline'
+    SEARCH_OUTBOX_BATCH_SIZE = int(os.environ.get('SEARCH_OUTBOX_BATCH_SIZE') or 500)
+    SEARCH_OUTBOX_BACKOFF = 1           # seconds, doubled on every failed attempt
+    SEARCH_OUTBOX_MAX_BACKOFF = 300
+    # Cache of ranked search results, SEARCH_CACHE_SIZE = 0 disables it
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 1000)
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 60)            # seconds
+    SEARCH_CACHE_DEPTH = int(os.environ.get('SEARCH_CACHE_DEPTH') or 250)       # ids per search
+    # How long ElasticSearch keeps a point in time open between pages of a search
+    SEARCH_PIT_KEEP_ALIVE = os.environ.get('SEARCH_PIT_KEEP_ALIVE') or '5m'
+    # Number of rows sent to the search index per bulk request by reindex
+    SEARCH_REINDEX_CHUNK_SIZE = int(os.environ.get('SEARCH_REINDEX_CHUNK_SIZE') or 500)
+    # Where 'flask search reindex' keeps its checkpoints
+    SEARCH_REINDEX_STATE_DIR = os.environ.get('SEARCH_REINDEX_STATE_DIR') or \
+        os.path.join(basedir, 'reindex')
+
+    # Time the database queries and templates of each request, see instrument.py
+    REQUEST_INSTRUMENTATION = (os.environ.get('REQUEST_INSTRUMENTATION') or '0') != '0'
+    SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS') or 500)
+    SLOW_REQUEST_QUERIES = int(os.environ.get('SLOW_REQUEST_QUERIES') or 50)
+    # Collect request, database and service metrics for /metrics, see metrics.py
+    METRICS = (os.environ.get('METRICS') or '0') != '0'
+    # Directory shared by the worker processes to add up their metrics, unset for a single process
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_WRITE_INTERVAL = int(os.environ.get('METRICS_WRITE_INTERVAL') or 1)     # seconds
+    # Sampling profiler, switched on at runtime with 'flask profile start', see profiler.py
+    PROFILER = (os.environ.get('PROFILER') or '1') != '0'
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(basedir, 'profiles')
+    PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL') or 0.005)         # seconds
+    PROFILE_MAX_STACKS = int(os.environ.get('PROFILE_MAX_STACKS') or 5000)      # per endpoint
+    # Cache of the users looked up by session and token, IDENTITY_CACHE_SIZE = 0 disables it
+    IDENTITY_CACHE_SIZE = int(os.environ.get('IDENTITY_CACHE_SIZE') or 10000)
+    IDENTITY_CACHE_TTL = int(os.environ.get('IDENTITY_CACHE_TTL') or 30)      # seconds
+    # Buffer the last_seen time of users in memory and write it in batches, see activity.py
+    LAST_SEEN_BUFFER = (os.environ.get('LAST_SEEN_BUFFER') or '1') != '0'
+    LAST_SEEN_GRANULARITY = int(os.environ.get('LAST_SEEN_GRANULARITY') or 60)        # seconds
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 10)  # seconds
+    REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
+    # Broker used to push notifications to open pages, by default pages poll for them.
+    # Every open page holds a worker while it streams, so only set this when the app is served
+    # by threaded or async workers - 'local' for a single process, 'redis' for several
+    NOTIFICATION_BROKER = os.environ.get('NOTIFICATION_BROKER') or 'none'
+    # Seconds a notification stream is held open before the client reconnects
+    NOTIFICATION_STREAM_TIMEOUT = int(os.environ.get('NOTIFICATION_STREAM_TIMEOUT') or 30)
+
+    # Number of reverse proxies in front of the app, whose X-Forwarded-* headers are trusted
+    # for the client address and scheme. Leave it at 0 when clients connect directly
+    TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES') or 0)
+
+    # Token bucket rate limits, see ratelimit.py - 'memory' keeps the buckets in each process,
+    # 'redis' shares them between processes
+    RATELIMIT = (os.environ.get('RATELIMIT') or '1') != '0'
+    RATELIMIT_STORAGE = os.environ.get('RATELIMIT_STORAGE') or 'memory'
+    # Requests with credentials share a bucket per IP address this many times the limit
+    RATELIMIT_IP_FACTOR = int(os.environ.get('RATELIMIT_IP_FACTOR') or 4)
+    # '<requests>/<second|minute|hour|day>' by endpoint or blueprint, the endpoint wins
+    RATELIMITS = {
+        'api': '600/minute',
+        'api.get_token': '10/minute',
+        'main.translate_text': '30/minute',
+        'main.search': '60/minute'
+    }
+
+    # Home timeline strategy - 'read' joins the followers table on every request,
+    # 'write' pushes new posts into a precomputed timeline for each follower
+    TIMELINE_FANOUT = os.environ.get('TIMELINE_FANOUT') or 'read'
+    # Authors with more followers than this are not fanned out, their posts are merged in on read
+    TIMELINE_FANOUT_THRESHOLD = int(os.environ.get('TIMELINE_FANOUT_THRESHOLD') or 10000)
+    # Max number of posts backfilled into a timeline on follow, or kept by a rebuild
+    TIMELINE_LENGTH = int(os.environ.get('TIMELINE_LENGTH') or 800)
\ No newline at end of file
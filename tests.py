@@ -1,28 +1,63 @@
+import base64
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+import json
+import os
+import shutil
+import tempfile
+import time
 import unittest
-from app import db, create_app
-from app.models import User, Post
+from unittest import mock
+from app import cli, db, create_app
+from app.models import User, Post, Message, TimelineEntry, SearchOutbox, ChangeLog
+from app.pagination import paginate_keyset, InvalidCursor, encode_cursor
+from app.search import ElasticsearchBackend, query_index, search_cursor, encode_search_cursor
+from app.localsearch import LocalSearchBackend
+from app.notify import user_channel
+from app.metrics import timed
+from app.ratelimit import MemoryStore, parse_limit
+from app.profiler import collect as collect_profiles, collapsed, speedscope
+from app.reindex import reindex, reindex_since
 from config import Config
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SEARCH_BACKEND = None
 
 
-class UserModelCase(unittest.TestCase):
+# directories written by the tests, each test removes the ones it used
+TEST_DIR = tempfile.mkdtemp()
+
+
+def tearDownModule():
+    shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+
+class AppTestCase(unittest.TestCase):
+    """
+    Runs each test in a new app created from config, with an empty database
+    """
+    config = TestConfig
 
     def setUp(self):
-        self.app = create_app(TestConfig)
+        self.app = create_app(self.config)
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
+        self.client = self.app.test_client()
 
     def tearDown(self):
+        if self.app.last_seen is not None:
+            self.app.last_seen.close()
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
 
+
+class UserModelCase(AppTestCase):
+
     def test_password_hashing(self):
         u = User(username='susan')
         u.set_password('cat')
@@ -89,5 +124,1201 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p4, p3])
         self.assertEqual(f4, [p4])
 
+
+    def test_following_ids(self):
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i))
+                 for i in range(4)]
+        db.session.add_all(users)
+        db.session.commit()
+        u1, u2, u3, u4 = users
+        u1.follow(u2)
+        u1.follow(u4)
+        db.session.commit()
+        self.assertEqual(u1.following_ids([u2, u3, u4.id]), {u2.id, u4.id})
+
+        with self.app.test_request_context():
+            self.assertEqual(u1.following_ids(users), {u2.id, u4.id})
+            # later checks are answered from the per-request cache
+            u1.unfollow(u4)
+            db.session.commit()
+            self.assertFalse(u1.is_following(u4))
+            self.assertTrue(u1.is_following(u2))
+            self.assertEqual(u1.following_ids(users), {u2.id})
+        self.assertEqual(u1.followed.all(), [u2])
+
+    def test_counters(self):
+        u1 = User(username='john', email='john@john.com')
+        u2 = User(username='susan', email='susan@susan.com')
+        u3 = User(username='bob', email='bob@bob.com')
+        db.session.add_all([u1, u2, u3, Post(body='post from susan', author=u2)])
+        db.session.commit()
+        self.assertEqual((u1.post_count, u2.post_count), (0, 1))
+
+        u1.follow(u2)
+        u3.follow(u2)
+        u1.follow(u3)
+        db.session.add(Post(body='another post from susan', user_id=u2.id))
+        db.session.commit()
+        self.assertEqual(u2.post_count, 2)
+        self.assertEqual((u1.followed_count, u2.follower_count, u3.follower_count), (2, 2, 1))
+
+        u3.unfollow(u2)
+        db.session.delete(u2.posts.first())
+        db.session.commit()
+        self.assertEqual((u2.follower_count, u3.followed_count, u2.post_count), (1, 0, 1))
+
+        # counters that drift are repaired in bulk
+        db.session.execute(User.__table__.update().values(follower_count=7))
+        db.session.commit()
+        self.assertEqual(User.repair_counters(), 3)
+        db.session.commit()
+        self.assertEqual([u.follower_count for u in (u1, u2, u3)], [0, 1, 1])
+        self.assertEqual(User.repair_counters(), 0)
+
+    def test_unread_messages(self):
+        u1 = User(username='john', email='john@john.com')
+        u2 = User(username='susan', email='susan@susan.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        for i in range(3):
+            db.session.add(Message(author=u1, recipient=u2, body='message {}'.format(i)))
+            u2.add_notification('unread_message_count', u2.new_messages())
+            db.session.commit()
+        self.assertEqual(u2.unread_message_count, 3)
+        self.assertEqual([n.get_data() for n in u2.notifications], [3])
+
+        u2.read_messages()
+        db.session.add(Message(author=u2, recipient=u1, recipient_id=u1.id, body='reply'))
+        db.session.commit()
+        self.assertEqual((u1.unread_message_count, u2.unread_message_count), (1, 0))
+        self.assertEqual([n.get_data() for n in u2.notifications], [0])
+
+        # existing messages are counted by the repair
+        db.session.execute(User.__table__.update().values(unread_message_count=0))
+        db.session.commit()
+        self.assertEqual(User.repair_counters(), 1)
+        db.session.commit()
+        self.assertEqual(u1.unread_message_count, 1)
+
+    def test_keyset_pagination(self):
+        u1 = User(username='john', email='john@john.com')
+        u2 = User(username='susan', email='susan@susan.com')
+        db.session.add_all([u1, u2])
+        now = datetime.utcnow()
+        # posts 2 and 3 share a timestamp, the id breaks the tie
+        posts = [Post(body='post {}'.format(i), author=u2 if i % 2 else u1,
+                      timestamp=now + timedelta(seconds=min(i, 2))) for i in range(5)]
+        db.session.add_all(posts)
+        u1.follow(u2)
+        db.session.commit()
+        expected = sorted(u1.followed_posts().all(),
+                          key=lambda p: (p.timestamp, p.id), reverse=True)
+        self.assertEqual(len(expected), 5)
+
+        key = [Post.timestamp, Post.id]
+        page1 = paginate_keyset(u1.followed_posts(), key, None, 2)
+        self.assertEqual(page1.items, expected[:2])
+        self.assertFalse(page1.has_prev)
+        page2 = paginate_keyset(u1.followed_posts(), key, page1.next_cursor, 2)
+        self.assertEqual(page2.items, expected[2:4])
+        page3 = paginate_keyset(u1.followed_posts(), key, page2.next_cursor, 2, count=True)
+        self.assertEqual(page3.items, expected[4:])
+        self.assertFalse(page3.has_next)
+        self.assertEqual(page3.total, 5)
+        back = paginate_keyset(u1.followed_posts(), key, page3.prev_cursor, 2)
+        self.assertEqual(back.items, expected[2:4])
+        self.assertTrue(back.has_prev)
+        self.assertIsNone(page2.total)
+        for cursor in ['not-a-cursor', encode_cursor([[1], 1], 'next'),
+                       encode_cursor(['2020-01-01T00:00:00', {'a': 1}], 'next'),
+                       encode_cursor(['2020-01-01T00:00:00', True], 'next')]:
+            with self.assertRaises(InvalidCursor):
+                paginate_keyset(u1.followed_posts(), key, cursor, 2)
+
+
+class PageConfig(TestConfig):
+    WTF_CSRF_ENABLED = False
+
+
+class PageRenderCase(AppTestCase):
+    """
+    Renders pages with the test client while keeping an eye on the number of queries
+    """
+    config = PageConfig
+
+    def login(self, user):
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+
+    @contextmanager
+    def assert_max_queries(self, budget):
+        """
+        Fails the test if the block runs more than budget SQL statements
+        """
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            yield statements
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertLessEqual(len(statements), budget,
+                             'query budget exceeded:\n' + '\n'.join(statements))
+
+    def test_post_list_query_budget(self):
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i))
+                 for i in range(10)]
+        db.session.add_all(users)
+        db.session.add_all([Post(body='post {}'.format(i), author=u)
+                            for i, u in enumerate(users)])
+        for u in users[1:]:
+            users[0].follow(u)
+        db.session.commit()
+        self.login(users[0])
+
+        # the budgets do not depend on the number of authors on the page
+        for url, budget in [('/index', 7), ('/explore', 7), ('/user/user1', 7)]:
+            with self.assert_max_queries(budget):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'post 1', response.data)
+
+    def test_last_seen_buffer(self):
+        u1 = User(username='john', email='john@john.com')
+        u2 = User(username='susan', email='susan@susan.com', last_seen=datetime(2030, 1, 1))
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        seen = u1.last_seen
+        self.login(u1)
+        with self.assert_max_queries(6) as statements:
+            self.client.get('/explore')
+        self.assertFalse([s for s in statements if s.startswith('UPDATE')])
+
+        buffer = self.app.last_seen
+        now = datetime.utcnow()
+        self.assertFalse(buffer.record(u1.id, now))       # within the granularity of the request
+        self.assertTrue(buffer.record(u2.id, now))
+        self.assertEqual(buffer.flush(), 2)
+        db.session.expire_all()
+        self.assertGreater(u1.last_seen, seen)
+        # last_seen never moves backwards
+        self.assertEqual(u2.last_seen, datetime(2030, 1, 1))
+        self.assertEqual(buffer.flush(), 0)
+
+        # a batch that cannot be written is kept for the next flush
+        later = datetime.utcnow() + timedelta(minutes=1)
+        buffer.record(u1.id, later)
+        with mock.patch.object(db, 'get_engine', side_effect=RuntimeError('unavailable')), \
+                self.assertLogs(self.app.logger, 'ERROR'):
+            self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(buffer.flush(), 1)
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, later)
+
+
+    def test_identity_cache(self):
+        u = User(username='john', email='john@john.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        auth = 'Basic ' + base64.b64encode(b'john:cat').decode('utf-8')
+        token = self.client.post('/api/tokens', headers={'Authorization': auth}).json['token']
+        headers = {'Authorization': 'Bearer ' + token}
+        url = '/api/users/{}'.format(u.id)
+        self.assertEqual(self.client.get(url, headers=headers).status_code, 200)
+
+        # a warm request authenticates without querying the database
+        db.session.remove()
+        with self.assert_max_queries(0):
+            response = self.client.get(url, headers=headers)
+        self.assertEqual(response.json['username'], 'john')
+        self.assertGreater(self.app.identity_cache.stats()['hits'], 0)
+
+        db.session.remove()
+        self.assertEqual(self.client.delete('/api/tokens', headers=headers).status_code, 204)
+        db.session.remove()
+        self.assertEqual(self.client.get(url, headers=headers).status_code, 401)
+
+    def test_conditional_get(self):
+        u1 = User(username='john', email='john@john.com')
+        u2 = User(username='susan', email='susan@susan.com')
+        u1.get_token()
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        headers = {'Authorization': 'Bearer ' + u1.token}
+        url = '/api/users/{}'.format(u2.id)
+        response = self.client.get(url, headers=headers)
+        etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+
+        response = self.client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual((response.status_code, response.data), (304, b''))
+        self.assertEqual(response.headers['ETag'], etag)
+        response = self.client.get(url, headers=dict(headers, **{'If-None-Match': 'W/' + etag}))
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, headers=dict(headers, **{'If-Modified-Since': last_modified}))
+        self.assertEqual(response.status_code, 304)
+
+        pages = {}
+        for query in ['', '?page=1']:
+            response = self.client.get('/api/users' + query, headers=headers)
+            pages[query] = response.headers['ETag']
+            response = self.client.get('/api/users' + query,
+                                       headers=dict(headers, **{'If-None-Match': pages[query]}))
+            self.assertEqual(response.status_code, 304)
+
+        # a new follower changes the user's counters, and so the user and the pages
+        u1.follow(u2)
+        db.session.commit()
+        response = self.client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        for query, page_etag in pages.items():
+            response = self.client.get('/api/users' + query,
+                                       headers=dict(headers, **{'If-None-Match': page_etag}))
+            self.assertEqual(response.status_code, 200)
+
+
+    def test_user_batch(self):
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i))
+                 for i in range(3)]
+        users[0].get_token()
+        db.session.add_all(users)
+        db.session.commit()
+        headers = {'Authorization': 'Bearer ' + users[0].token}
+        ids = '{},999,{}'.format(users[2].id, users[1].id)
+        # the token lookup and a single query for all of the users
+        with self.assert_max_queries(2):
+            response = self.client.get('/api/users?ids={}&fields=username,follower_count'.format(ids),
+                                       headers=headers)
+        self.assertEqual(response.json['items'], [
+            {'id': users[2].id, 'username': 'user2', 'follower_count': 0},
+            {'id': users[1].id, 'username': 'user1', 'follower_count': 0}])
+        self.assertEqual(response.json['_meta']['missing'], [999])
+
+        response = self.client.get('/api/users?per_page=1&fields=_links', headers=headers)
+        self.assertEqual(set(response.json['items'][0]), {'id', '_links'})
+        self.assertIn('fields=_links', response.json['_links']['next'])
+        response = self.client.get('/api/users/{}?fields=email'.format(users[1].id),
+                                   headers=headers)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['message'], 'unknown fields: email')
+        self.assertEqual(self.client.get('/api/users?ids=1,x', headers=headers).status_code, 400)
+
+    def test_export(self):
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i))
+                 for i in range(3)]
+        users[0].get_token()
+        db.session.add_all(users)
+        db.session.commit()
+        users[0].follow(users[1])
+        users[0].follow(users[2])
+        users[2].follow(users[1])
+        db.session.add_all([Post(body='post {}'.format(i), author=users[i % 3]) for i in range(4)])
+        db.session.commit()
+        headers = {'Authorization': 'Bearer ' + users[0].token}
+
+        def export(url):
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+        lines = export('/api/export/users?fields=username')
+        self.assertEqual([line['username'] for line in lines], ['user0', 'user1', 'user2'])
+        lines = export('/api/export/users?after={}'.format(users[1].id))
+        self.assertEqual([line['id'] for line in lines], [users[2].id])
+        lines = export('/api/export/posts?after=2')
+        self.assertEqual([line['body'] for line in lines], ['post 2', 'post 3'])
+        self.assertEqual(lines[0]['user_id'], users[2].id)
+        lines = export('/api/export/followers?after={},{}'.format(users[0].id, users[1].id))
+        self.assertEqual([(line['follower_id'], line['followed_id']) for line in lines],
+                         [(users[0].id, users[2].id), (users[2].id, users[1].id)])
+        response = self.client.get('/api/export/followers?after=1', headers=headers)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get('/api/export/posts').status_code, 401)
+
+    def test_post_batch(self):
+        user = User(username='susan', email='susan@example.com')
+        user.get_token()
+        db.session.add(user)
+        db.session.commit()
+        headers = {'Authorization': 'Bearer ' + user.token}
+        posts = [{'body': 'post {}'.format(i)} for i in range(5)]
+        posts[1] = {'body': ''}
+        posts[3]['timestamp'] = '2020-01-02T03:04:05Z'
+        posts[4]['language'] = 'es'
+        posts[2]['timestamp'] = '2020-01-01T10:00:00+02:00'
+        response = self.client.post('/api/posts/batch', json={'posts': posts}, headers=headers)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json['_meta'], {'created': 4, 'failed': 1})
+        items = response.json['items']
+        self.assertEqual([item['status'] for item in items], [201, 400, 201, 201, 201])
+        self.assertEqual(items[1]['message'], 'must include a body')
+        self.assertEqual(User.query.get(user.id).post_count, 4)
+
+        post = self.client.get(items[3]['_links']['self'], headers=headers).json
+        self.assertEqual(post['timestamp'], '2020-01-02T03:04:05Z')
+        # timestamps with an offset are stored in UTC
+        self.assertEqual(Post.query.get(items[2]['id']).timestamp, datetime(2020, 1, 1, 8))
+        self.assertEqual(post['user_id'], user.id)
+        self.assertEqual(Post.query.get(items[4]['id']).language, 'es')
+        response = self.client.get('/api/users/{}/posts?per_page=2&fields=body'.format(user.id),
+                                   headers=headers)
+        self.assertEqual(response.json['items'], [{'id': items[0]['id'], 'body': 'post 0'},
+                                                  {'id': items[2]['id'], 'body': 'post 2'}])
+        self.assertIsNotNone(response.json['_links']['next'])
+
+        response = self.client.post('/api/posts', json={'body': 'single'}, headers=headers)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.headers['Location'].split('/')[-1], str(response.json['id']))
+        response = self.client.post('/api/posts/batch', json={'posts': [{'body': 'x' * 141}]},
+                                    headers=headers)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.post('/api/posts/batch', json={}, headers=headers).status_code,
+                         400)
+        self.assertEqual(self.client.post('/api/posts/batch', json=[{'body': 'x'}],
+                                          headers=headers).status_code, 400)
+        # timestamps must be strings, even if a number would parse
+        response = self.client.post('/api/posts/batch', json={'posts': [
+            {'body': 'number', 'timestamp': 20200101}, {'body': 'fine'}]}, headers=headers)
+        self.assertEqual([item['status'] for item in response.json['items']], [400, 201])
+        response = self.client.post('/api/posts', json={'body': 'x', 'timestamp': 20200101},
+                                    headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_follow_batch(self):
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i))
+                 for i in range(6)]
+        users[0].get_token()
+        db.session.add_all(users)
+        db.session.commit()
+        users[0].follow(users[1])
+        db.session.commit()
+        headers = {'Authorization': 'Bearer ' + users[0].token}
+        url = '/api/users/{}/followed'.format(users[0].id)
+        ids = [user.id for user in users]
+
+        # the token lookup, the diff, the insert, both counters, the change log of the bulk
+        # and of the ORM changes, and reading back followed_count - however many ids there are
+        with self.assert_max_queries(8):
+            response = self.client.post(url, json={'ids': ids + [999]}, headers=headers)
+        self.assertEqual(response.json['followed'], ids[2:])
+        self.assertEqual(response.json['followed_count'], 5)
+        for user in users[1:]:
+            self.assertEqual(User.query.get(user.id).follower_count, 1)
+        self.assertEqual(ChangeLog.query.filter_by(resource='follow').count(), 5)
+
+        response = self.client.delete(url, json={'ids': ids[1:3]}, headers=headers)
+        self.assertEqual(response.json['unfollowed'], ids[1:3])
+        self.assertEqual(response.json['followed_count'], 3)
+        response = self.client.put(url, json={'ids': [ids[1], ids[5]]}, headers=headers)
+        self.assertEqual(response.json, {'followed': [ids[1]], 'unfollowed': ids[3:5],
+                                         'followed_count': 2})
+        self.assertEqual(sorted(user.id for user in User.query.get(ids[0]).followed),
+                         [ids[1], ids[5]])
+        self.assertEqual(User.query.get(ids[3]).follower_count, 0)
+        self.assertEqual(User.repair_counters(), 0)
+
+        response = self.client.post('/api/users/{}/followed'.format(ids[1]), json={'ids': []},
+                                    headers=headers)
+        self.assertEqual(response.status_code, 403)
+        response = self.client.post(url, json={'ids': ['x']}, headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_changes(self):
+        self.app.config['CHANGES_SETTLE_SECONDS'] = 0
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i))
+                 for i in range(3)]
+        users[0].get_token()
+        db.session.add_all(users)
+        db.session.commit()
+        headers = {'Authorization': 'Bearer ' + users[0].token}
+        watermark = self.client.get('/api/changes', headers=headers).json['watermark']
+
+        def changes(limit=100):
+            response = self.client.get('/api/changes?since={}&limit={}'.format(
+                watermark, limit), headers=headers)
+            return response.json
+
+        post = Post(body='hello', author=users[1])
+        db.session.add(post)
+        users[0].follow(users[1])
+        db.session.commit()
+        users[2].about_me = 'changed'
+        db.session.delete(post)
+        db.session.commit()
+        data = changes()
+        items = {(item['resource'], item.get('id')): item for item in data['items']}
+        self.assertFalse(data['has_more'])
+        self.assertEqual(items[('post', post.id)]['operation'], 'delete')
+        self.assertIsNone(items[('post', post.id)]['data'])
+        self.assertEqual(items[('user', users[2].id)]['data']['about_me'], 'changed')
+        self.assertEqual(items[('follow', None)]['data'],
+                         {'follower_id': users[0].id, 'followed_id': users[1].id})
+        self.assertEqual(items[('follow', None)]['operation'], 'create')
+
+        # in batches, until the client has caught up
+        seen, batches = set(), 0
+        while True:
+            data = changes(limit=2)
+            seen.update((item['resource'], item.get('id')) for item in data['items'])
+            watermark = data['watermark']
+            batches += 1
+            if not data['has_more']:
+                break
+        self.assertEqual(seen, set(items))
+        self.assertGreater(batches, 2)
+        self.assertEqual(changes()['items'], [])
+        users[0].unfollow(users[1])
+        db.session.commit()
+        follows = [item for item in changes()['items'] if item['resource'] == 'follow']
+        self.assertEqual([item['operation'] for item in follows], ['delete'])
+
+        ChangeLog.query.update({'timestamp': datetime.utcnow() - timedelta(days=365)})
+        total = ChangeLog.query.count()
+        self.assertEqual(ChangeLog.prune(), total - 1)
+        expired = self.client.get('/api/changes?since={}'.format(
+            encode_cursor([1, datetime.utcnow() - timedelta(days=365)], 'next')), headers=headers)
+        self.assertEqual(expired.status_code, 410)
+        self.assertEqual(self.client.get('/api/changes?since=x', headers=headers).status_code, 400)
+
+    def test_changes_out_of_order(self):
+        user = User(username='susan', email='susan@example.com')
+        user.get_token()
+        db.session.add(user)
+        db.session.commit()
+        headers = {'Authorization': 'Bearer ' + user.token}
+        ChangeLog.query.delete()
+        now = datetime.utcnow()
+
+        def change(id, age):
+            db.session.add(ChangeLog(id=id, resource='post', object_id=id, operation='delete',
+                                     timestamp=now - timedelta(seconds=age)))
+            db.session.commit()
+
+        def changes(since):
+            return self.client.get('/api/changes?since={}'.format(since), headers=headers).json
+
+        # change 2 is flushed before change 3 but its transaction commits after it
+        change(1, 60)
+        change(3, 1)
+        since = encode_cursor([0, now], 'next')
+        data = changes(since)
+        self.assertEqual([item['id'] for item in data['items']], [1])
+        self.assertFalse(data['has_more'])
+        change(2, 2)
+        ChangeLog.query.update({'timestamp': now - timedelta(seconds=60)})
+        db.session.commit()
+        self.assertEqual([item['id'] for item in changes(data['watermark'])['items']], [2, 3])
+
+    def test_changes_outside_session(self):
+        self.app.config['CHANGES_SETTLE_SECONDS'] = 0
+        users = [User(username='john', email='john@john.com'),
+                 User(username='susan', email='susan@susan.com')]
+        users[0].get_token()
+        db.session.add_all(users)
+        db.session.commit()
+        headers = {'Authorization': 'Bearer ' + users[0].token}
+        watermark = [self.client.get('/api/changes', headers=headers).json['watermark']]
+
+        def changed_users():
+            data = self.client.get('/api/changes?since={}'.format(watermark[0]),
+                                   headers=headers).json
+            watermark[0] = data['watermark']
+            return {item['id']: item['data'] for item in data['items']
+                    if item['resource'] == 'user'}
+
+        # buffered last_seen times, counters updated without loading the author,
+        # and repaired counters are all recorded in the change log
+        self.app.last_seen.record(users[1].id, datetime.utcnow() + timedelta(minutes=1))
+        self.app.last_seen.flush()
+        self.assertIn(users[1].id, changed_users())
+        db.session.add(Post(body='hello', user_id=users[1].id))
+        db.session.commit()
+        self.assertEqual(changed_users()[users[1].id]['post_count'], 1)
+        db.session.execute(User.__table__.update().values(post_count=5))
+        db.session.commit()
+        changed_users()
+        self.assertEqual(User.repair_counters(), 2)
+        db.session.commit()
+        changed = changed_users()
+        self.assertEqual({id: data['post_count'] for id, data in changed.items()},
+                         {users[0].id: 0, users[1].id: 1})
+        self.assertEqual(self.client.get('/api/changes?since={}'.format(
+            encode_cursor([[1], datetime.utcnow()], 'next')), headers=headers).status_code, 400)
+
+
+class InstrumentedConfig(PageConfig):
+    REQUEST_INSTRUMENTATION = True
+    SLOW_REQUEST_QUERIES = 1
+
+
+class InstrumentedPageRenderCase(PageRenderCase):
+    """
+    Runs the PageRenderCase tests again with request instrumentation enabled
+    """
+    config = InstrumentedConfig
+
+    def test_server_timing(self):
+        u = User(username='john', email='john@john.com')
+        db.session.add_all([u, Post(body='post from john', author=u)])
+        db.session.commit()
+        self.login(u)
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            response = self.client.get('/explore')
+        timing = response.headers['Server-Timing']
+        self.assertRegex(timing, r'^db;dur=[0-9.]+;desc="\d+ queries", tpl;dur=[0-9.]+, total;dur=')
+        self.assertIn('Slow request GET /explore', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+        # nothing is installed when instrumentation is off
+        app = create_app(PageConfig)
+        with app.test_request_context('/'):
+            response = app.process_response(app.response_class())
+        self.assertNotIn('Server-Timing', response.headers)
+
+
+class MetricsConfig(PageConfig):
+    METRICS = True
+    METRICS_DIR = os.path.join(TEST_DIR, 'metrics')
+
+
+class MetricsCase(AppTestCase):
+    config = MetricsConfig
+
+    def setUp(self):
+        super(MetricsCase, self).setUp()
+        self.dir = self.app.config['METRICS_DIR']
+
+    def tearDown(self):
+        super(MetricsCase, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def test_metrics(self):
+        u = User(username='john', email='john@john.com')
+        db.session.add(u)
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        self.client.get('/explore')
+        self.client.get('/explore')
+        self.client.get('/no-such-page')
+        with self.app.test_request_context():
+            with timed('translator'):
+                pass
+
+        # the metrics of another worker process, that has exited
+        other = {'pid': 2 ** 22 + 1,
+                 'counters': [['http_requests_total', [['blueprint', 'main'],
+                               ['endpoint', 'main.explore'], ['method', 'GET'],
+                               ['status', 200]], 3]],
+                 'gauges': [['http_requests_in_flight', [], 5]],
+                 'histograms': []}
+        with open(os.path.join(self.dir, 'metrics-other.json'), 'w') as f:
+            json.dump(other, f)
+
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('# TYPE http_request_duration_seconds histogram', text)
+        self.assertIn('http_requests_total{blueprint="main",endpoint="main.explore",'
+                      'method="GET",status="200"} 5', text)
+        self.assertIn('http_requests_total{blueprint="",endpoint="",method="GET",'
+                      'status="404"} 1', text)
+        self.assertIn('http_request_duration_seconds_bucket{blueprint="main",'
+                      'endpoint="main.explore",le="+Inf"} 2', text)
+        self.assertRegex(text, r'db_queries_total{blueprint="main",endpoint="main.explore"} [1-9]')
+        self.assertIn('external_call_duration_seconds_count{service="translator"} 1', text)
+        # only the request for /metrics itself is in flight
+        self.assertIn('http_requests_in_flight 1\n', text)
+
+    def test_cache_metrics(self):
+        cache = self.app.search_cache
+        self.assertIsNone(cache.get('post', 'hello'))
+        cache.put('post', 'hello', [1, 2], 2, cache.generation('post'))
+        self.assertEqual(cache.get('post', 'hello'), ([1, 2], 2))
+
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('# TYPE cache_hits_total counter', text)
+        self.assertIn('cache_hits_total{cache="search"} 1\n', text)
+        self.assertIn('cache_misses_total{cache="search"} 1\n', text)
+        self.assertIn('cache_entries{cache="search"} 1\n', text)
+
+        identity = self.app.identity_cache
+        identity.put(('user', 1), {'id': 1})
+        self.assertIsNotNone(identity.get(('user', 1)))
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertRegex(text, r'cache_hits_total{cache="identity"} [1-9]')
+        self.assertRegex(text, r'cache_entries{cache="identity"} [1-9]')
+
+
+class RateLimitConfig(PageConfig):
+    RATELIMITS = {'api': '2/minute', 'main.explore': '1/minute'}
+    TRUSTED_PROXIES = 1
+
+
+class RateLimitCase(AppTestCase):
+    config = RateLimitConfig
+
+    def test_rate_limit(self):
+        users = [User(username='john', email='john@john.com'),
+                 User(username='susan', email='susan@susan.com')]
+        for user in users:
+            user.get_token()
+        db.session.add_all(users)
+        db.session.commit()
+
+        # each token has a bucket of its own
+        john = {'Authorization': 'Bearer ' + users[0].token}
+        for _ in range(2):
+            self.assertEqual(self.client.get('/api/users', headers=john).status_code, 200)
+        response = self.client.get('/api/users/1', headers=john)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json['error'], 'Too Many Requests')
+        self.assertGreater(int(response.headers['Retry-After']), 0)
+        self.assertLessEqual(int(response.headers['Retry-After']), 30)
+        susan = {'Authorization': 'Bearer ' + users[1].token}
+        self.assertEqual(self.client.get('/api/users', headers=susan).status_code, 200)
+
+        # browser sessions are limited by user, other endpoints are not limited
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(users[0].id)
+        self.assertEqual(self.client.get('/explore').status_code, 200)
+        response = self.client.get('/explore', headers={'Accept': 'text/html'})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn(b'Too Many Requests', response.data)
+        self.assertIn('Retry-After', response.headers)
+        self.assertEqual(self.client.get('/index').status_code, 200)
+
+    def test_made_up_tokens(self):
+        # every request takes from the bucket of its address, whatever token it sends
+        forwarded = {'X-Forwarded-For': '203.0.113.7'}
+        statuses = [self.client.get('/api/users', headers=dict(forwarded, **{
+            'Authorization': 'Bearer ' + os.urandom(8).hex()})).status_code for _ in range(10)]
+        self.assertEqual(statuses, [401] * 8 + [429] * 2)
+        # anonymous requests get the plain limit, the address comes from the trusted proxy
+        self.assertEqual(self.client.get('/api/users', headers=forwarded).status_code, 401)
+        self.assertEqual(self.client.get('/api/users', headers=forwarded).status_code, 401)
+        self.assertEqual(self.client.get('/api/users', headers=forwarded).status_code, 429)
+        self.assertEqual(self.client.get('/api/users', headers={
+            'X-Forwarded-For': '203.0.113.8'}).status_code, 401)
+
+    def test_memory_store(self):
+        store = MemoryStore()
+        self.assertEqual(store.take('key', 2, 1 / 60), (True, 0.0))
+        self.assertEqual(store.take('key', 2, 1 / 60), (True, 0.0))
+        allowed, retry_after = store.take('key', 2, 1 / 60)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 60, delta=1)
+        # a fast bucket refills in a few milliseconds
+        self.assertTrue(store.take('fast', 1, 1000)[0])
+        time.sleep(0.01)
+        self.assertTrue(store.take('fast', 1, 1000)[0])
+        self.assertEqual(parse_limit('30/minute'), (30, 0.5))
+
+
+class ProfilerConfig(PageConfig):
+    PROFILE_DIR = os.path.join(TEST_DIR, 'profiles')
+    ADMINS = 'admin@example.com'
+
+
+class ProfilerCase(AppTestCase):
+    config = ProfilerConfig
+
+    def setUp(self):
+        super(ProfilerCase, self).setUp()
+        self.dir = self.app.config['PROFILE_DIR']
+
+    def tearDown(self):
+        super(ProfilerCase, self).tearDown()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_sampling(self):
+        profiler = self.app.profiler
+        profiler.start_request('main.index')
+        profiler.sample()
+        profiler.sample()
+        profiler.end_request()
+        profiler.sample()               # no request is profiled any more
+        profiler.write()
+
+        profiles = collect_profiles(self.dir)
+        self.assertEqual(sum(profiles['main.index'].values()), 2)
+        stack, count = profiles['main.index'].most_common(1)[0]
+        self.assertIn('test_sampling', stack)
+        self.assertIn(' 2\n', collapsed(profiles['main.index']))
+        profile = speedscope(profiles)['profiles'][0]
+        self.assertEqual((profile['name'], profile['weights']), ('main.index', [2]))
+
+    def test_admin_route(self):
+        u1 = User(username='john', email='john@john.com')
+        u2 = User(username='admin', email='admin@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u1.id)
+        self.assertEqual(self.client.get('/admin/profile').status_code, 403)
+
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u2.id)
+        response = self.client.post('/admin/profile', json={'rate': 1, 'endpoint': 'main.explore'})
+        self.assertEqual(response.json['endpoint'], 'main.explore')
+        self.app.profiler.control_checked = 0      # the control file is read once a second
+        self.assertTrue(self.app.profiler.should_profile('main.explore'))
+        self.assertFalse(self.app.profiler.should_profile('main.index'))
+        self.assertEqual(self.client.get('/admin/profile').json['control']['rate'], 1)
+
+        self.client.post('/admin/profile', json={'rate': 0})
+        self.assertIsNone(self.client.get('/admin/profile').json['control'])
+
+    def test_report_command(self):
+        cli.register(self.app)
+        runner = self.app.test_cli_runner()
+        # an endpoint without samples has an empty profile
+        result = runner.invoke(args=['profile', 'report', 'main.explore'])
+        self.assertEqual((result.exit_code, result.output), (0, ''))
+        result = runner.invoke(args=['profile', 'report', 'main.explore', '--format', 'speedscope'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(json.loads(result.output)['profiles'][0]['weights'], [])
+
+
+class StreamConfig(PageConfig):
+    NOTIFICATION_BROKER = 'local'
+    NOTIFICATION_STREAM_TIMEOUT = 0
+
+
+class NotificationCase(AppTestCase):
+    config = StreamConfig
+
+    def test_stream_opt_in(self):
+        u = User(username='john', email='john@john.com')
+        db.session.add(u)
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        self.assertIn(b'new EventSource', self.client.get('/index').data)
+        # without a broker, the default, the pages poll and do not open a stream at all
+        self.assertIsNone(create_app(PageConfig).notifier)
+        self.app.config['NOTIFICATION_BROKER'] = 'none'
+        self.assertNotIn(b'new EventSource', self.client.get('/index').data)
+
+    def test_publish(self):
+        u = User(username='john', email='john@john.com')
+        db.session.add(u)
+        db.session.commit()
+        subscription = self.app.notifier.subscribe(user_channel(u.id))
+        u.add_notification('unread_message_count', 3)
+        db.session.rollback()
+        self.assertIsNone(subscription.get(0))
+
+        u.add_notification('unread_message_count', 2)
+        self.assertIsNone(subscription.get(0))
+        db.session.commit()
+        message = json.loads(subscription.get(0))
+        self.assertEqual((message['name'], message['data']), ('unread_message_count', 2))
+        subscription.close()
+        self.assertEqual(self.app.notifier.channels, {})
+
+    def test_concurrent_first_notification(self):
+        u = User(username='john', email='john@john.com')
+        db.session.add(u)
+        u.add_notification('unread_message_count', 1)
+        db.session.commit()
+        subscription = self.app.notifier.subscribe(user_channel(u.id))
+
+        # another request inserted the notification after this one found none to update
+        update = User._update_notification
+        calls = []
+
+        def missed_once(user, payload):
+            calls.append(payload)
+            return len(calls) > 1 and update(user, payload)
+
+        with mock.patch.object(User, '_update_notification', missed_once):
+            u.add_notification('unread_message_count', 2)
+        db.session.commit()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual([n.get_data() for n in u.notifications], [2])
+        self.assertEqual(json.loads(subscription.get(0))['data'], 2)
+        subscription.close()
+
+    def test_stream(self):
+        u = User(username='john', email='john@john.com')
+        db.session.add(u)
+        u.add_notification('unread_message_count', 1)
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        timestamp = u.notifications.first().timestamp
+
+        response = self.client.get('/notifications/stream')
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        body = response.get_data(as_text=True)
+        self.assertIn('id: {}\n'.format(timestamp), body)
+        self.assertIn('"data": 1', body)
+        # a reconnecting client only gets the notifications it has not seen
+        response = self.client.get('/notifications/stream',
+                                   headers={'Last-Event-ID': str(timestamp)})
+        self.assertNotIn('data:', response.get_data(as_text=True))
+
+        self.app.notifier = None
+        self.assertEqual(self.client.get('/notifications/stream').status_code, 204)
+
+
+class FakeElasticsearch(object):
+    """
+    Records the requests sent to Elasticsearch
+    """
+
+    def __init__(self):
+        self.bulk_requests = []
+
+    def bulk(self, body):
+        self.bulk_requests.append(body)
+        return {'errors': False, 'items': []}
+
+
+class SearchIndexCase(AppTestCase):
+
+    def setUp(self):
+        super(SearchIndexCase, self).setUp()
+        self.es = FakeElasticsearch()
+        self.app.search_backend = ElasticsearchBackend(self.es)
+
+    def test_bulk_after_commit(self):
+        u = User(username='john', email='john@john.com')
+        posts = [Post(body='post {}'.format(i), author=u) for i in range(3)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        requests = self.es.bulk_requests
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(len(requests[0]), 6)
+        self.assertEqual(sorted(r['body'] for r in requests[0][1::2]),
+                         ['post 0', 'post 1', 'post 2'])
+
+        posts[0].body = 'edited'
+        db.session.delete(posts[1])
+        db.session.commit()
+        self.assertEqual(len(requests), 2)
+        self.assertIn({'index': {'_index': 'post', '_id': posts[0].id}}, requests[1])
+        self.assertIn({'delete': {'_index': 'post', '_id': posts[1].id}}, requests[1])
+        self.assertIn({'body': 'edited'}, requests[1])
+
+    def test_reindex_in_chunks(self):
+        u = User(username='john', email='john@john.com')
+        db.session.add_all([u] + [Post(body='post {}'.format(i), author=u) for i in range(5)])
+        db.session.commit()
+        self.es.bulk_requests = []
+        count, rate = Post.reindex(chunk_size=2)
+        self.assertEqual(count, 5)
+        self.assertGreater(rate, 0)
+        self.assertEqual([len(r) // 2 for r in self.es.bulk_requests], [2, 2, 1])
+
+
+class OutboxConfig(TestConfig):
+    SEARCH_SYNC = 'outbox'
+
+
+class SearchOutboxCase(AppTestCase):
+    config = OutboxConfig
+
+    def setUp(self):
+        super(SearchOutboxCase, self).setUp()
+        self.es = FakeElasticsearch()
+        self.app.search_backend = ElasticsearchBackend(self.es)
+
+    def test_outbox(self):
+        u = User(username='john', email='john@john.com')
+        p1 = Post(body='first', author=u)
+        p2 = Post(body='second', author=u)
+        db.session.add_all([u, p1, p2])
+        db.session.commit()
+        p1.body = 'first, edited'
+        db.session.commit()
+        db.session.delete(p2)
+        db.session.commit()
+        # nothing is sent inline, the changes wait in the outbox
+        self.assertEqual(self.es.bulk_requests, [])
+        self.assertEqual(SearchOutbox.lag()[0], 4)
+
+        self.assertEqual(SearchOutbox.drain(), 4)
+        self.assertEqual(self.es.bulk_requests, [[
+            {'index': {'_index': 'post', '_id': p1.id}}, {'body': 'first, edited'},
+            {'delete': {'_index': 'post', '_id': p2.id}}]])
+        self.assertEqual(SearchOutbox.lag(), (0, 0.0))
+        self.assertEqual(SearchOutbox.drain(), 0)
+
+    def test_outbox_retry(self):
+        def unavailable(body):
+            raise ConnectionError('no elasticsearch')
+        self.es.bulk = unavailable
+        db.session.add(Post(body='post'))
+        db.session.commit()
+        self.assertEqual(SearchOutbox.drain(), 1)
+        record = SearchOutbox.query.one()
+        self.assertEqual(record.attempts, 1)
+        self.assertGreater(record.next_attempt, datetime.utcnow())
+        # not due yet
+        self.assertEqual(SearchOutbox.drain(), 0)
+
+    def test_outbox_partial_failure(self):
+        # the first operation of the batch is rejected because the cluster is busy,
+        # the second because the document is invalid
+        def partial(body):
+            items = [{'index': {'_id': body[0]['index']['_id'], 'status': 429,
+                                'error': {'type': 'es_rejected_execution_exception'}}},
+                     {'index': {'_id': body[2]['index']['_id'], 'status': 400,
+                                'error': {'type': 'mapper_parsing_exception'}}},
+                     {'index': {'_id': body[4]['index']['_id'], 'status': 201}}]
+            return {'errors': True, 'items': items}
+        self.es.bulk = partial
+        posts = [Post(body='post {}'.format(i)) for i in range(3)]
+        db.session.add_all(posts)
+        db.session.commit()
+        self.assertEqual(SearchOutbox.drain(), 3)
+        record = SearchOutbox.query.one()
+        self.assertEqual(record.object_id, posts[0].id)
+        self.assertEqual(record.attempts, 1)
+        self.assertGreater(record.next_attempt, datetime.utcnow())
+
+
+class LocalSearchConfig(TestConfig):
+    SEARCH_BACKEND = 'local'
+    SEARCH_INDEX_DIR = os.path.join(TEST_DIR, 'search_index')
+    SEARCH_MERGE_FACTOR = 3
+    SEARCH_REINDEX_STATE_DIR = os.path.join(TEST_DIR, 'search_index', 'reindex')
+
+
+class LocalSearchCase(AppTestCase):
+    config = LocalSearchConfig
+
+    def setUp(self):
+        super(LocalSearchCase, self).setUp()
+        self.dir = self.app.config['SEARCH_INDEX_DIR']
+
+    def tearDown(self):
+        super(LocalSearchCase, self).tearDown()
+        self.app.search_backend.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_search(self):
+        u = User(username='john', email='john@john.com')
+        p1 = Post(body='the quick brown fox', author=u)
+        p2 = Post(body='the lazy dog', author=u)
+        p3 = Post(body='fox news about a fox', author=u)
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+        posts, total = Post.search('FOX', 1, 10)
+        self.assertEqual((posts.all(), total), ([p3, p1], 2))
+        self.assertEqual(query_index('post', 'the fox', 2, 2), ([p2.id], 3))
+
+        p3.body = 'nothing to see here'
+        db.session.delete(p1)
+        db.session.commit()
+        self.assertEqual(query_index('post', 'fox', 1, 10), ([], 0))
+        self.assertEqual(query_index('post', 'nothing', 1, 10), ([p3.id], 1))
+
+        # another process sharing the directory sees the same index
+        other = LocalSearchBackend(self.dir)
+        self.assertEqual(other.query('post', 'lazy', 1, 10), ([p2.id], 1))
+
+    def test_search_cache(self):
+        u = User(username='john', email='john@john.com')
+        posts = [Post(body='fox number {}'.format(i), author=u) for i in range(5)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        cache = self.app.search_cache
+        first, total = Post.search('fox', 1, 2)
+        self.assertEqual((len(first.all()), total), (2, 5))
+        second, total = Post.search('  FOX ', 2, 2)
+        self.assertEqual(len(second.all()), 2)
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (1, 1))
+
+        # a commit that changes a post invalidates the cached results
+        db.session.add(Post(body='another fox', author=u))
+        db.session.commit()
+        posts, total = Post.search('fox', 1, 2)
+        self.assertEqual(total, 6)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_search_after(self):
+        u = User(username='john', email='john@john.com')
+        db.session.add_all([u] + [Post(body='fox ' * (i % 3 + 1), author=u) for i in range(7)])
+        db.session.commit()
+        expected, total = query_index('post', 'fox', 1, 10)
+        found, cursor = [], search_cursor(1)
+        while cursor:
+            posts, total, cursor = Post.search_after('fox', cursor, 2)
+            found += [p.id for p in posts]
+        self.assertEqual(total, 7)
+        self.assertEqual(found, expected[1:])
+        # forged cursors are rejected before they reach the index
+        for state in [{'after': 'abc'}, {'after': [1.0, 'x']}, {'offset': 'x'},
+                      {'offset': -1}, {'pit': 1}, {'total': [1]}]:
+            with self.assertRaises(InvalidCursor):
+                Post.search_after('fox', encode_search_cursor(state), 2)
+
+    def test_shadowing(self):
+        index = self.app.search_backend.get_index('shadow')
+        index.write({1: 'red fox', 2: 'red dog'}, set())
+        index.write({1: 'blue fox'}, {2})
+        self.assertEqual(index.search('red', 10), ([], 0))
+        self.assertEqual([doc_id for _, doc_id in index.search('fox', 10)[0]], [1])
+        newest = index.refresh()[-1]
+        self.assertEqual([newest.shadows(doc_id) for doc_id in (1, 2, 3)], [True, True, False])
+
+    def test_merge(self):
+        backend = self.app.search_backend
+        for i in range(9):
+            backend.bulk([('index', 'post', i, {'body': 'post number {}'.format(i)}),
+                          ('delete', 'post', i - 1, None)])
+        index = backend.get_index('post')
+        while index.merging:
+            time.sleep(0.01)
+        index._merge_loop()
+        self.assertEqual(len(index.refresh()), 1)
+        self.assertEqual(os.listdir(self.dir + '/post').count('MANIFEST'), 1)
+        self.assertEqual(backend.query('post', 'post', 1, 10), ([8], 1))
+        self.assertEqual(backend.query('post', '8', 1, 10), ([8], 1))
+
+    def test_reindex(self):
+        self.app.config['CHANGES_SETTLE_SECONDS'] = 0
+        u = User(username='john', email='john@john.com')
+        posts = [Post(body='fox number {}'.format(i), author=u) for i in range(5)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        backend = self.app.search_backend
+        backend.bulk([('delete', 'post', posts[0].id, None)])
+        self.assertEqual(query_index('post', 'fox', 1, 10)[1], 4)
+
+        count, rate = reindex('post', workers=0, chunk_size=2, log=lambda msg: None)
+        self.assertEqual(count, 5)
+        self.assertNotEqual(backend.resolve('post'), 'post')
+        self.assertFalse(os.path.isdir(os.path.join(self.dir, 'post')))
+        self.assertEqual(query_index('post', 'fox', 1, 10)[1], 5)
+        self.assertEqual(os.listdir(self.app.config['SEARCH_REINDEX_STATE_DIR']), [])
+
+        # posts created with an old timestamp or deleted during a build are caught up
+        def during_build(message):
+            if message.startswith('Building'):
+                db.session.add(Post(body='backdated fox', author=u, timestamp=datetime(2000, 1, 1)))
+                db.session.delete(posts[4])
+                db.session.commit()
+        count, rate = reindex('post', workers=0, chunk_size=2, log=during_build)
+        self.assertEqual(count, 4 + 2)
+        self.assertEqual(query_index('post', 'fox', 1, 10)[1], 5)
+        self.assertIn('backdated fox', [post.body for post in
+                                        Post.query.filter(Post.id.in_(
+                                            query_index('post', 'backdated', 1, 10)[0]))])
+
+        # an incremental reindex only sends the rows that changed since a time
+        posts[1].timestamp = datetime.utcnow() + timedelta(minutes=1)
+        db.session.commit()
+        since = datetime.utcnow() + timedelta(seconds=30)
+        self.assertEqual(reindex_since('post', since), 1)
+
+
+class FanoutOnWriteConfig(TestConfig):
+    TIMELINE_FANOUT = 'write'
+    TIMELINE_FANOUT_THRESHOLD = 1
+
+
+class TimelineCase(UserModelCase):
+    """
+    Runs the UserModelCase tests again with precomputed home timelines
+    """
+    config = FanoutOnWriteConfig
+
+    def test_timeline_fanout(self):
+        u1 = User(username='john', email='john@john.com')
+        u2 = User(username='susan', email='susan@susan.com')
+        u3 = User(username='bob', email='bob@bob.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        now = datetime.utcnow()
+        p1 = Post(body='old post from susan', author=u2, timestamp=now)
+        db.session.add(p1)
+        db.session.commit()
+
+        # following backfills older posts, new posts are pushed on commit
+        u1.follow(u2)
+        db.session.commit()
+        p2 = Post(body='new post from susan', author=u2, timestamp=now+timedelta(seconds=1))
+        db.session.add(p2)
+        db.session.commit()
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=u1.id).count(), 2)
+        self.assertEqual(u1.followed_posts().all(), [p2, p1])
+
+        # susan goes over the threshold, her new posts are merged in on read
+        u3.follow(u2)
+        db.session.commit()
+        p3 = Post(body='popular post from susan', author=u2, timestamp=now+timedelta(seconds=2))
+        db.session.add(p3)
+        db.session.commit()
+        self.assertEqual(TimelineEntry.query.filter_by(post_id=p3.id).count(), 1)
+        self.assertEqual(u1.followed_posts().all(), [p3, p2, p1])
+
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=u1.id).count(), 0)
+        self.assertEqual(u1.followed_posts().all(), [])
+
+        TimelineEntry.rebuild(u3)
+        db.session.commit()
+        self.assertEqual(u3.followed_posts().all(), [p3, p2, p1])
+
+    def test_batch_fanout(self):
+        u1 = User(username='john', email='john@john.com')
+        u2 = User(username='susan', email='susan@susan.com')
+        u3 = User(username='bob', email='bob@bob.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        u1.follow(u3)
+        u2.follow(u3)
+        db.session.commit()
+
+        # bob is over the threshold, his posts only go into his own timeline
+        now = datetime.utcnow()
+        posts = [Post(body='post {}'.format(i), author=[u2, u3][i % 2],
+                      timestamp=now + timedelta(seconds=i)) for i in range(4)]
+        db.session.add_all(posts)
+        db.session.commit()
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=u1.id).count(), 2)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=u3.id).count(), 2)
+        self.assertEqual(u1.followed_posts().all(), posts[::-1])
+
+        # following in bulk backfills the timeline in the same way
+        u1.unfollow_many([u2.id, u3.id])
+        db.session.commit()
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=u1.id).count(), 0)
+        self.assertEqual(u1.follow_many([u2.id, u3.id]), [u2.id, u3.id])
+        db.session.commit()
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=u1.id).count(), 2)
+        self.assertEqual(u1.followed_posts().all(), posts[::-1])
+
+    def test_timeline_trim(self):
+        u1 = User(username='john', email='john@john.com')
+        u2 = User(username='susan', email='susan@susan.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        self.app.config['TIMELINE_LENGTH'] = 3
+        now = datetime.utcnow()
+        # two posts with the same timestamp straddle the cut
+        posts = [Post(body='post {}'.format(i), author=u2,
+                      timestamp=now + timedelta(seconds=[0, 1, 1, 2, 3][i])) for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=u1.id).count(), 5)
+        self.assertEqual(TimelineEntry.trim(), 4)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [posts[4], posts[3], posts[2]])
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=u2.id).count(), 3)
+        self.assertEqual(TimelineEntry.trim(), 0)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file